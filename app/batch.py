@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import asyncio
+import zipfile
+import tempfile
+
+from app.excel_to_markdown import convert_excel_to_markdown
+from app.fill_excel_with_json import fill_excel_template, load_excel_template
+from app.fill_excel_with_scan import (
+    SCAN_MAPPING_MODE, extract_document_structure, resolve_cells_from_profile, select_scan_pages, map_document
+)
+from app.mapping_coverage import MAPPING_COVERAGE_CHECK_ENABLED, template_cell_flags
+from app.template_profile import template_fingerprint, load_template_profile
+from utils.file_utils import cleanup_files
+from utils.metrics_utils import increment_counter
+
+BATCH_MAX_DOCUMENTS = int(os.getenv('BATCH_MAX_DOCUMENTS', '50'))
+# How many documents of one batch may be in each stage at the same time
+BATCH_TEXTRACT_CONCURRENCY = int(os.getenv('BATCH_TEXTRACT_CONCURRENCY', '4'))
+BATCH_GEMINI_CONCURRENCY = int(os.getenv('BATCH_GEMINI_CONCURRENCY', '4'))
+BATCH_FILL_CONCURRENCY = int(os.getenv('BATCH_FILL_CONCURRENCY', '2'))
+
+
+class _ZipStream:
+    """Write-only sink for zipfile; the bytes written so far are taken out with drain() and streamed."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def prepare_batch_template(request_id, template_path: str) -> tuple[str, dict, dict | None]:
+    """
+    Converts the batch template to Markdown and loads its profile, once for all documents.
+    Also returns the template's formula cells and merged ranges for the coverage check (None when it is off).
+    """
+    success, excel_markdown_or_error = convert_excel_to_markdown(template_path)
+    if not success:
+        raise RuntimeError(f"Failed to convert Excel template: {excel_markdown_or_error}")
+    print(f"[{request_id}] Batch template converted to Markdown.")
+    template_flags = None
+    if MAPPING_COVERAGE_CHECK_ENABLED:
+        _, ws, merged_ranges = load_excel_template(template_path)
+        template_flags = template_cell_flags(ws, merged_ranges)
+    return excel_markdown_or_error, load_template_profile(template_fingerprint(excel_markdown_or_error)), template_flags
+
+
+async def _process_document(request_id, index: int, document: dict, template_path: str, excel_markdown: str, profile: dict, template_flags: dict | None, limits: dict) -> dict:
+    """
+    Runs one document through Textract, the Gemini mapping and the fill. Every stage waits for its own
+    semaphore, so while one document is being filled the next ones are already in Textract or Gemini.
+    """
+    doc_request_id = f"{request_id}/{index}"
+    status = {"index": index, "filename": document["filename"], "status": "failed", "error": None, "cells": 0, "timings": {}}
+    raw_text_path = table_path = structure_path = output_path = None
+    started = time.perf_counter()
+
+    async def run_stage(stage: str, limit: str, func, *args):
+        async with limits[limit]:
+            stage_start = time.perf_counter()
+            try:
+                return await asyncio.to_thread(func, *args)
+            finally:
+                status["timings"][stage] = round(time.perf_counter() - stage_start, 3)
+
+    try:
+        textract = await run_stage("textract", "textract", extract_document_structure, doc_request_id, document["path"])
+        raw_text_path, table_path, structure_path, structure = textract
+        status["pages"], resolved = await asyncio.to_thread(
+            lambda: (select_scan_pages(doc_request_id, excel_markdown, structure), resolve_cells_from_profile(doc_request_id, profile, structure))
+        )
+        # The same mapping as /fill-excel-with-scan/: profile, Gemini, coverage follow-up and profile learning
+        data_to_insert = await run_stage(
+            "mapping", "gemini", map_document, doc_request_id, SCAN_MAPPING_MODE, excel_markdown, document["path"],
+            textract, profile, resolved, status["pages"], template_flags
+        )
+
+        output_path = tempfile.mktemp(suffix="_filled.xlsx")
+        success, error = await run_stage("fill", "fill", fill_excel_template, template_path, output_path, data_to_insert)
+        if not success:
+            raise RuntimeError(f"Failed to fill Excel template: {error}")
+        status.update(status="succeeded", cells=len(data_to_insert))
+        return {"status": status, "output_path": output_path}
+    except Exception as e:
+        status["error"] = getattr(e, 'detail', None) or str(e)
+        print(f"[{doc_request_id}] Batch document {document['filename']} failed: {status['error']}")
+        cleanup_files(output_path)
+        return {"status": status, "output_path": None}
+    finally:
+        status["timings"]["total"] = round(time.perf_counter() - started, 3)
+        cleanup_files(raw_text_path, table_path, structure_path)
+
+
+async def stream_batch_zip(request_id, template_path: str, excel_markdown: str, profile: dict, template_flags: dict | None, documents: list[dict], cleanup_paths: list[str]):
+    """
+    Processes the documents as a pipeline and yields a zip archive as it grows: each filled workbook is added
+    as soon as its document finishes, and manifest.json with the status of every document closes the archive.
+    documents are {"filename", "path"} or {"filename", "error"} for uploads that were already rejected.
+    """
+    limits = {
+        "textract": asyncio.Semaphore(BATCH_TEXTRACT_CONCURRENCY),
+        "gemini": asyncio.Semaphore(BATCH_GEMINI_CONCURRENCY),
+        "fill": asyncio.Semaphore(BATCH_FILL_CONCURRENCY),
+    }
+    statuses = []
+    tasks = []
+    for index, document in enumerate(documents, start=1):
+        if document.get("error"):
+            statuses.append({"index": index, "filename": document["filename"], "status": "rejected", "error": document["error"], "cells": 0, "timings": {}})
+        else:
+            tasks.append(asyncio.create_task(
+                _process_document(request_id, index, document, template_path, excel_markdown, profile, template_flags, limits)
+            ))
+
+    sink = _ZipStream()
+    archive = zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED)
+    try:
+        for next_finished in asyncio.as_completed(tasks):
+            result = await next_finished
+            status = result["status"]
+            increment_counter("excel_agent_batch_documents_total", description="Documents processed in batches", status=status["status"])
+            if result["output_path"]:
+                stem = os.path.splitext(os.path.basename(status["filename"]))[0]
+                status["output"] = f"{status['index']:03d}_{stem}_filled.xlsx"
+                await asyncio.to_thread(archive.write, result["output_path"], status["output"])
+                cleanup_files(result["output_path"])
+            statuses.append(status)
+            print(f"[{request_id}] Batch document {status['index']}/{len(documents)} {status['status']}.")
+            yield sink.drain()
+
+        statuses.sort(key=lambda status: status["index"])
+        manifest = {
+            "documents": len(documents),
+            "succeeded": sum(1 for status in statuses if status["status"] == "succeeded"),
+            "results": statuses,
+        }
+        archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+        archive.close()
+        yield sink.drain()
+    finally:
+        # Also reached when the client disconnects mid-stream: stop the remaining documents
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for task in tasks:
+            if task.done() and not task.cancelled() and task.result()["output_path"]:
+                cleanup_files(task.result()["output_path"])
+        cleanup_files(*cleanup_paths)
@@ -0,0 +1,173 @@
+import os
+import re
+import datetime
+import threading
+from collections import OrderedDict
+from openpyxl import load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
+
+from app.excel_to_markdown import merged_cell_ranges, iter_filled_cells
+from utils.metrics_utils import timed_stage, increment_counter
+
+# Converted workbooks kept in memory, keyed by the content hash of the upload
+EXCEL_JSON_CACHE_SIZE = int(os.getenv('EXCEL_JSON_CACHE_SIZE', '64'))
+
+_json_cache = OrderedDict()
+_json_cache_lock = threading.Lock()
+
+
+# Quoted literals, escaped characters and bracketed colors or locales, none of which are date or time parts
+_FORMAT_LITERAL_PATTERN = re.compile(r'"[^"]*"|\\.|\[(?![hms]+\])[^\]]*\]', re.IGNORECASE)
+
+
+def _has_time_part(number_format: str) -> bool:
+    """True if a date number format shows a time of day (hours, seconds or AM/PM), not just the date."""
+    number_format = _FORMAT_LITERAL_PATTERN.sub('', number_format or '').lower()
+    return 'h' in number_format or 's' in number_format or 'am/pm' in number_format or 'a/p' in number_format
+
+
+def _typed_value(cell) -> tuple[str, object]:
+    """
+    Returns (type, JSON value) for a cell. Dates and times keep their type and are written as ISO 8601.
+    openpyxl reads every date-formatted number as a datetime, so a date format without a time part is a "date".
+    """
+    value = cell.value
+    if isinstance(value, bool):
+        return "boolean", value
+    if isinstance(value, (int, float)):
+        return "number", value
+    if isinstance(value, datetime.datetime):
+        if cell.is_date and not _has_time_part(cell.number_format):
+            return "date", value.date().isoformat()
+        return "datetime", value.isoformat()
+    if isinstance(value, datetime.date):
+        return "date", value.isoformat()
+    if isinstance(value, datetime.time):
+        return "time", value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return "duration", value.total_seconds()
+    return "string", str(value)
+
+
+def _read_formulas(excel_file_path: str) -> dict[str, dict[str, str]]:
+    """Formula text per sheet and cell. A streaming read without styles, so it is cheap next to the full load."""
+    wb = load_workbook(excel_file_path, read_only=True, data_only=False)
+    try:
+        formulas = {}
+        for ws in wb.worksheets:
+            sheet_formulas = formulas[ws.title] = {}
+            for row in ws.iter_rows():
+                for cell in row:
+                    if getattr(cell, 'data_type', None) == 'f':
+                        sheet_formulas[cell.coordinate] = str(cell.value)
+        return formulas
+    finally:
+        wb.close()
+
+
+def _iter_json_cells(ws, sheet_formulas: dict[str, str]):
+    """Yields (cell_id, cell) for the non-empty cells and, in place, the formula cells without a cached value."""
+    filled = dict(iter_filled_cells(ws))
+    for cell_id in sheet_formulas:
+        if cell_id not in filled:
+            filled[cell_id] = ws[cell_id]
+    for cell_id in sorted(filled, key=lambda cell_id: (filled[cell_id].row, filled[cell_id].column)):
+        yield cell_id, filled[cell_id]
+
+
+@timed_stage("excel_to_json")
+def convert_excel_to_json(excel_file_path: str) -> tuple[bool, dict | str]:
+    """
+    Converts an Excel file to a compact cell map with typed values.
+
+    Every sheet lists its non-empty cells column-wise ("ref", "value", "type", "format", "formula" arrays of
+    the same length), its merged ranges and the formulas of formula cells. A formula cell's "value" is the
+    value Excel cached; formula cells without a cached value are listed with value None and type "formula".
+    "format" indexes into the workbook-wide "number_formats" table.
+
+    Args:
+        excel_file_path: Path to the input Excel file.
+
+    Returns:
+        A tuple containing:
+        - bool: True if conversion was successful, False otherwise.
+        - dict | str: The cell map or an error message.
+    """
+    filename_for_log = os.path.basename(excel_file_path)
+    print(f"Starting conversion of '{filename_for_log}' to JSON...")
+    try:
+        wb = load_workbook(excel_file_path, data_only=True)
+        formulas = _read_formulas(excel_file_path)
+        number_formats = []
+        format_index = {}
+        sheets = []
+
+        for ws in wb.worksheets:
+            merged_ranges = merged_cell_ranges(ws)
+            sheet_formulas = formulas.get(ws.title, {})
+            cells = {"ref": [], "value": [], "type": [], "format": [], "formula": []}
+            for cell_id, cell in _iter_json_cells(ws, sheet_formulas):
+                if cell.value is None or str(cell.value).strip() == "":
+                    value_type, value = "formula", None  # Formula Excel has no cached result for
+                elif cell.data_type == 'e':
+                    value_type, value = "error", str(cell.value)  # e.g. #DIV/0! cached by Excel
+                else:
+                    value_type, value = _typed_value(cell)
+                number_format = cell.number_format or "General"
+                if number_format not in format_index:
+                    format_index[number_format] = len(number_formats)
+                    number_formats.append(number_format)
+                cells["ref"].append(cell_id)
+                cells["value"].append(value)
+                cells["type"].append(value_type)
+                cells["format"].append(format_index[number_format])
+                cells["formula"].append(sheet_formulas.get(cell_id))
+
+            sheets.append({
+                "name": ws.title,
+                "dimensions": ws.dimensions,
+                "cells": cells,
+                "merged_ranges": sorted(set(merged_ranges.values())),
+                "formulas": sheet_formulas,
+            })
+
+        print(f"Successfully converted '{filename_for_log}' to JSON.")
+        return True, {
+            "filename": os.path.basename(excel_file_path),
+            "number_formats": number_formats,
+            "sheets": sheets,
+        }
+
+    except FileNotFoundError:
+        print(f"Error converting '{filename_for_log}': File not found.")
+        return False, f"Excel file not found at path: {excel_file_path}"
+    except InvalidFileException:
+        print(f"Error converting '{filename_for_log}': Invalid file format.")
+        return False, f"Invalid Excel file format: {excel_file_path}. Only .xlsx is supported by openpyxl."
+    except Exception as e:
+        print(f"Error converting '{filename_for_log}': {str(e)}")
+        return False, f"An error occurred during Excel to JSON conversion: {str(e)}"
+
+
+def get_cached_excel_json(content_hash: str) -> dict | None:
+    """Returns the cell map of a workbook converted earlier, by the SHA-256 of its upload."""
+    with _json_cache_lock:
+        result = _json_cache.get(content_hash)
+        if result is not None:
+            _json_cache.move_to_end(content_hash)
+    increment_counter(
+        "excel_agent_excel_json_cache_total", description="Excel to JSON cache lookups",
+        result="hit" if result is not None else "miss"
+    )
+    return result
+
+
+def cache_excel_json(content_hash: str, result: dict) -> None:
+    """Keeps a cell map for later requests, evicting the least recently used beyond EXCEL_JSON_CACHE_SIZE."""
+    if EXCEL_JSON_CACHE_SIZE <= 0:
+        return
+    with _json_cache_lock:
+        _json_cache[content_hash] = result
+        _json_cache.move_to_end(content_hash)
+        while len(_json_cache) > EXCEL_JSON_CACHE_SIZE:
+            _json_cache.popitem(last=False)
@@ -1,8 +1,44 @@
+import re
 from openpyxl import load_workbook
 from openpyxl.utils import get_column_letter
 from openpyxl.utils.exceptions import InvalidFileException
 import os
 
+from utils.metrics_utils import timed_stage
+
+def merged_cell_ranges(ws) -> dict[str, str]:
+    """Maps every cell ID inside a merged range of the worksheet to the range coordinate (e.g. "A1:C2")."""
+    merged_ranges = {}
+    for merged_range in ws.merged_cells.ranges:
+        # Ensure the range coordinates are valid before iterating
+        if merged_range.min_row is None or merged_range.max_row is None or \
+           merged_range.min_col is None or merged_range.max_col is None:
+            continue # Skip invalid ranges if any
+
+        for row in range(merged_range.min_row, merged_range.max_row + 1):
+            for col in range(merged_range.min_col, merged_range.max_col + 1):
+                # Handle potential issues with get_column_letter if col is large or 0
+                try:
+                    col_letter = get_column_letter(col)
+                except ValueError:
+                    continue # Skip if column index is invalid
+                merged_ranges[f"{col_letter}{row}"] = merged_range.coord
+    return merged_ranges
+
+def iter_filled_cells(ws):
+    """Yields (cell_id, cell) for every non-empty cell of the worksheet, row by row."""
+    for row_idx, row in enumerate(ws.iter_rows(), start=1):
+        for col_idx, cell in enumerate(row, start=1):
+            try:
+                col_letter = get_column_letter(col_idx)
+            except ValueError:
+                continue # Skip invalid column index
+            cell_value = cell.value
+            # Only include non-empty cells
+            if cell_value is not None and str(cell_value).strip() != "":
+                yield f"{col_letter}{row_idx}", cell
+
+@timed_stage("excel_to_markdown")
 def convert_excel_to_markdown(excel_file_path: str) -> tuple[bool, str]:
     """
     Converts an Excel file to a markdown string.
@@ -29,51 +65,22 @@ def convert_excel_to_markdown(excel_file_path: str) -> tuple[bool, str]:
             # Add worksheet title as header
             markdown_output.append(f"\n## {ws.title}\n")
             
-            # Create a dictionary to store merged cell ranges
-            merged_ranges = {}
-            for merged_range in ws.merged_cells.ranges:
-                # Ensure the range coordinates are valid before iterating
-                if merged_range.min_row is None or merged_range.max_row is None or \
-                   merged_range.min_col is None or merged_range.max_col is None:
-                    continue # Skip invalid ranges if any
-                    
-                for row in range(merged_range.min_row, merged_range.max_row + 1):
-                    for col in range(merged_range.min_col, merged_range.max_col + 1):
-                        # Handle potential issues with get_column_letter if col is large or 0
-                        try:
-                            col_letter = get_column_letter(col)
-                        except ValueError:
-                            continue # Skip if column index is invalid
-                        cell_id = f"{col_letter}{row}"
-                        merged_ranges[cell_id] = merged_range.coord
-            
-            # Iterate through all cells in the worksheet
-            for row_idx, row in enumerate(ws.iter_rows(), start=1):
-                for col_idx, cell in enumerate(row, start=1):
-                    try:
-                        col_letter = get_column_letter(col_idx)
-                    except ValueError:
-                        continue # Skip invalid column index
-                    cell_id = f"{col_letter}{row_idx}"
-                    cell_value = cell.value
-                    
-                    # Only include non-empty cells
-                    if cell_value is not None and str(cell_value).strip() != "":
-                        # Check if cell is part of a merged range
-                        merge_info = ""
-                        if cell_id in merged_ranges:
-                            # Ensure merged_ranges[cell_id] is not None before formatting
-                            coord = merged_ranges.get(cell_id)
-                            if coord:
-                                merge_info = f" (merged range: {coord})"
-                        
-                        # Represent the cell value as a string, handle potential errors
-                        try:
-                            value_str = str(cell_value)
-                        except Exception:
-                            value_str = "[Error converting value]"
-                            
-                        markdown_output.append(f"{cell_id}: \"{value_str}\"{merge_info}  ")
+            merged_ranges = merged_cell_ranges(ws)
+            for cell_id, cell in iter_filled_cells(ws):
+                cell_value = cell.value
+                # Check if cell is part of a merged range
+                merge_info = ""
+                coord = merged_ranges.get(cell_id)
+                if coord:
+                    merge_info = f" (merged range: {coord})"
+
+                # Represent the cell value as a string, handle potential errors
+                try:
+                    value_str = str(cell_value)
+                except Exception:
+                    value_str = "[Error converting value]"
+
+                markdown_output.append(f"{cell_id}: \"{value_str}\"{merge_info}  ")
 
         print(f"Successfully converted '{filename_for_log}' to Markdown.")
         return True, '\n'.join(markdown_output)
@@ -87,4 +94,22 @@ def convert_excel_to_markdown(excel_file_path: str) -> tuple[bool, str]:
     except Exception as e:
         # Catch other potential exceptions during loading or processing
         print(f"Error converting '{filename_for_log}': {str(e)}")
-        return False, f"An unexpected error occurred processing {os.path.basename(excel_file_path)}: {str(e)}" 
\ No newline at end of file
+        return False, f"An unexpected error occurred processing {os.path.basename(excel_file_path)}: {str(e)}" 
+
+_MARKDOWN_CELL_PATTERN = re.compile(r'^([A-Z]+)(\d+): "(.*)"(?: \(merged range: ([A-Z]+\d+:[A-Z]+\d+)\))?\s*$')
+
+def parse_excel_markdown(markdown_content: str) -> dict[str, dict]:
+    """
+    Parses the cell lines produced by convert_excel_to_markdown back into a dictionary.
+
+    Returns:
+        A dict mapping cell IDs (e.g. "A4") to {"value": str, "merged_range": str | None}.
+        Sheet and file headers are skipped.
+    """
+    cells = {}
+    for line in markdown_content.splitlines():
+        match = _MARKDOWN_CELL_PATTERN.match(line)
+        if match:
+            col_letters, row, value, merged_range = match.groups()
+            cells[f"{col_letters}{row}"] = {"value": value, "merged_range": merged_range}
+    return cells
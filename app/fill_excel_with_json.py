@@ -3,34 +3,75 @@ from openpyxl import load_workbook
 from openpyxl.utils.exceptions import InvalidFileException
 import os # Added for basename
 
-def fill_excel_template(excel_template_file, output_file, data_to_insert):
+from app.recalculate import recalculate_workbook, write_cached_values
+from utils.metrics_utils import timed_stage, stage_timer
+
+# Evaluate the template's formulas after filling and store their results in the saved file, so the output
+# can be read with data_only=True (e.g. for QA) without opening it in Excel first
+FORMULA_RECALC_ENABLED = os.getenv('FORMULA_RECALC_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+def load_excel_template(excel_template_file):
+    """
+    Opens an Excel template for filling.
+    Returns the workbook, its "Sheet1" worksheet and a dict mapping every merged cell ID to its merged range.
+    """
+    wb = load_workbook(filename=excel_template_file)
+    ws = wb["Sheet1"]
+    
+    # Create a dictionary to store merged cell ranges
+    merged_ranges = {}
+    for merged_range in ws.merged_cells.ranges:
+        for row in range(merged_range.min_row, merged_range.max_row + 1):
+            for col in range(merged_range.min_col, merged_range.max_col + 1):
+                cell_id = f"{openpyxl.utils.get_column_letter(col)}{row}"
+                merged_ranges[cell_id] = merged_range.coord
+    return wb, ws, merged_ranges
+
+def write_template_cell(ws, merged_ranges, cell_id, value):
+    """Writes a value to a cell, redirecting writes inside a merged range to its master (top-left) cell."""
+    try:
+        # Check if the cell is part of a merged range
+        if cell_id in merged_ranges:
+            # Get the master cell (top-left cell) of the merged range
+            master_cell = ws[merged_ranges[cell_id].split(':')[0]]
+            master_cell.value = value
+        else:
+            ws[cell_id] = value
+        return True
+    except Exception as cell_error:
+        print(f"Error setting cell {cell_id} to {value}: {cell_error}")
+        return False
+
+def save_filled_workbook(wb, output_file, recalculate=None):
+    """
+    Saves a filled workbook. With recalculate (default: FORMULA_RECALC_ENABLED) the formulas are evaluated
+    first and their results written into the saved file as cached values. Every fill path saves through here.
+    """
+    if recalculate is None:
+        recalculate = FORMULA_RECALC_ENABLED
+    formula_results = None
+    if recalculate:
+        with stage_timer("recalculate"):
+            formula_results = recalculate_workbook(wb)
+
+    wb.save(output_file)
+    if formula_results:
+        write_cached_values(output_file, formula_results)
+
+@timed_stage("fill")
+def fill_excel_template(excel_template_file, output_file, data_to_insert, recalculate=None):
+    """
+    Fills the template and saves it to output_file. With recalculate (default: FORMULA_RECALC_ENABLED)
+    the formulas are evaluated and their results written into the file as cached values.
+    """
     print(f"Starting to fill Excel template '{os.path.basename(excel_template_file)}'...")
     try:
-        wb = load_workbook(filename=excel_template_file)
-        ws = wb["Sheet1"]
-        
-        # Create a dictionary to store merged cell ranges
-        merged_ranges = {}
-        for merged_range in ws.merged_cells.ranges:
-            for row in range(merged_range.min_row, merged_range.max_row + 1):
-                for col in range(merged_range.min_col, merged_range.max_col + 1):
-                    cell_id = f"{openpyxl.utils.get_column_letter(col)}{row}"
-                    merged_ranges[cell_id] = merged_range.coord
+        wb, ws, merged_ranges = load_excel_template(excel_template_file)
         
         for cell_id, value in data_to_insert.items():
-            try:
-                # Check if the cell is part of a merged range
-                if cell_id in merged_ranges:
-                    # Get the master cell (top-left cell) of the merged range
-                    master_cell = ws[merged_ranges[cell_id].split(':')[0]]
-                    master_cell.value = value
-                else:
-                    ws[cell_id] = value
-            except Exception as cell_error:
-                print(f"Error setting cell {cell_id} to {value}: {cell_error}")
-                continue
-                
-        wb.save(output_file)
+            write_template_cell(ws, merged_ranges, cell_id, value)
+
+        save_filled_workbook(wb, output_file, recalculate)
         print(f"Successfully filled Excel template and saved to '{os.path.basename(output_file)}'.")
         return True, None
     except FileNotFoundError:
@@ -1,17 +1,224 @@
 import uuid
 import os
+import re
 import json
 from typing import Tuple, List
 from fastapi import UploadFile, HTTPException # Removed BackgroundTasks, no longer needed here
 
 # Import core logic functions
-from app.excel_to_markdown import convert_excel_to_markdown
+from app.excel_to_markdown import convert_excel_to_markdown, parse_excel_markdown
 from app.scan_to_markdown import convert_scan_to_markdown
-from app.fill_excel_with_json import fill_excel_template
+from app.fill_excel_with_json import fill_excel_template, load_excel_template, write_template_cell, save_filled_workbook
+from app.mapping_coverage import MAPPING_COVERAGE_CHECK_ENABLED, template_cell_flags, cell_issue, check_mapping_coverage
+from app.template_profile import (
+    template_fingerprint, load_template_profile, is_profile_ready,
+    resolve_with_template_profile, learn_template_profile
+)
 
 # Import utility functions
-from utils.gemini_utils import generate_excel_mapping_from_markdown, get_gemini_client
+from utils.aws_utils import extract_text_and_tables, get_textract_client, read_textract_structure, render_key_value_context
+from utils.gemini_utils import (
+    generate_excel_mapping_from_markdown, stream_excel_mapping_from_markdown, stream_excel_mapping_from_structure,
+    stream_excel_mapping_followup,
+    generate_markdown_from_scan, get_gemini_client, load_document_images, select_textract_pages
+)
 from utils.file_utils import save_upload_file_tmp, cleanup_files # Added cleanup_files
+from utils.metrics_utils import increment_counter, stage_timer
+from utils.dag_utils import StageDAG
+from utils.page_filter_utils import filter_pages, kept_pages, format_page_decisions
+
+TEMPLATE_PROFILES_ENABLED = os.getenv('TEMPLATE_PROFILES_ENABLED', 'true').lower() == 'true'
+# "markdown": generate the scan Markdown, then map it (two Gemini calls). "direct": map the Textract
+# output straight onto the template in one call, with the page images unless SCAN_MAPPING_DIRECT_IMAGES is off
+MAPPING_MODES = ('markdown', 'direct')
+SCAN_MAPPING_MODE = os.getenv('SCAN_MAPPING_MODE', 'markdown').lower()
+SCAN_MAPPING_DIRECT_IMAGES = os.getenv('SCAN_MAPPING_DIRECT_IMAGES', 'true').lower() == 'true'
+
+_CELL_ID_PATTERN = re.compile(r'^[A-Z]{1,3}[1-9][0-9]*$')
+
+def resolve_cells_from_profile(request_id, profile: dict, structure: list[dict]) -> tuple[dict, list[str] | None]:
+    """
+    Fills what the learned template profile can resolve from the Textract structure.
+    Returns (cells, unresolved cell IDs); unresolved is None when no usable profile exists yet.
+    """
+    if not (TEMPLATE_PROFILES_ENABLED and is_profile_ready(profile)):
+        return {}, None
+    data_to_insert, unresolved_cells = resolve_with_template_profile(profile, structure)
+    print(f"[{request_id}] Template profile resolved {len(data_to_insert)} cells, {len(unresolved_cells)} unresolved.")
+    increment_counter(
+        "excel_agent_cache_hits_total" if not unresolved_cells else "excel_agent_cache_misses_total",
+        cache="template_profile"
+    )
+    return data_to_insert, unresolved_cells
+
+def select_scan_pages(request_id, excel_markdown: str, structure: list[dict]) -> list[dict]:
+    """
+    Decides which scan pages are sent to Gemini. Blank pages were already skipped before Textract; pages whose
+    text shares too little vocabulary with the template's labels are left out as well. Returns the per-page decisions.
+    """
+    labels = [cell["value"] for cell in parse_excel_markdown(excel_markdown).values()]
+    decisions = filter_pages(structure, labels)
+    irrelevant = sum(1 for decision in decisions if decision["decision"] == "irrelevant")
+    if irrelevant:
+        increment_counter("excel_agent_pages_skipped_total", irrelevant, description="Pages left out before Textract or Gemini", reason="irrelevant")
+    print(f"[{request_id}] Page filter: {format_page_decisions(decisions)}")
+    return decisions
+
+def read_form_text(raw_text_path: str, table_path: str, pages: list[int] | None) -> tuple[str, str]:
+    """Reads the Textract raw text and tables, keeping only the given page numbers if set."""
+    with open(raw_text_path, 'r', encoding='utf-8') as f:
+        raw_text = f.read()
+    with open(table_path, 'r', encoding='utf-8') as f:
+        table_data = f.read()
+    if pages is not None:
+        raw_text, table_data = select_textract_pages(raw_text, pages), select_textract_pages(table_data, pages)
+    return raw_text, table_data
+
+def _valid_pairs(request_id, pairs):
+    for cell_id, value in pairs:
+        if not _CELL_ID_PATTERN.match(cell_id) or isinstance(value, (dict, list)):
+            print(f"[{request_id}] Skipping invalid mapping entry {cell_id!r}: {value!r}")
+            continue
+        yield cell_id, value
+
+def iter_valid_mapping(request_id, gemini_client, excel_markdown: str, scan_markdown: str, exclude_cells: list[str]):
+    """Streams the Gemini mapping, yielding only (cell_id, value) pairs with a valid cell ID and a scalar value."""
+    yield from _valid_pairs(request_id, stream_excel_mapping_from_markdown(gemini_client, excel_markdown, scan_markdown, exclude_cells=exclude_cells))
+
+def iter_valid_direct_mapping(request_id, gemini_client, excel_markdown: str, doc_path: str, raw_text_path: str, table_path: str, structure: list[dict], exclude_cells: list[str], pages: list[int] | None = None):
+    """Like iter_valid_mapping, but maps the Textract output (and page images) without the scan Markdown."""
+    raw_text, table_data = read_form_text(raw_text_path, table_path, pages)
+    if pages is not None:
+        structure = [page for page in structure if page["page"] in pages]
+    images = load_document_images(doc_path, "gemini_mapping", pages) if SCAN_MAPPING_DIRECT_IMAGES else None
+    yield from _valid_pairs(request_id, stream_excel_mapping_from_structure(
+        gemini_client, excel_markdown, raw_text, table_data, render_key_value_context(structure),
+        images=images, exclude_cells=exclude_cells
+    ))
+
+def map_scan_to_template(request_id, gemini_client, mapping_mode: str, excel_markdown: str, doc_path: str, raw_text_path: str, table_path: str, structure: list[dict], exclude_cells: list[str], pages: list[int] | None = None):
+    """
+    Maps the scan onto the template in the given mapping mode. Returns the form text the mapping is made from
+    (the scan Markdown, or the Textract text and tables in direct mode) and an iterator of the valid (cell_id, value) pairs.
+    With pages set, only those page numbers are sent to Gemini.
+    """
+    if mapping_mode == 'direct':
+        form_text = '\n'.join(read_form_text(raw_text_path, table_path, pages))
+        return form_text, iter_valid_direct_mapping(request_id, gemini_client, excel_markdown, doc_path, raw_text_path, table_path, structure, exclude_cells, pages)
+    print(f"[{request_id}] Starting Gemini enhancement...")
+    scan_markdown = generate_markdown_from_scan(gemini_client, doc_path, raw_text_path, table_path, pages=pages, structure=structure)
+    print(f"[{request_id}] Scan document converted to Markdown successfully.")
+    return scan_markdown, iter_valid_mapping(request_id, gemini_client, excel_markdown, scan_markdown, exclude_cells)
+
+def withhold_unwritable_cells(request_id, pairs, template_flags: dict | None, flagged_cells: dict):
+    """
+    Passes on the (cell_id, value) pairs that can be written. Cells that hold a formula or lie inside a merged
+    range without being its master are collected in flagged_cells as {cell_id: (value, issue)} instead.
+    """
+    for cell_id, value in pairs:
+        issue = cell_issue(template_flags, cell_id) if template_flags is not None else None
+        if issue is not None:
+            print(f"[{request_id}] Withholding mapped cell {cell_id}: it {issue}.")
+            flagged_cells[cell_id] = (value, issue)
+            continue
+        yield cell_id, value
+
+def complete_mapping(request_id, gemini_client, excel_markdown: str, form_text: str, mapping: dict, flagged_cells: dict, template_flags: dict, exclude_cells: list[str]) -> dict:
+    """
+    Checks the mapping against the form locally and, if values were left out or cells withheld, asks Gemini
+    about just those in a small follow-up call. Returns the cells to add. The check is best effort: a failed
+    follow-up keeps the mapping as it is.
+    """
+    report = check_mapping_coverage(request_id, form_text, excel_markdown, mapping, flagged_cells)
+    if not report["missing"] and not report["flagged"]:
+        return {}
+    try:
+        additions = dict(withhold_unwritable_cells(
+            request_id,
+            _valid_pairs(request_id, stream_excel_mapping_followup(
+                gemini_client, excel_markdown, report["missing"], report["flagged"], exclude_cells
+            )),
+            template_flags,
+            {}
+        ))
+    except Exception as e:
+        print(f"[{request_id}] Follow-up mapping failed, keeping the mapping as it is: {getattr(e, 'detail', e)}")
+        return {}
+    print(f"[{request_id}] Follow-up mapping added {len(additions)} cells.")
+    increment_counter("excel_agent_mapping_followup_cells_total", len(additions), description="Cells added by the coverage follow-up")
+    return additions
+
+def extract_document_structure(request_id, doc_path: str) -> tuple[str, str, str, list[dict]]:
+    """
+    Reads the document from its text layer or with Textract. Returns the raw text, table and structure file
+    paths and the parsed structure; the files are removed again if the structure cannot be read.
+    """
+    print(f"[{request_id}] Starting Textract processing for: {doc_path}")
+    paths = extract_text_and_tables(get_textract_client, doc_path)
+    try:
+        structure = read_textract_structure(paths[2])
+    except Exception:
+        cleanup_files(*paths)
+        raise
+    print(f"[{request_id}] Textract processing complete.")
+    return (*paths, structure)
+
+def map_document(request_id, mapping_mode: str, excel_markdown: str, doc_path: str, textract: tuple, profile: dict, resolved: tuple, page_decisions: list[dict], template_flags: dict | None, write_cell=None) -> dict:
+    """
+    The mapping part of the per-document pipeline, shared by /fill-excel-with-scan/ and the batch: takes the
+    cells the template profile resolved, maps the rest with Gemini, re-asks for what the coverage check finds
+    missing and updates the profile. Returns every cell to insert. write_cell(cell_id, value), if given, is
+    called for each cell as soon as it is known, so the mapping can be written while it streams.
+    """
+    raw_text_path, table_path, _, structure = textract
+    data_to_insert, unresolved_cells = resolved
+    data_to_insert = dict(data_to_insert)
+    write_cell = write_cell or (lambda cell_id, value: None)
+    for cell_id, value in data_to_insert.items():
+        write_cell(cell_id, value)
+
+    if unresolved_cells is not None and not unresolved_cells:
+        print(f"[{request_id}] All fields resolved from the template profile, skipping Gemini.")
+        return data_to_insert
+
+    # --- 4./5. Stream the Gemini Mapping --- 
+    # In "markdown" mode the scan is converted to Markdown first, "direct" maps the Textract output in one call
+    print(f"[{request_id}] Generating data mapping using Gemini ({mapping_mode} mode)...")
+    gemini_client = get_gemini_client()
+    mapping = {}
+    flagged_cells = {}
+    form_text, pairs = map_scan_to_template(
+        request_id,
+        gemini_client,
+        mapping_mode,
+        excel_markdown,
+        doc_path,
+        raw_text_path,
+        table_path,
+        structure,
+        list(data_to_insert),
+        kept_pages(page_decisions)
+    )
+    for cell_id, value in withhold_unwritable_cells(request_id, pairs, template_flags, flagged_cells):
+        mapping[cell_id] = value
+        write_cell(cell_id, value)
+    print(f"[{request_id}] Data mapping generated successfully ({len(mapping)} cells).")
+
+    if MAPPING_COVERAGE_CHECK_ENABLED:
+        # --- 5b. Re-ask for Values the Mapping Left Out --- 
+        # Values the template profile resolved count as mapped, only Gemini's gaps are re-asked
+        additions = complete_mapping(
+            request_id, gemini_client, excel_markdown, form_text, {**data_to_insert, **mapping}, flagged_cells, template_flags,
+            list(data_to_insert) + list(mapping)
+        )
+        for cell_id, value in additions.items():
+            write_cell(cell_id, value)
+        mapping.update(additions)
+
+    if TEMPLATE_PROFILES_ENABLED:
+        learn_template_profile(profile, excel_markdown, structure, mapping, resolved=data_to_insert)
+    data_to_insert.update(mapping)
+    return data_to_insert
 
 async def fill_excel_with_scan(
     request_id: uuid.UUID,
@@ -112,66 +319,84 @@ async def fill_excel_with_scan(
     excel_template_path: str, # Path to the .xlsx template
     document_path: str, # Path to the saved PDF/image
     document_original_filename: str, # Needed if scan_to_markdown uses it
-    excel_original_filename: str # For naming output
-) -> Tuple[str, str, str, str, str]: # output_path, excel_path, doc_path, raw_text_path, table_path
+    excel_original_filename: str, # For naming output
+    mapping_mode: str | None = None # "markdown" or "direct", default SCAN_MAPPING_MODE
+) -> Tuple[str, str, str, str, str, str, list]: # output_path, excel_path, doc_path, raw_text_path, table_path, structure_path, page_decisions
     """
     Core logic: Converts both files (from paths), gets mapping, fills template.
-    Returns paths to all temporary files created including the final output.
+    Returns paths to all temporary files created including the final output, and the page filter's
+    decisions ({"page", "decision", "score"} per scan page).
     """
+    mapping_mode = mapping_mode or SCAN_MAPPING_MODE
     excel_path = excel_template_path
     doc_path = document_path
-    raw_text_path = None
-    table_path = None
-    output_path = None
 
-    try:
+    # The template and the document branches are independent: the template is converted and opened
+    # while Textract runs, so only the document branch and the mapping remain on the critical path.
+    dag = StageDAG(request_id, "fill_excel_with_scan")
+
+    def convert_template():
         # --- 1. Convert Excel Template to Markdown --- 
         print(f"[{request_id}] Converting Excel template to Markdown: {excel_path}")
         success, excel_markdown_or_error = convert_excel_to_markdown(excel_path)
         if not success:
             raise RuntimeError(f"Failed to convert Excel template: {excel_markdown_or_error}")
-        excel_markdown = excel_markdown_or_error
         print(f"[{request_id}] Excel template converted to Markdown successfully.")
+        return excel_markdown_or_error
 
-        # --- 2. Convert Scan to Markdown --- 
-        # Requires `convert_scan_to_markdown` to accept a file path instead of UploadFile
-        # We will *assume* this change is made separately or this part will fail.
-        print(f"[{request_id}] Converting Scan document to Markdown: {doc_path}")
-        # Mock UploadFile object if necessary, or ideally refactor convert_scan_to_markdown
-        # Let's assume refactoring of convert_scan_to_markdown to take path and original filename
-        scan_markdown, _, raw_text_path, table_path = await convert_scan_to_markdown(request_id, doc_path, document_original_filename)
-        # We get back paths to temp files created by convert_scan_to_markdown
-        print(f"[{request_id}] Scan document converted to Markdown successfully.")
-
-        # --- 3. Get Gemini Mapping --- 
-        print(f"[{request_id}] Generating data mapping using Gemini...")
-        gemini_client = get_gemini_client()
-        mapping_json_str = generate_excel_mapping_from_markdown(
-            gemini_client,
-            excel_markdown, 
-            scan_markdown
-        )
-        
-        # The function already returns a dictionary, no need for json.loads
-        data_to_insert = mapping_json_str # Rename variable for clarity
-        if not isinstance(data_to_insert, dict):
-            # This check might still be useful if the previous function fails silently
-             raise RuntimeError("Mapping function did not return a valid dictionary object")
+    def open_template():
+        # The workbook is opened before the mapping so streamed cells can be written as they arrive
+        print(f"[{request_id}] Opening Excel template for filling: {excel_path}")
+        try:
+            with stage_timer("fill"):
+                wb, ws, merged_ranges = load_excel_template(excel_path)
+                # Formula cells and merged ranges, read before anything is written
+                template_flags = template_cell_flags(ws, merged_ranges) if MAPPING_COVERAGE_CHECK_ENABLED else None
+                return wb, ws, merged_ranges, template_flags
+        except Exception as e:
+            raise RuntimeError(f"Failed to fill Excel template: {e}")
+
+    def resolve_profile(excel_markdown, profile, textract):
+        # --- 3. Resolve Fields from the Template Profile --- 
+        # Templates that have been mapped often enough are filled from learned anchors,
+        # Gemini is only asked for the fields the profile cannot resolve.
+        return resolve_cells_from_profile(request_id, profile, textract[3])
 
-        print(f"[{request_id}] Data mapping generated successfully.")
+    def map_and_fill(excel_markdown, template, textract, profile, resolved, page_decisions):
+        wb, ws, merged_ranges, template_flags = template
+        return map_document(
+            request_id, mapping_mode, excel_markdown, doc_path, textract, profile, resolved, page_decisions, template_flags,
+            write_cell=lambda cell_id, value: write_template_cell(ws, merged_ranges, cell_id, value)
+        )
 
-        # --- 4. Fill Excel Template --- 
+    def save_template(template, data_to_insert):
+        # --- 6. Save the Filled Template --- 
         output_path = excel_path.replace(".xlsx", "_filled.xlsx")
-        print(f"[{request_id}] Filling Excel template: {excel_path} -> {output_path}")
-        success, error = fill_excel_template(excel_path, output_path, data_to_insert)
-        if not success:
-            raise RuntimeError(f"Failed to fill Excel template: {error}")
+        print(f"[{request_id}] Saving filled Excel template: {excel_path} -> {output_path}")
+        try:
+            with stage_timer("fill"):
+                save_filled_workbook(template[0], output_path)
+        except Exception as e:
+            raise RuntimeError(f"Failed to fill Excel template: {e}")
         print(f"[{request_id}] Excel template filled successfully: {output_path}")
+        return output_path
 
-        # Return all relevant paths for cleanup by the caller (main.py)
-        return output_path, excel_path, doc_path, raw_text_path, table_path
+    dag.add("template_markdown", convert_template)
+    dag.add("open_template", open_template)
+    # The caller never receives the Textract paths on error, so the stage cleans them up itself
+    dag.add("textract", lambda: extract_document_structure(request_id, doc_path), cleanup=lambda textract: cleanup_files(*textract[:3]))
+    dag.add("template_profile", lambda excel_markdown: load_template_profile(template_fingerprint(excel_markdown)), deps=("template_markdown",))
+    dag.add("resolve_profile", resolve_profile, deps=("template_markdown", "template_profile", "textract"))
+    dag.add("page_filter", lambda excel_markdown, textract: select_scan_pages(request_id, excel_markdown, textract[3]), deps=("template_markdown", "textract"))
+    dag.add("mapping", map_and_fill, deps=("template_markdown", "open_template", "textract", "template_profile", "resolve_profile", "page_filter"))
+    dag.add("save", save_template, deps=("open_template", "mapping"), cleanup=cleanup_files)
 
+    try:
+        results = await dag.run()
     except Exception as e:
         print(f"[{request_id}] Error during fill_excel_with_scan processing: {str(e)}")
-        # Let main.py handle cleanup based on which paths are not None
-        raise # Re-raise exception for main.py to catch 
\ No newline at end of file
+        raise # Re-raise exception for main.py to catch
+
+    raw_text_path, table_path, structure_path, _ = results["textract"]
+    # Return all relevant paths for cleanup by the caller (main.py)
+    return results["save"], excel_path, doc_path, raw_text_path, table_path, structure_path, results["page_filter"]
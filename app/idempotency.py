@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import hashlib
+
+from utils.file_utils import get_data_dir, cleanup_files
+
+# Stored results expire after this many seconds, and the oldest are evicted beyond the size cap
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+IDEMPOTENCY_STORE_MAX_BYTES = int(os.getenv('IDEMPOTENCY_STORE_MAX_BYTES', str(512 * 1024 * 1024)))
+
+# Hop-by-hop headers describe one connection, not the response, and are never stored
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer', 'trailers',
+    'transfer-encoding', 'upgrade', 'content-length'
+}
+
+
+def request_fingerprint(method: str, route: str, content_type: str, body: bytes) -> str:
+    """
+    Hashes what makes two requests with the same Idempotency-Key the same request: method, route and body.
+    The multipart boundary is left out, since clients pick a new one for every attempt of the same upload.
+    """
+    digest = hashlib.sha256(f"{method}\n{route}\n".encode('utf-8'))
+    boundary = content_type.partition('boundary=')[2].split(';')[0].strip().strip('"')
+    digest.update(body.replace(boundary.encode('latin-1'), b'') if boundary else body)
+    return digest.hexdigest()
+
+
+def _entry_paths(route: str, key: str) -> tuple[str, str]:
+    name = hashlib.sha256(f"{route}\n{key}".encode('utf-8')).hexdigest()
+    store_dir = get_data_dir('idempotency')
+    return os.path.join(store_dir, f"{name}.json"), os.path.join(store_dir, f"{name}.body")
+
+
+def load_idempotent_response(route: str, key: str) -> dict | None:
+    """Returns the stored response ({fingerprint, status_code, headers, body}) for a route and Idempotency-Key, or None."""
+    meta_path, body_path = _entry_paths(route, key)
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if time.time() - meta["created_at"] > IDEMPOTENCY_TTL_SECONDS:
+            cleanup_files(meta_path, body_path)
+            return None
+        with open(body_path, 'rb') as f:
+            meta["body"] = f.read()
+        return meta
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def store_idempotent_response(route: str, key: str, fingerprint: str, status_code: int, headers: dict, body: bytes) -> None:
+    """
+    Stores a finished response with the fingerprint of the request that produced it.
+    The body is written first, so a metadata file always has a complete body.
+    """
+    meta_path, body_path = _entry_paths(route, key)
+    meta = {
+        "route": route,
+        "fingerprint": fingerprint,
+        "status_code": status_code,
+        "headers": {name: value for name, value in headers.items() if name.lower() not in HOP_BY_HOP_HEADERS},
+        "created_at": time.time(),
+        "size": len(body),
+    }
+    with open(body_path + '.tmp', 'wb') as f:
+        f.write(body)
+    os.replace(body_path + '.tmp', body_path)
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+    purge_idempotency_store()
+
+
+def purge_idempotency_store() -> None:
+    """Deletes expired results, then the oldest ones until the store fits IDEMPOTENCY_STORE_MAX_BYTES."""
+    store_dir = get_data_dir('idempotency')
+    entries = []
+    for name in os.listdir(store_dir):
+        if not name.endswith('.json'):
+            continue
+        meta_path = os.path.join(store_dir, name)
+        body_path = meta_path[:-len('.json')] + '.body'
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            entries.append((meta["created_at"], meta["size"], meta_path, body_path))
+        except (OSError, ValueError, KeyError):
+            cleanup_files(meta_path, body_path)
+
+    entries.sort()
+    total = sum(size for _, size, _, _ in entries)
+    cutoff = time.time() - IDEMPOTENCY_TTL_SECONDS
+    for created_at, size, meta_path, body_path in entries:
+        if created_at >= cutoff and total <= IDEMPOTENCY_STORE_MAX_BYTES:
+            break
+        cleanup_files(meta_path, body_path)
+        total -= size
@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import sqlite3
+import asyncio
+import urllib.request
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from app.fill_excel_with_scan import fill_excel_with_scan
+from utils.file_utils import cleanup_files, get_data_dir, count_document_pages
+from utils.rate_limit_utils import UpstreamBusyError
+
+# Worker pool size, and how many of those workers only ever take jobs from the small lane
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+JOB_SMALL_LANE_WORKERS = int(os.getenv('JOB_SMALL_LANE_WORKERS', '1'))
+# Documents with at most this many pages go to the small lane
+SMALL_JOB_MAX_PAGES = int(os.getenv('SMALL_JOB_MAX_PAGES', '1'))
+# Finished jobs (files and results) are purged after this many seconds
+JOB_RESULT_TTL_SECONDS = int(os.getenv('JOB_RESULT_TTL_SECONDS', str(24 * 3600)))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv('JOB_POLL_INTERVAL_SECONDS', '1.0'))
+# A running job's lease is renewed while it runs; jobs whose lease ran out (their process died) are re-queued
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '60'))
+# Webhook callbacks are only sent to these hosts
+JOB_WEBHOOK_ALLOWED_HOSTS = {
+    host.strip() for host in os.getenv('JOB_WEBHOOK_ALLOWED_HOSTS', 'localhost,127.0.0.1').split(',') if host.strip()
+}
+
+LANE_SMALL = 0
+LANE_LARGE = 1
+LANE_NAMES = {LANE_SMALL: "small", LANE_LARGE: "large"}
+
+# Identifies this process as the owner of the jobs it runs, so other uvicorn workers leave them alone
+_LEASE_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_worker_tasks = []
+_job_available = None  # asyncio.Event, created when the workers start
+_worker_loop_ref = None  # event loop the workers (and _job_available) belong to
+
+
+@contextmanager
+def _connect():
+    conn = sqlite3.connect(os.path.join(get_data_dir('jobs'), 'jobs.db'), timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def init_job_store() -> None:
+    """
+    Creates the job table. Jobs left running by a process that stopped are re-queued once their lease
+    runs out, not here: with several worker processes, the other processes may still be running theirs.
+    """
+    with _connect() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                lane INTEGER NOT NULL,
+                page_count INTEGER,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                template_path TEXT NOT NULL,
+                template_filename TEXT,
+                document_path TEXT NOT NULL,
+                document_filename TEXT,
+                result_path TEXT,
+                error TEXT,
+                webhook_url TEXT,
+                lease_owner TEXT,
+                lease_expires_at REAL
+            )
+        """)
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in (("lease_owner", "TEXT"), ("lease_expires_at", "REAL")):
+            if column not in columns:  # job stores created before leases existed
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, lane, created_at)")
+
+
+def validate_webhook_url(webhook_url: str) -> None:
+    """Raises ValueError unless the URL is an http(s) URL on an allowed (local) host."""
+    parsed = urlparse(webhook_url)
+    if parsed.scheme not in ('http', 'https') or parsed.hostname not in JOB_WEBHOOK_ALLOWED_HOSTS:
+        raise ValueError(f"Webhook URL must be http(s) on one of: {', '.join(sorted(JOB_WEBHOOK_ALLOWED_HOSTS))}")
+
+
+def enqueue_job(
+    template_path: str,
+    document_path: str,
+    template_filename: str,
+    document_filename: str,
+    webhook_url: str | None = None
+) -> dict:
+    """
+    Moves the uploaded files into a durable job directory and queues a fill_excel_with_scan job.
+    Single-page documents (up to SMALL_JOB_MAX_PAGES) are queued in the small lane.
+    """
+    job_id = str(uuid.uuid4())
+    job_dir = get_data_dir('jobs', job_id)
+    stored_template_path = os.path.join(job_dir, f"template{os.path.splitext(template_path)[1]}")
+    stored_document_path = os.path.join(job_dir, f"document{os.path.splitext(document_path)[1]}")
+    shutil.move(template_path, stored_template_path)
+    shutil.move(document_path, stored_document_path)
+
+    page_count = count_document_pages(stored_document_path)
+    lane = LANE_SMALL if page_count is not None and page_count <= SMALL_JOB_MAX_PAGES else LANE_LARGE
+    with _connect() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, status, lane, page_count, created_at, template_path, template_filename, "
+            "document_path, document_filename, webhook_url) VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, lane, page_count, time.time(), stored_template_path, template_filename,
+             stored_document_path, document_filename, webhook_url)
+        )
+    _wake_workers()
+    return get_job(job_id)
+
+
+def _wake_workers() -> None:
+    """Wakes idle workers. Safe to call from any thread: asyncio.Event is only set on the workers' own loop."""
+    if _job_available is not None and _worker_loop_ref is not None and not _worker_loop_ref.is_closed():
+        _worker_loop_ref.call_soon_threadsafe(_job_available.set)
+
+
+def get_job(job_id: str) -> dict | None:
+    """Returns the stored state of a job, or None if it does not exist."""
+    with _connect() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def job_status(job: dict) -> dict:
+    """Public view of a job, without local file paths."""
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "lane": LANE_NAMES[job["lane"]],
+        "page_count": job["page_count"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "error": job["error"],
+    }
+
+
+def _claim_next_job(small_lane_only: bool) -> dict | None:
+    """
+    Atomically marks the next queued job as running under a lease owned by this process and returns it.
+    Running jobs whose lease has run out are re-queued first.
+    """
+    now = time.time()
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, lease_owner = NULL, lease_expires_at = NULL "
+                "WHERE status = 'running' AND (lease_expires_at IS NULL OR lease_expires_at < ?)",
+                (now,)
+            )
+            if small_lane_only:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' AND lane = ? ORDER BY created_at LIMIT 1",
+                    (LANE_SMALL,)
+                ).fetchone()
+            else:
+                # Small-lane jobs go first on every worker, not only on the reserved ones
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' ORDER BY lane = ? DESC, created_at LIMIT 1",
+                    (LANE_SMALL,)
+                ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', started_at = ?, lease_owner = ?, lease_expires_at = ? WHERE id = ?",
+                    (now, _LEASE_OWNER, now + JOB_LEASE_SECONDS, row["id"])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return dict(row) if row else None
+
+
+def _finish_job(job_id: str, status: str, result_path: str | None = None, error: str | None = None) -> dict:
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, finished_at = ?, result_path = ?, error = ?, lease_owner = NULL, lease_expires_at = NULL WHERE id = ?",
+            (status, time.time(), result_path, error, job_id)
+        )
+    return get_job(job_id)
+
+
+def _requeue_job(job_id: str) -> None:
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', started_at = NULL, lease_owner = NULL, lease_expires_at = NULL WHERE id = ?",
+            (job_id,)
+        )
+
+
+def _renew_lease(job_id: str) -> None:
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND status = 'running' AND lease_owner = ?",
+            (time.time() + JOB_LEASE_SECONDS, job_id, _LEASE_OWNER)
+        )
+
+
+def _release_leases() -> None:
+    """Re-queues the jobs this process is running, so another process can pick them up without waiting for the lease."""
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', started_at = NULL, lease_owner = NULL, lease_expires_at = NULL "
+            "WHERE status = 'running' AND lease_owner = ?",
+            (_LEASE_OWNER,)
+        )
+
+
+async def _keep_lease(job_id: str) -> None:
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        await asyncio.to_thread(_renew_lease, job_id)
+
+
+def _run_job(job: dict) -> str:
+    """Runs the scan pipeline for a job on its own event loop (called from a worker thread)."""
+    output_path, _, _, raw_text_path, table_path, structure_path, _ = asyncio.run(fill_excel_with_scan(
+        job["id"],
+        job["template_path"],
+        job["document_path"],
+        job["document_filename"],
+        job["template_filename"]
+    ))
+    cleanup_files(raw_text_path, table_path, structure_path)
+    return output_path
+
+
+def _send_webhook(job: dict) -> None:
+    try:
+        request = urllib.request.Request(
+            job["webhook_url"],
+            data=json.dumps(job_status(job)).encode('utf-8'),
+            headers={"Content-Type": "application/json"},
+            method="POST"
+        )
+        urllib.request.urlopen(request, timeout=10).close()
+    except Exception as e:
+        print(f"[{job['id']}] Webhook callback to {job['webhook_url']} failed: {e}")
+
+
+def purge_expired_jobs() -> None:
+    """Deletes finished jobs (and their files) older than JOB_RESULT_TTL_SECONDS."""
+    cutoff = time.time() - JOB_RESULT_TTL_SECONDS
+    with _connect() as conn:
+        expired = [row["id"] for row in conn.execute(
+            "SELECT id FROM jobs WHERE status IN ('succeeded', 'failed') AND finished_at < ?", (cutoff,)
+        )]
+        for job_id in expired:
+            shutil.rmtree(get_data_dir('jobs', job_id), ignore_errors=True)
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+
+async def _worker_loop(worker_name: str, small_lane_only: bool) -> None:
+    print(f"Job worker {worker_name} started (small lane only: {small_lane_only}).")
+    while True:
+        job = await asyncio.to_thread(_claim_next_job, small_lane_only)
+        if job is None:
+            _job_available.clear()
+            try:
+                await asyncio.wait_for(_job_available.wait(), timeout=JOB_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                await asyncio.to_thread(purge_expired_jobs)
+            continue
+
+        print(f"[{job['id']}] Worker {worker_name} running job ({LANE_NAMES[job['lane']]} lane).")
+        lease = asyncio.create_task(_keep_lease(job["id"]))
+        try:
+            # The pipeline makes blocking SDK calls, so it runs in a thread to keep the API responsive
+            try:
+                result_path = await asyncio.to_thread(_run_job, job)
+            finally:
+                lease.cancel()
+            finished = await asyncio.to_thread(_finish_job, job["id"], "succeeded", result_path)
+            print(f"[{job['id']}] Job succeeded.")
+        except UpstreamBusyError as e:
+            # Quota exhausted: put the job back instead of failing it, and give the upstream time to recover
+            await asyncio.to_thread(_requeue_job, job["id"])
+            print(f"[{job['id']}] {e.detail}, job re-queued.")
+            await asyncio.sleep(e.retry_after)
+            continue
+        except Exception as e:
+            detail = getattr(e, 'detail', None) or str(e)
+            finished = await asyncio.to_thread(_finish_job, job["id"], "failed", None, detail)
+            print(f"[{job['id']}] Job failed: {detail}")
+        if finished.get("webhook_url"):
+            await asyncio.to_thread(_send_webhook, finished)
+
+
+async def start_job_workers() -> None:
+    """Initializes the job store and starts the worker pool on the running event loop."""
+    global _job_available, _worker_loop_ref
+    if _worker_tasks:
+        return
+    await asyncio.to_thread(init_job_store)
+    if JOB_WORKERS <= 0:
+        return
+    _job_available = asyncio.Event()
+    _worker_loop_ref = asyncio.get_running_loop()
+    # At least one worker always serves both lanes, so large jobs cannot starve
+    small_lane_workers = min(JOB_SMALL_LANE_WORKERS, JOB_WORKERS - 1)
+    for i in range(JOB_WORKERS):
+        _worker_tasks.append(asyncio.create_task(_worker_loop(f"worker-{i + 1}", i < small_lane_workers)))
+
+
+async def stop_job_workers() -> None:
+    """Cancels the worker pool and re-queues the jobs it was running."""
+    for task in _worker_tasks:
+        task.cancel()
+    await asyncio.gather(*_worker_tasks, return_exceptions=True)
+    if _worker_tasks:
+        await asyncio.to_thread(_release_leases)
+    _worker_tasks.clear()
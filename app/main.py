@@ -1,19 +1,80 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, PlainTextResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks, Request
+from fastapi.responses import FileResponse, PlainTextResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import json
 import uuid
+import asyncio
 import os
+import time
+import shutil
+import tempfile
+from dotenv import load_dotenv
+
+# Load .env once, before the modules below read their configuration from the environment
+load_dotenv()
 
 # Import core logic functions
 from app.excel_to_markdown import convert_excel_to_markdown 
+from app.excel_to_json import convert_excel_to_json, get_cached_excel_json, cache_excel_json
 from app.scan_to_markdown import convert_scan_to_markdown
+from app.query_document import query_document, normalize_questions
 from app.fill_excel_with_json import fill_excel_template
-from app.fill_excel_with_scan import fill_excel_with_scan
+from app.fill_excel_with_scan import fill_excel_with_scan, MAPPING_MODES, SCAN_MAPPING_MODE
+from app.warmup import warm_up
+from app.batch import BATCH_MAX_DOCUMENTS, prepare_batch_template, stream_batch_zip
+from app.idempotency import load_idempotent_response, store_idempotent_response, request_fingerprint
+from app.jobs import (
+    start_job_workers, stop_job_workers, enqueue_job, get_job, job_status, validate_webhook_url
+)
 
 # Import utility functions
-from utils.file_utils import save_upload_file_tmp, cleanup_files, convert_xls_to_xlsx
+from utils.rate_limit_utils import check_admission
+from utils.single_flight_utils import SingleFlight, coalescing_key
+from utils.file_utils import ingest_upload_file, cleanup_files, convert_xls_to_xlsx
 from utils.gemini_utils import generate_excel_mapping_from_markdown, get_gemini_client
+from utils.gemini_cache_utils import clear_context_caches
+from utils.page_filter_utils import format_page_decisions
+from utils.deadline_utils import start_request_deadline, reset_request_deadline
+from utils.metrics_utils import (
+    start_request_timings, reset_request_timings, observe_histogram,
+    format_server_timing, render_prometheus_metrics, monitor_event_loop_lag
+)
+
+# Pre-create the SDK clients and load prompts before serving, so the first requests do not pay for it
+WARMUP_ON_STARTUP = os.getenv('WARMUP_ON_STARTUP', 'false').lower() in ('1', 'true', 'yes')
+# How often the event-loop lag monitor wakes up (0 disables it)
+EVENT_LOOP_LAG_INTERVAL_SECONDS = float(os.getenv('EVENT_LOOP_LAG_INTERVAL_SECONDS', '0.1'))
+_lag_monitor_task = None
+
+# Identical scan requests (same content hashes and parameters) in flight at the same time share one pipeline run
+scan_to_markdown_flight = SingleFlight("/scan-to-markdown/")
+fill_excel_with_scan_flight = SingleFlight("/fill-excel-with-scan/")
+# A retry that arrives while the first attempt with the same Idempotency-Key is still running waits for it,
+# also when the first client has timed out and disconnected (the attempt runs on as the flight's own task)
+idempotency_flight = SingleFlight("idempotency")
+_idempotency_in_flight = {}  # flight key -> fingerprint of the request being run
+# Streamed responses are not buffered for storage, so these routes ignore the Idempotency-Key header
+IDEMPOTENCY_EXCLUDED_ROUTES = {"/batch/fill-excel-with-scan/"}
+
+# Upload limits. Documents for background jobs may have more pages than those processed inline.
+MAX_TEMPLATE_BYTES = int(os.getenv('MAX_TEMPLATE_BYTES', str(10 * 1024 * 1024)))
+MAX_DOCUMENT_BYTES = int(os.getenv('MAX_DOCUMENT_BYTES', str(25 * 1024 * 1024)))
+MAX_DOCUMENT_PAGES = int(os.getenv('MAX_DOCUMENT_PAGES', '20'))
+MAX_JOB_DOCUMENT_PAGES = int(os.getenv('MAX_JOB_DOCUMENT_PAGES', '200'))
+# Allowance for multipart headers and form fields such as data_json
+FORM_OVERHEAD_BYTES = 1024 * 1024
+
+# Largest accepted request body per route, checked against Content-Length before the body is read
+MAX_REQUEST_BYTES = {
+    "/scan-to-markdown/": MAX_DOCUMENT_BYTES + FORM_OVERHEAD_BYTES,
+    "/query-document/": MAX_DOCUMENT_BYTES + FORM_OVERHEAD_BYTES,
+    "/excel-to-markdown/": MAX_TEMPLATE_BYTES + FORM_OVERHEAD_BYTES,
+    "/excel-to-json/": MAX_TEMPLATE_BYTES + FORM_OVERHEAD_BYTES,
+    "/fill-excel-with-json/": MAX_TEMPLATE_BYTES + FORM_OVERHEAD_BYTES,
+    "/fill-excel-with-scan/": MAX_TEMPLATE_BYTES + MAX_DOCUMENT_BYTES + FORM_OVERHEAD_BYTES,
+    "/jobs/fill-excel-with-scan/": MAX_TEMPLATE_BYTES + MAX_DOCUMENT_BYTES + FORM_OVERHEAD_BYTES,
+    "/batch/fill-excel-with-scan/": MAX_TEMPLATE_BYTES + BATCH_MAX_DOCUMENTS * MAX_DOCUMENT_BYTES + FORM_OVERHEAD_BYTES,
+}
 
 
 # --- FastAPI App Setup ---
@@ -28,8 +89,119 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "Idempotent-Replayed", "ETag", "X-Page-Filter"],
 )
 
+@app.on_event("startup")
+async def startup():
+    global _lag_monitor_task
+    if WARMUP_ON_STARTUP:
+        timings = await asyncio.to_thread(warm_up)
+        print("Warm-up complete: " + ", ".join(f"{step} {seconds * 1000:.0f}ms" for step, seconds in timings.items()))
+    if EVENT_LOOP_LAG_INTERVAL_SECONDS > 0:
+        _lag_monitor_task = asyncio.create_task(monitor_event_loop_lag(EVENT_LOOP_LAG_INTERVAL_SECONDS))
+    await start_job_workers()
+
+@app.on_event("shutdown")
+async def shutdown():
+    if _lag_monitor_task is not None:
+        _lag_monitor_task.cancel()
+    await stop_job_workers()
+    # Provider-side caches are billed until their TTL runs out
+    await asyncio.to_thread(clear_context_caches)
+
+@app.middleware("http")
+async def replay_idempotent_requests(request: Request, call_next):
+    """
+    POST requests with an Idempotency-Key header run once per route and key: successful responses are
+    stored and replayed to retries, and a retry that arrives during the first attempt waits for its result.
+    A key reused for a different request (another method, route or body) is answered with 422.
+    """
+    key = request.headers.get("idempotency-key")
+    if request.method != "POST" or not key or request.url.path in IDEMPOTENCY_EXCLUDED_ROUTES:
+        return await call_next(request)
+    if len(key) > 255:
+        return JSONResponse(status_code=400, content={"detail": "Idempotency-Key must be at most 255 characters"})
+    route = request.url.path
+    # The body is read here and handed on to the route; the size limit has already been checked
+    fingerprint = request_fingerprint(request.method, route, request.headers.get("content-type", ""), await request.body())
+    key_reused = JSONResponse(status_code=422, content={"detail": "Idempotency-Key was already used for a different request"})
+
+    stored = await asyncio.to_thread(load_idempotent_response, route, key)
+    if stored is not None:
+        if stored.get("fingerprint") != fingerprint:
+            return key_reused
+        print(f"Replaying stored response for Idempotency-Key {key} on {route}")
+        return Response(content=stored["body"], status_code=stored["status_code"], headers={**stored["headers"], "Idempotent-Replayed": "true"})
+
+    flight_key = coalescing_key(route, key)
+    if _idempotency_in_flight.get(flight_key, fingerprint) != fingerprint:
+        return key_reused
+
+    async def execute():
+        _idempotency_in_flight[flight_key] = fingerprint
+        try:
+            response = await call_next(request)
+            body = b"".join([chunk async for chunk in response.body_iterator])
+            headers = {name: value for name, value in response.headers.items() if name != "content-length"}
+            if 200 <= response.status_code < 300:
+                await asyncio.to_thread(store_idempotent_response, route, key, fingerprint, response.status_code, headers, body)
+            return response.status_code, headers, body
+        finally:
+            del _idempotency_in_flight[flight_key]
+
+    status_code, headers, body = await idempotency_flight.run(flight_key, execute)
+    return Response(content=body, status_code=status_code, headers=headers)
+
+# Routes that run the pipeline inline get an end-to-end deadline, split across their upstream stages
+REQUEST_DEADLINE_ROUTES = {"/scan-to-markdown/", "/query-document/", "/fill-excel-with-scan/"}
+
+@app.middleware("http")
+async def apply_request_deadline(request: Request, call_next):
+    """Starts the request deadline; stages that overrun their share of it are cancelled with 504."""
+    if request.url.path not in REQUEST_DEADLINE_ROUTES:
+        return await call_next(request)
+    token = start_request_deadline()
+    try:
+        return await call_next(request)
+    finally:
+        reset_request_deadline(token)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Times every request, records it per route and reports the stage breakdown in a Server-Timing header."""
+    timings, token = start_request_timings()
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        reset_request_timings(token)
+    elapsed = time.perf_counter() - start
+    route = request.scope.get("route")
+    observe_histogram(
+        "excel_agent_request_duration_seconds", elapsed,
+        description="HTTP request duration in seconds",
+        route=route.path if route else "unmatched", status=str(response.status_code)
+    )
+    response.headers["Server-Timing"] = format_server_timing(timings, elapsed)
+    return response
+
+def _share_filled_output(result: tuple) -> tuple:
+    """Gives a coalesced request its own copy of the filled file; the Textract temp files stay with the first request."""
+    with tempfile.NamedTemporaryFile(delete=False, suffix="_filled.xlsx") as tmp_file:
+        copy_path = tmp_file.name
+    shutil.copyfile(result[0], copy_path)
+    return copy_path, None, None, None, None, None, result[6]
+
+@app.middleware("http")
+async def reject_oversized_requests(request: Request, call_next):
+    """Answers 413 from the Content-Length header alone, before an oversized upload is received and spooled."""
+    limit = MAX_REQUEST_BYTES.get(request.url.path)
+    content_length = request.headers.get("content-length")
+    if limit is not None and content_length and content_length.isdigit() and int(content_length) > limit:
+        return JSONResponse(status_code=413, content={"detail": f"Request body exceeds the limit of {limit // (1024 * 1024)} MB"})
+    return await call_next(request)
+
 # --- API Endpoints ---
 
 @app.post("/scan-to-markdown/", 
@@ -55,24 +227,86 @@ async def scan_to_markdown_route(
             detail=f"Invalid file type. Allowed types: {', '.join(allowed_extensions)}"
         )
 
+    doc_path = raw_text_path = table_path = structure_path = None
     try:
-        markdown_content, doc_path, raw_text_path, table_path = await convert_scan_to_markdown(request_id, document)
+        # Fail fast with 429 before accepting the upload when the Gemini quota is already saturated; the Textract
+        # quota is checked once the document turns out to need Textract (digital PDFs are read from their text layer)
+        check_admission("gemini")
+        doc_path, document_hash = await ingest_upload_file(
+            document, suffix=file_ext, max_bytes=MAX_DOCUMENT_BYTES, max_pages=MAX_DOCUMENT_PAGES
+        )
+        print(f"[{request_id}] Document saved to: {doc_path} (sha256 {document_hash[:12]})")
+        # The pipeline blocks on Textract and Gemini, so it runs in a worker thread on its own event loop
+        markdown_content, _, raw_text_path, table_path, structure_path, page_decisions = await scan_to_markdown_flight.run(
+            coalescing_key(document_hash, file_ext),
+            lambda: asyncio.to_thread(asyncio.run, convert_scan_to_markdown(request_id, doc_path, document.filename)),
+            share=lambda result: (result[0], None, None, None, None, result[5])
+        )
         
         # Schedule cleanup for all temporary files
-        print(f"[{request_id}] Scheduling cleanup for: {doc_path}, {raw_text_path}, {table_path}")
-        background_tasks.add_task(cleanup_files, doc_path, raw_text_path, table_path)
+        print(f"[{request_id}] Scheduling cleanup for: {doc_path}, {raw_text_path}, {table_path}, {structure_path}")
+        background_tasks.add_task(cleanup_files, doc_path, raw_text_path, table_path, structure_path)
         
         # Return the markdown content
         print(f"[{request_id}] Returning Markdown content.")
-        return PlainTextResponse(content=markdown_content, media_type="text/markdown")
+        return PlainTextResponse(
+            content=markdown_content, media_type="text/markdown",
+            headers={"X-Page-Filter": format_page_decisions(page_decisions)}
+        )
+
+    except HTTPException as http_exc:
+        cleanup_files(doc_path, raw_text_path, table_path, structure_path)
+        raise http_exc
+    except Exception as e:
+        print(f"[{request_id}] An unexpected server error occurred: {str(e)}")
+        cleanup_files(doc_path, raw_text_path, table_path, structure_path)
+        raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
+
+
+@app.post("/query-document/",
+          summary="Answers questions about a scanned document with Textract queries",
+          response_description="The answers to every question, with their confidences and page numbers")
+async def query_document_route(
+    document: UploadFile = File(..., description="Scanned document in PDF, PNG, or JPG format"),
+    questions: list[str] = Form(..., description="Questions to ask, e.g. \"What is the job number?\"; repeat the field for more")
+):
+    """
+    Asks AWS Textract the questions about every page of the document, without Gemini. For targeted fields
+    this is much faster than the Markdown and mapping pipeline. Questions are packed into as few Textract
+    calls as its per-call query limit allows, pages run concurrently, and answers are cached per page
+    content and question, so repeated questions about the same scan do not call Textract again.
+    """
+    request_id = uuid.uuid4()
+    print(f"[{request_id}] Received request for /query-document/ with {len(questions)} questions")
+
+    allowed_extensions = {'.pdf', '.png', '.jpg', '.jpeg'}
+    file_ext = os.path.splitext(document.filename)[1].lower()
+    if file_ext not in allowed_extensions:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type. Allowed types: {', '.join(allowed_extensions)}"
+        )
+
+    doc_path = None
+    try:
+        # Starlette has already spooled the multipart body, but bad questions still skip ingesting and rasterizing it
+        questions = normalize_questions(questions)
+        check_admission("textract")
+        doc_path, document_hash = await ingest_upload_file(
+            document, suffix=file_ext, max_bytes=MAX_DOCUMENT_BYTES, max_pages=MAX_DOCUMENT_PAGES
+        )
+        print(f"[{request_id}] Document saved to: {doc_path} (sha256 {document_hash[:12]})")
+        # Rasterization and the Textract calls block, so they run in a worker thread
+        result = await asyncio.to_thread(query_document, request_id, doc_path, questions)
+        return JSONResponse(content={**result, "filename": document.filename})
 
     except HTTPException as http_exc:
-        cleanup_files(doc_path, raw_text_path, table_path)
         raise http_exc
     except Exception as e:
         print(f"[{request_id}] An unexpected server error occurred: {str(e)}")
-        cleanup_files(doc_path, raw_text_path, table_path)
         raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
+    finally:
+        cleanup_files(doc_path)
     
 
 @app.post("/excel-to-markdown/",
@@ -97,14 +331,14 @@ async def excel_to_markdown_route(
         # Save uploaded Excel file
         file_ext = os.path.splitext(excel_file.filename)[1].lower()
         print(f"[{request_id}] Saving uploaded Excel file: {excel_file.filename}")
-        original_excel_path = await save_upload_file_tmp(excel_file, suffix=file_ext)
+        original_excel_path, template_hash = await ingest_upload_file(excel_file, suffix=file_ext, max_bytes=MAX_TEMPLATE_BYTES)
         files_to_cleanup.append(original_excel_path)
         print(f"[{request_id}] Original Excel file saved to: {original_excel_path}")
 
         # Convert .xls to .xlsx if necessary
         if file_ext == '.xls':
             print(f"[{request_id}] .xls file detected. Converting to .xlsx...")
-            processed_excel_path = convert_xls_to_xlsx(original_excel_path)
+            processed_excel_path = await asyncio.to_thread(convert_xls_to_xlsx, original_excel_path)
             files_to_cleanup.append(processed_excel_path) # Add converted file for cleanup
             print(f"[{request_id}] Converted .xlsx file path: {processed_excel_path}")
         elif file_ext == '.xlsx':
@@ -139,6 +373,67 @@ async def excel_to_markdown_route(
         raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
 
 
+@app.post("/excel-to-json/",
+          summary="Converts an Excel file to a JSON cell map with typed values",
+          response_description="Cells, number formats, merged ranges and formulas of every sheet")
+async def excel_to_json_route(
+    request: Request,
+    excel_file: UploadFile = File(..., description="Excel file (.xlsx or .xls) to convert")
+):
+    """
+    Receives an Excel file (.xlsx or .xls) and returns its cells as structured JSON, the machine-readable
+    counterpart of /excel-to-markdown/. The ETag is the content hash of the upload: a request with a
+    matching If-None-Match gets 304 Not Modified, and unchanged workbooks are served from a cache.
+    """
+    request_id = uuid.uuid4()
+    print(f"[{request_id}] Received request for /excel-to-json/")
+    files_to_cleanup = []
+
+    try:
+        file_ext = os.path.splitext(excel_file.filename)[1].lower()
+        if file_ext not in ('.xlsx', '.xls'):
+            print(f"[{request_id}] Error: Invalid Excel file format {file_ext}")
+            raise HTTPException(status_code=400, detail="Invalid file format. Only .xlsx and .xls are supported.")
+
+        print(f"[{request_id}] Saving uploaded Excel file: {excel_file.filename}")
+        original_excel_path, template_hash = await ingest_upload_file(excel_file, suffix=file_ext, max_bytes=MAX_TEMPLATE_BYTES)
+        files_to_cleanup.append(original_excel_path)
+        etag = f'"sha256-{template_hash}"'
+
+        if_none_match = request.headers.get("if-none-match", "")
+        if etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+            print(f"[{request_id}] Workbook unchanged (ETag {etag}), returning 304.")
+            return Response(status_code=304, headers={"ETag": etag})
+
+        result = get_cached_excel_json(template_hash)
+        if result is not None:
+            print(f"[{request_id}] Returning cached JSON for ETag {etag}.")
+        else:
+            processed_excel_path = original_excel_path
+            if file_ext == '.xls':
+                print(f"[{request_id}] .xls file detected. Converting to .xlsx...")
+                processed_excel_path = await asyncio.to_thread(convert_xls_to_xlsx, original_excel_path)
+                files_to_cleanup.append(processed_excel_path)
+
+            print(f"[{request_id}] Calling convert_excel_to_json for: {processed_excel_path}")
+            success, result = await asyncio.to_thread(convert_excel_to_json, processed_excel_path)
+            if not success:
+                print(f"[{request_id}] Error converting Excel to JSON: {result}")
+                raise HTTPException(status_code=500, detail=f"Failed to convert Excel to JSON: {result}")
+            cache_excel_json(template_hash, result)
+            print(f"[{request_id}] Excel converted to JSON successfully.")
+
+        return JSONResponse(content={**result, "filename": excel_file.filename}, headers={"ETag": etag})
+
+    except HTTPException as http_exc:
+        raise http_exc
+    except Exception as e:
+        print(f"[{request_id}] An unexpected server error occurred: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
+    finally:
+        cleanup_files(*files_to_cleanup)
+
+
 @app.post("/fill-excel-with-json/",
           summary="Fills an Excel template using provided JSON data",
           response_description="The filled Excel file")
@@ -172,7 +467,7 @@ async def fill_excel_with_json_route(
         # Save uploaded Excel template
         file_ext = os.path.splitext(excel_template.filename)[1].lower()
         print(f"[{request_id}] Saving uploaded template: {excel_template.filename}")
-        original_template_path = await save_upload_file_tmp(excel_template, suffix=file_ext)
+        original_template_path, template_hash = await ingest_upload_file(excel_template, suffix=file_ext, max_bytes=MAX_TEMPLATE_BYTES)
         files_to_cleanup.append(original_template_path)
         print(f"[{request_id}] Original template saved to: {original_template_path}")
 
@@ -229,12 +524,14 @@ async def fill_excel_with_json_route(
 async def fill_excel_with_scan_route(
     background_tasks: BackgroundTasks,
     excel_template: UploadFile = File(..., description="Excel template file (.xlsx or .xls)"),
-    document: UploadFile = File(..., description="Scanned document in PDF, PNG, or JPG format containing data")
+    document: UploadFile = File(..., description="Scanned document in PDF, PNG, or JPG format containing data"),
+    mapping_mode: str | None = Form(None, description='"markdown" (scan Markdown, then mapping) or "direct" (one Gemini call from the Textract output); default SCAN_MAPPING_MODE')
 ):
     """
     Receives an Excel template (.xlsx or .xls) and a scanned document. Converts template if needed,
     converts scan to Markdown, uses Gemini to map data, fills the template, 
     and returns the resulting Excel file.
+    With mapping_mode "direct" the Markdown step is skipped and the Textract output is mapped in a single call.
     """
     request_id = uuid.uuid4()
     print(f"[{request_id}] Received request for /fill-excel-with-scan/")
@@ -248,7 +545,14 @@ async def fill_excel_with_scan_route(
     files_to_cleanup = []
 
     try:
-        # --- 1. Validate and Save Document --- 
+        # Fail fast with 429 before accepting the upload when the Gemini quota is already saturated; the Textract
+        # quota is checked once the document turns out to need Textract (digital PDFs are read from their text layer)
+        check_admission("gemini")
+        mapping_mode = (mapping_mode or SCAN_MAPPING_MODE).lower()
+        if mapping_mode not in MAPPING_MODES:
+            raise HTTPException(status_code=400, detail=f"Invalid mapping_mode '{mapping_mode}'. Allowed: {', '.join(MAPPING_MODES)}")
+
+        # --- 1. Validate the Uploads --- 
         allowed_doc_extensions = {'.pdf', '.png', '.jpg', '.jpeg'}
         doc_ext = os.path.splitext(document.filename)[1].lower()
         if doc_ext not in allowed_doc_extensions:
@@ -256,42 +560,63 @@ async def fill_excel_with_scan_route(
                 status_code=400,
                 detail=f"Invalid document file type '{doc_ext}'. Allowed types: {', '.join(allowed_doc_extensions)}"
             )
-        print(f"[{request_id}] Saving uploaded document: {document.filename}")
-        doc_path = await save_upload_file_tmp(document, suffix=doc_ext)
-        files_to_cleanup.append(doc_path)
-        print(f"[{request_id}] Document saved to: {doc_path}")
-
-        # --- 2. Validate, Save, and Convert Excel Template --- 
         excel_ext = os.path.splitext(excel_template.filename)[1].lower()
-        print(f"[{request_id}] Saving uploaded Excel template: {excel_template.filename}")
-        original_template_path = await save_upload_file_tmp(excel_template, suffix=excel_ext)
-        files_to_cleanup.append(original_template_path)
-        print(f"[{request_id}] Original template saved to: {original_template_path}")
+        if excel_ext not in ('.xls', '.xlsx'):
+            raise HTTPException(status_code=400, detail=f"Invalid template file format '{excel_ext}'. Only .xlsx and .xls are supported.")
 
-        if excel_ext == '.xls':
+        async def save_document():
+            print(f"[{request_id}] Saving uploaded document: {document.filename}")
+            doc_path, document_hash = await ingest_upload_file(
+                document, suffix=doc_ext, max_bytes=MAX_DOCUMENT_BYTES, max_pages=MAX_DOCUMENT_PAGES
+            )
+            files_to_cleanup.append(doc_path)
+            print(f"[{request_id}] Document saved to: {doc_path} (sha256 {document_hash[:12]})")
+            return doc_path, document_hash
+
+        async def save_template():
+            print(f"[{request_id}] Saving uploaded Excel template: {excel_template.filename}")
+            original_template_path, template_hash = await ingest_upload_file(excel_template, suffix=excel_ext, max_bytes=MAX_TEMPLATE_BYTES)
+            files_to_cleanup.append(original_template_path)
+            print(f"[{request_id}] Original template saved to: {original_template_path}")
+            if excel_ext == '.xlsx':
+                return original_template_path, template_hash
             print(f"[{request_id}] .xls template detected. Converting to .xlsx...")
-            processed_template_path = convert_xls_to_xlsx(original_template_path)
-            files_to_cleanup.append(processed_template_path) 
+            processed_template_path = await asyncio.to_thread(convert_xls_to_xlsx, original_template_path)
+            files_to_cleanup.append(processed_template_path)
             print(f"[{request_id}] Converted .xlsx template path: {processed_template_path}")
-        elif excel_ext == '.xlsx':
-            processed_template_path = original_template_path
-        else:
-            raise HTTPException(status_code=400, detail=f"Invalid template file format '{excel_ext}'. Only .xlsx and .xls are supported.")
+            return processed_template_path, template_hash
+
+        # --- 2. Save the Document and Save/Convert the Template Concurrently --- 
+        # Both branches run to completion even if one fails, so every file they saved is in files_to_cleanup
+        document_result, template_result = await asyncio.gather(save_document(), save_template(), return_exceptions=True)
+        for result in (document_result, template_result):
+            if isinstance(result, BaseException):
+                raise result
+        doc_path, document_hash = document_result
+        processed_template_path, template_hash = template_result
 
         # --- 3. Call the core logic function (with paths) --- 
         # Assumption: fill_excel_with_scan now takes paths and returns all created file paths
         print(f"[{request_id}] Calling core fill_excel_with_scan logic...")
-        output_path, _, _, raw_text_path_from_func, table_path_from_func = await fill_excel_with_scan(
-            request_id,
-            processed_template_path, # Path to .xlsx
-            doc_path, # Path to saved document
-            document.filename, # Original document filename
-            excel_template.filename # Original excel filename
+        # Concurrent duplicates attach to the in-flight run. The pipeline blocks on Textract and Gemini,
+        # so it runs in a worker thread on its own event loop.
+        output_path, _, _, raw_text_path_from_func, table_path_from_func, structure_path_from_func, page_decisions = await fill_excel_with_scan_flight.run(
+            coalescing_key(document_hash, template_hash, doc_ext, excel_ext, mapping_mode),
+            lambda: asyncio.to_thread(asyncio.run, fill_excel_with_scan(
+                request_id,
+                processed_template_path, # Path to .xlsx
+                doc_path, # Path to saved document
+                document.filename, # Original document filename
+                excel_template.filename, # Original excel filename
+                mapping_mode
+            )),
+            share=_share_filled_output
         )
         # Add paths returned by the function to cleanup list if they exist
         if output_path: files_to_cleanup.append(output_path)
         if raw_text_path_from_func: files_to_cleanup.append(raw_text_path_from_func)
         if table_path_from_func: files_to_cleanup.append(table_path_from_func)
+        if structure_path_from_func: files_to_cleanup.append(structure_path_from_func)
         # Note: excel_path and doc_path are already in files_to_cleanup
 
         print(f"[{request_id}] Core logic completed. Output path: {output_path}")
@@ -306,7 +631,9 @@ async def fill_excel_with_scan_route(
         return FileResponse(
             output_path,
             filename=output_filename,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            # Which scan pages were sent to Gemini, and why the others were not
+            headers={"X-Page-Filter": format_page_decisions(page_decisions)}
         )
 
     except HTTPException as http_exc:
@@ -320,6 +647,174 @@ async def fill_excel_with_scan_route(
         cleanup_files(*files_to_cleanup)
         raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
 
+@app.post("/batch/fill-excel-with-scan/",
+          summary="Fills one Excel template from each of many scanned documents",
+          response_description="Zip archive with the filled Excel files and a manifest.json")
+async def batch_fill_excel_with_scan_route(
+    excel_template: UploadFile = File(..., description="Excel template file (.xlsx or .xls)"),
+    documents: list[UploadFile] = File(..., description="Scanned documents in PDF, PNG, or JPG format")
+):
+    """
+    Converts the template once and runs the documents through Textract, Gemini and the fill as a pipeline.
+    The zip is streamed while documents finish; manifest.json at the end lists the status of every document.
+    Documents that fail or are rejected do not fail the batch, they are reported in the manifest.
+    """
+    request_id = uuid.uuid4()
+    print(f"[{request_id}] Received request for /batch/fill-excel-with-scan/ with {len(documents)} documents")
+    files_to_cleanup = []
+
+    try:
+        if len(documents) > BATCH_MAX_DOCUMENTS:
+            raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_DOCUMENTS} documents per batch")
+        check_admission("gemini")
+
+        # --- 1. Validate, Save, and Convert Excel Template --- 
+        excel_ext = os.path.splitext(excel_template.filename)[1].lower()
+        if excel_ext not in ('.xls', '.xlsx'):
+            raise HTTPException(status_code=400, detail=f"Invalid template file format '{excel_ext}'. Only .xlsx and .xls are supported.")
+        original_template_path, _ = await ingest_upload_file(excel_template, suffix=excel_ext, max_bytes=MAX_TEMPLATE_BYTES)
+        files_to_cleanup.append(original_template_path)
+        if excel_ext == '.xls':
+            processed_template_path = await asyncio.to_thread(convert_xls_to_xlsx, original_template_path)
+            files_to_cleanup.append(processed_template_path)
+        else:
+            processed_template_path = original_template_path
+        excel_markdown, profile, template_flags = await asyncio.to_thread(prepare_batch_template, request_id, processed_template_path)
+
+        # --- 2. Save Documents (rejected uploads are reported in the manifest) --- 
+        allowed_doc_extensions = {'.pdf', '.png', '.jpg', '.jpeg'}
+        batch_documents = []
+        for document in documents:
+            doc_ext = os.path.splitext(document.filename or '')[1].lower()
+            if doc_ext not in allowed_doc_extensions:
+                batch_documents.append({"filename": document.filename, "error": f"Invalid document file type '{doc_ext}'"})
+                continue
+            try:
+                doc_path, _ = await ingest_upload_file(document, suffix=doc_ext, max_bytes=MAX_DOCUMENT_BYTES, max_pages=MAX_DOCUMENT_PAGES)
+            except HTTPException as e:
+                batch_documents.append({"filename": document.filename, "error": e.detail})
+                continue
+            files_to_cleanup.append(doc_path)
+            batch_documents.append({"filename": document.filename, "path": doc_path})
+
+        # --- 3. Stream the Results (the generator owns and cleans up the files from here on) --- 
+        output_filename = os.path.splitext(excel_template.filename)[0] + "_batch.zip"
+        return StreamingResponse(
+            stream_batch_zip(request_id, processed_template_path, excel_markdown, profile, template_flags, batch_documents, files_to_cleanup),
+            media_type="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="{output_filename}"'}
+        )
+
+    except HTTPException as http_exc:
+        cleanup_files(*files_to_cleanup)
+        raise http_exc
+    except Exception as e:
+        print(f"[{request_id}] An unexpected server error occurred: {str(e)}")
+        cleanup_files(*files_to_cleanup)
+        raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
+
+
+@app.post("/jobs/fill-excel-with-scan/",
+          status_code=202,
+          summary="Queues a fill-excel-with-scan job and returns its job ID immediately",
+          response_description="The queued job")
+async def create_fill_excel_with_scan_job(
+    excel_template: UploadFile = File(..., description="Excel template file (.xlsx or .xls)"),
+    document: UploadFile = File(..., description="Scanned document in PDF, PNG, or JPG format containing data"),
+    webhook_url: str | None = Form(None, description="Optional local URL that receives a POST with the job status when it finishes")
+):
+    """
+    Same pipeline as /fill-excel-with-scan/, run by the background worker pool.
+    Poll GET /jobs/{job_id} for the status and download the filled file from GET /jobs/{job_id}/result.
+    """
+    request_id = uuid.uuid4()
+    print(f"[{request_id}] Received request for /jobs/fill-excel-with-scan/")
+    files_to_cleanup = []
+
+    try:
+        if webhook_url:
+            try:
+                validate_webhook_url(webhook_url)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+        # --- 1. Validate and Save Document --- 
+        allowed_doc_extensions = {'.pdf', '.png', '.jpg', '.jpeg'}
+        doc_ext = os.path.splitext(document.filename)[1].lower()
+        if doc_ext not in allowed_doc_extensions:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid document file type '{doc_ext}'. Allowed types: {', '.join(allowed_doc_extensions)}"
+            )
+        doc_path, document_hash = await ingest_upload_file(
+            document, suffix=doc_ext, max_bytes=MAX_DOCUMENT_BYTES, max_pages=MAX_JOB_DOCUMENT_PAGES
+        )
+        files_to_cleanup.append(doc_path)
+
+        # --- 2. Validate, Save, and Convert Excel Template --- 
+        excel_ext = os.path.splitext(excel_template.filename)[1].lower()
+        if excel_ext not in ('.xls', '.xlsx'):
+            raise HTTPException(status_code=400, detail=f"Invalid template file format '{excel_ext}'. Only .xlsx and .xls are supported.")
+        original_template_path, template_hash = await ingest_upload_file(excel_template, suffix=excel_ext, max_bytes=MAX_TEMPLATE_BYTES)
+        files_to_cleanup.append(original_template_path)
+        if excel_ext == '.xls':
+            print(f"[{request_id}] .xls template detected. Converting to .xlsx...")
+            processed_template_path = await asyncio.to_thread(convert_xls_to_xlsx, original_template_path)
+            files_to_cleanup.append(processed_template_path)
+        else:
+            processed_template_path = original_template_path
+
+        # --- 3. Queue the Job (files are moved into the job's own directory) --- 
+        job = await asyncio.to_thread(
+            enqueue_job, processed_template_path, doc_path, excel_template.filename, document.filename, webhook_url
+        )
+        cleanup_files(*files_to_cleanup)
+        print(f"[{request_id}] Queued job {job['id']} in the {job_status(job)['lane']} lane.")
+        return JSONResponse(status_code=202, content=job_status(job))
+
+    except HTTPException as http_exc:
+        cleanup_files(*files_to_cleanup)
+        raise http_exc
+    except Exception as e:
+        print(f"[{request_id}] An unexpected server error occurred: {str(e)}")
+        cleanup_files(*files_to_cleanup)
+        raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {str(e)}")
+
+
+@app.get("/jobs/{job_id}",
+         summary="Returns the status of a queued job")
+async def get_job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job_status(job)
+
+
+@app.get("/jobs/{job_id}/result",
+         summary="Downloads the filled Excel file of a finished job",
+         response_description="The filled Excel file")
+async def get_job_result(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    if job["status"] == "failed":
+        raise HTTPException(status_code=500, detail=f"Job failed: {job['error']}")
+    if job["status"] != "succeeded":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}, the result is not available yet")
+    template_filename = job["template_filename"] or "template.xlsx"
+    output_filename = os.path.splitext(template_filename)[0] + "_filled.xlsx"
+    return FileResponse(
+        job["result_path"],
+        filename=output_filename,
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Exposes stage latency histograms and pipeline counters in the Prometheus text format."""
+    return PlainTextResponse(content=render_prometheus_metrics(), media_type="text/plain; version=0.0.4")
+
 # --- Optional: Add a root endpoint for basic info ---
 @app.get("/", include_in_schema=False)
 async def root():
@@ -0,0 +1,144 @@
+import os
+import re
+
+from app.excel_to_markdown import parse_excel_markdown
+from utils.metrics_utils import increment_counter
+
+# Check every mapping locally for form values it left out and for cells that must not be written,
+# and ask Gemini about just those in a small follow-up call
+MAPPING_COVERAGE_CHECK_ENABLED = os.getenv('MAPPING_COVERAGE_CHECK_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# At most this many missing values go into the follow-up; more usually means the form has content the template does not ask for
+MAPPING_COVERAGE_MAX_ITEMS = int(os.getenv('MAPPING_COVERAGE_MAX_ITEMS', '40'))
+
+_NUMBER = re.compile(r'^[-+]?(?:\d{1,3}(?:,\d{3})+|\d+)?(?:\.\d+)?%?$')
+_LABEL_VALUE = re.compile(r'^([^:]{1,60}?):\s*(\S.*)$')
+_TABLE_SEPARATOR = re.compile(r'^[\s|:-]+$')
+_PAGE_MARKER = re.compile(r'^=== Page \d+ ===$')
+_DIGITS = re.compile(r'\d+(?:\.\d+)?')
+# Markdown emphasis, headings, list bullets and checkbox marks around a value
+_MARKUP = re.compile(r'^[#>*\-\s]+|[*_`]+')
+
+
+def _normalize_text(text) -> str:
+    return ' '.join(str(text).split()).lower()
+
+
+def _parse_number(token: str) -> float | None:
+    token = token.strip('()[]{},;:')
+    if not token or not any(char.isdigit() for char in token) or not _NUMBER.match(token):
+        return None
+    return round(float(token.rstrip('%').replace(',', '')), 6)
+
+
+def _numbers_in(text) -> set:
+    return {number for number in (_parse_number(token) for token in str(text).split()) if number is not None}
+
+
+def _form_fields(line: str) -> list[str]:
+    """The values on a line of the form: every table cell, or the value of a "Label: value" line."""
+    line = line.strip()
+    if not line or _PAGE_MARKER.match(line):
+        return []
+    if line.startswith('|'):
+        if _TABLE_SEPARATOR.match(line):
+            return []
+        cells = [cell.strip() for cell in line.strip('|').split('|')]
+    else:
+        match = _LABEL_VALUE.match(_MARKUP.sub('', line))
+        cells = [match.group(2)] if match else []
+    fields = []
+    for cell in cells:
+        cell = _MARKUP.sub('', cell).strip()
+        match = _LABEL_VALUE.match(cell)
+        if match:
+            cell = match.group(2).strip()
+        if cell and not cell.endswith(':'):
+            fields.append(cell)
+    return fields
+
+
+def index_form_values(form_text: str) -> list[dict]:
+    """
+    Indexes the values on a form (scan Markdown or Textract text): every number, and every table cell or
+    "Label: value" value that contains letters. Returns {"value", "number", "context"} items, without duplicates.
+    """
+    items, seen = [], set()
+    for line in form_text.splitlines():
+        for field in _form_fields(line):
+            tokens = field.split()
+            numbers = [_parse_number(token) for token in tokens]
+            if any(number is None for number in numbers) and any(char.isalpha() or char.isdigit() for char in field):
+                # Text, dates and codes such as "04-23-25" or "205274-101.01.01" are checked as a whole
+                key = ('text', _normalize_text(field))
+                if len(key[1]) >= 2 and key not in seen:
+                    seen.add(key)
+                    items.append({"value": field, "number": None, "context": line.strip()})
+            for token, number in zip(tokens, numbers):
+                if number is not None and ('number', number) not in seen:
+                    seen.add(('number', number))
+                    items.append({"value": token.strip('()[]{},;:'), "number": number, "context": line.strip()})
+    return items
+
+
+def find_missing_values(form_text: str, template_markdown: str, mapping: dict) -> list[dict]:
+    """
+    Form values that appear neither in a mapped value nor in the template (labels and pre-printed content).
+    Numbers are compared numerically, text ignoring case and whitespace, also as part of a longer value.
+    """
+    mapped_texts = [_normalize_text(value) for value in mapping.values()]
+    mapped_numbers = set()
+    for value in mapping.values():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            mapped_numbers.add(round(float(value), 6))
+        else:
+            mapped_numbers |= _numbers_in(value)
+    # Only the cell texts, the cell IDs and merged ranges around them are not form content
+    template_values = ' | '.join(cell["value"] for cell in parse_excel_markdown(template_markdown).values())
+    template_text = _normalize_text(template_values)
+    # Numbers in pre-printed template text such as "SEG: 4-12" or "Ø3.5" count as well
+    template_numbers = {round(float(number), 6) for number in _DIGITS.findall(template_values)}
+
+    missing = []
+    for item in index_form_values(form_text):
+        if item["number"] is not None:
+            if item["number"] in mapped_numbers or item["number"] in template_numbers:
+                continue
+        else:
+            value = _normalize_text(item["value"])
+            if value in template_text or any(value in mapped or (len(mapped) >= 3 and mapped in value) for mapped in mapped_texts):
+                continue
+        missing.append(item)
+    return missing
+
+
+def template_cell_flags(ws, merged_ranges: dict) -> dict:
+    """What the checker needs to know about the template: its formula cells and merged ranges."""
+    formulas = {cell.coordinate for row in ws.iter_rows() for cell in row if cell.data_type == 'f'}
+    return {"formulas": formulas, "merged_ranges": dict(merged_ranges)}
+
+
+def cell_issue(template_flags: dict, cell_id: str) -> str | None:
+    """Why a mapped cell must not be written, or None: it holds a formula or lies inside a merged range but is not its master."""
+    if cell_id in template_flags["formulas"]:
+        return "contains a formula"
+    merged_range = template_flags["merged_ranges"].get(cell_id)
+    if merged_range is not None:
+        master = merged_range.split(':')[0]
+        if master != cell_id:
+            return f"lies inside the merged range {merged_range}, only its top-left cell {master} can hold a value"
+    return None
+
+
+def check_mapping_coverage(request_id, form_text: str, template_markdown: str, mapping: dict, flagged_cells: dict) -> dict:
+    """
+    Returns {"missing": [items], "flagged": {cell_id: (value, issue)}} for a mapping, where flagged_cells are
+    the cells withheld from the template by cell_issue while the mapping was written.
+    """
+    missing = find_missing_values(form_text, template_markdown, mapping)
+    increment_counter("excel_agent_mapping_values_missing_total", len(missing), description="Form values the mapping left out")
+    increment_counter("excel_agent_mapping_cells_flagged_total", len(flagged_cells), description="Mapped cells withheld from the template")
+    if len(missing) > MAPPING_COVERAGE_MAX_ITEMS:
+        print(f"[{request_id}] {len(missing)} form values are not mapped, asking about the first {MAPPING_COVERAGE_MAX_ITEMS}.")
+        missing = missing[:MAPPING_COVERAGE_MAX_ITEMS]
+    print(f"[{request_id}] Coverage check: {len(missing)} form values not mapped, {len(flagged_cells)} cells flagged.")
+    return {"missing": missing, "flagged": flagged_cells}
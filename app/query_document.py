@@ -0,0 +1,160 @@
+import io
+import os
+import hashlib
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+
+from utils.aws_utils import get_textract_client, rasterize_document, parse_textract_query_answers
+from utils.deadline_utils import stage_deadline, run_with_deadline
+from utils.metrics_utils import stage_timer, increment_counter
+from utils.page_filter_utils import is_blank_page
+from utils.rate_limit_utils import call_with_rate_limit
+
+# Synchronous AnalyzeDocument accepts at most 15 queries per call; more questions are split across calls
+TEXTRACT_MAX_QUERIES_PER_CALL = int(os.getenv('TEXTRACT_MAX_QUERIES_PER_CALL', '15'))
+QUERY_MAX_QUESTIONS = int(os.getenv('QUERY_MAX_QUESTIONS', '60'))
+# Pages of one document queried at the same time (all calls still share the Textract rate limit)
+QUERY_PAGE_CONCURRENCY = int(os.getenv('QUERY_PAGE_CONCURRENCY', '4'))
+# Answers kept in memory, one entry per page content and question; 0 disables the cache
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', '4096'))
+# Textract rejects query texts longer than this
+MAX_QUESTION_CHARS = 200
+
+_answer_cache = OrderedDict()  # (page sha256, question) -> [{"text", "confidence"}]
+_answer_cache_lock = threading.Lock()
+
+
+def normalize_questions(questions: list[str]) -> list[str]:
+    """Strips the questions and drops duplicates, keeping their order. Raises 400 for unusable input."""
+    normalized = []
+    for question in questions:
+        question = ' '.join(question.split())
+        if question and question not in normalized:
+            normalized.append(question)
+    if not normalized:
+        raise HTTPException(status_code=400, detail="At least one question is required")
+    if len(normalized) > QUERY_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"At most {QUERY_MAX_QUESTIONS} questions per request")
+    too_long = [question for question in normalized if len(question) > MAX_QUESTION_CHARS]
+    if too_long:
+        raise HTTPException(status_code=400, detail=f"Questions must be at most {MAX_QUESTION_CHARS} characters: {too_long[0][:50]}...")
+    return normalized
+
+
+def _cached_answers(page_hash: str, questions: list[str]) -> dict[str, list[dict]]:
+    with _answer_cache_lock:
+        cached = {}
+        for question in questions:
+            answers = _answer_cache.get((page_hash, question))
+            if answers is not None:
+                _answer_cache.move_to_end((page_hash, question))
+                cached[question] = answers
+    return cached
+
+
+def _cache_answers(page_hash: str, answers: dict[str, list[dict]]) -> None:
+    if QUERY_CACHE_SIZE <= 0:
+        return
+    with _answer_cache_lock:
+        for question, question_answers in answers.items():
+            _answer_cache[(page_hash, question)] = question_answers
+            _answer_cache.move_to_end((page_hash, question))
+        while len(_answer_cache) > QUERY_CACHE_SIZE:
+            _answer_cache.popitem(last=False)
+
+
+def _query_page(client, image, page_num: int, questions: list[str]) -> dict:
+    """
+    Answers the questions for one page, from the cache where possible and otherwise with as few
+    analyze_document calls as the per-call query limit allows.
+    Returns {"answers": {question: [{"text", "confidence"}]}, "calls", "cached"}.
+    """
+    # Hashed from the pixels, so a fully cached page is never encoded
+    page_hash = hashlib.sha256(f"{image.mode}{image.size}".encode('utf-8') + image.tobytes()).hexdigest()
+    answers = _cached_answers(page_hash, questions)
+    cached = len(answers)
+    increment_counter("excel_agent_cache_hits_total", cached, cache="textract_query")
+    missing = [question for question in questions if question not in answers]
+    increment_counter("excel_agent_cache_misses_total", len(missing), cache="textract_query")
+    if not missing:
+        return {"answers": answers, "calls": 0, "cached": cached}
+
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format='PNG')
+    img_byte_arr = img_byte_arr.getvalue()
+    calls = 0
+    for start in range(0, len(missing), TEXTRACT_MAX_QUERIES_PER_CALL):
+        batch = missing[start:start + TEXTRACT_MAX_QUERIES_PER_CALL]
+        increment_counter("excel_agent_image_bytes_total", len(img_byte_arr), description="Image bytes sent upstream", upstream="textract")
+        try:
+            with stage_timer("textract_query"):
+                response = run_with_deadline(
+                    call_with_rate_limit,
+                    "textract",
+                    client.analyze_document,
+                    Document={'Bytes': img_byte_arr},
+                    FeatureTypes=["QUERIES"],
+                    QueriesConfig={'Queries': [{'Text': question} for question in batch]}
+                )
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"AWS Textract API error on page {page_num}: {str(e)}")
+        calls += 1
+        batch_answers = parse_textract_query_answers(response.get('Blocks', []))
+        # Questions Textract found no answer for are cached as such, so they are not asked again
+        batch_answers = {question: batch_answers.get(question, []) for question in batch}
+        _cache_answers(page_hash, batch_answers)
+        answers.update(batch_answers)
+    return {"answers": answers, "calls": calls, "cached": cached}
+
+
+def query_document(request_id, doc_path: str, questions: list[str]) -> dict:
+    """
+    Asks Textract the questions about every page of the document, pages running concurrently.
+    Returns {"answers": [{"question", "answer", "answers"}], "pages", "textract_calls", "cached_answers"} where
+    "answers" lists every answer with its confidence and page number, best first, and "answer" is the best one or None.
+    Blank pages are not queried. The questions must already have been through normalize_questions.
+    """
+    client = get_textract_client()
+    images = rasterize_document(doc_path)
+    increment_counter("excel_agent_pages_total", len(images), description="Document pages processed", stage="textract_query")
+    pages = []
+    for page_num, image in enumerate(images, start=1):
+        if is_blank_page(image):
+            increment_counter("excel_agent_pages_skipped_total", description="Pages left out before Textract or Gemini", reason="blank")
+            continue
+        pages.append((page_num, image))
+    print(f"[{request_id}] Querying {len(pages)} of {len(images)} pages with {len(questions)} questions "
+          f"(at most {TEXTRACT_MAX_QUERIES_PER_CALL} per call).")
+
+    # All pages share the Textract stage's part of the request deadline
+    with stage_deadline("textract"), ThreadPoolExecutor(max_workers=max(1, QUERY_PAGE_CONCURRENCY)) as executor:
+        # Each page runs in a copy of this context, so it sees the stage deadline and the request's timings
+        futures = [
+            (page_num, executor.submit(contextvars.copy_context().run, _query_page, client, image, page_num, questions))
+            for page_num, image in pages
+        ]
+        page_results = [(page_num, future.result()) for page_num, future in futures]
+
+    textract_calls = sum(page["calls"] for _, page in page_results)
+    results = []
+    for question in questions:
+        found = [
+            {**answer, "page": page_num}
+            for page_num, page in page_results
+            for answer in page["answers"].get(question, [])
+        ]
+        found.sort(key=lambda answer: answer["confidence"], reverse=True)
+        results.append({"question": question, "answer": found[0] if found else None, "answers": found})
+    print(f"[{request_id}] Answered {sum(1 for result in results if result['answer'])} of {len(questions)} questions "
+          f"with {textract_calls} Textract calls.")
+    return {
+        "answers": results,
+        "pages": len(images),
+        "textract_calls": textract_calls,
+        "cached_answers": sum(page["cached"] for _, page in page_results)
+    }
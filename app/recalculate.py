@@ -0,0 +1,530 @@
+import os
+import re
+import math
+import datetime
+import zipfile
+from xml.sax.saxutils import escape
+from openpyxl.utils import column_index_from_string
+from openpyxl.utils.datetime import to_excel
+
+from utils.metrics_utils import increment_counter
+
+_TOKEN_PATTERN = re.compile(r'''
+    \s*(?:
+      (?P<string>"(?:[^"]|"")*")
+    | (?P<error>\#DIV/0!|\#N/A|\#NAME\?|\#NULL!|\#NUM!|\#REF!|\#VALUE!)
+    | (?P<ref>(?:(?P<sheet>'(?:[^']|'')+'|[A-Za-z0-9_.]+)!)?
+              \$?(?P<col1>[A-Za-z]{1,3})\$?(?P<row1>\d+)(?::\$?(?P<col2>[A-Za-z]{1,3})\$?(?P<row2>\d+))?)(?![\w(])
+    | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<function>[A-Za-z_][A-Za-z0-9_.]*)\(
+    | (?P<bool>TRUE|FALSE)(?![\w(])
+    | (?P<op><>|<=|>=|[-+*/^&%=<>(),])
+    )''', re.VERBOSE | re.IGNORECASE)
+
+
+class ExcelError(str):
+    """An Excel error value such as #DIV/0!. Flows through formulas like any other value."""
+
+
+class UnsupportedFormula(Exception):
+    """The formula uses syntax or a function the engine does not implement; its cell is left uncached."""
+
+
+# --- Parsing -------------------------------------------------------------------------------------------
+
+def _tokenize(formula: str) -> list[tuple]:
+    tokens = []
+    position = 0
+    while position < len(formula):
+        if formula[position:].isspace():
+            break
+        match = _TOKEN_PATTERN.match(formula, position)
+        if match is None or match.end() == position:
+            raise UnsupportedFormula(f"cannot parse {formula[position:]!r}")
+        position = match.end()
+        kind = match.lastgroup
+        if match.group('ref'):
+            sheet = match.group('sheet')
+            if sheet and sheet.startswith("'"):
+                sheet = sheet[1:-1].replace("''", "'")
+            col1, row1 = column_index_from_string(match.group('col1').upper()), int(match.group('row1'))
+            col2 = column_index_from_string(match.group('col2').upper()) if match.group('col2') else col1
+            row2 = int(match.group('row2')) if match.group('row2') else row1
+            bounds = (min(col1, col2), min(row1, row2), max(col1, col2), max(row1, row2))
+            tokens.append(('ref', (sheet, bounds)))
+        elif kind == 'string':
+            tokens.append(('str', match.group('string')[1:-1].replace('""', '"')))
+        elif kind == 'error':
+            tokens.append(('err', ExcelError(match.group('error').upper())))
+        elif kind == 'number':
+            tokens.append(('num', float(match.group('number'))))
+        elif kind == 'function':
+            tokens.append(('func', match.group('function').upper()))
+        elif kind == 'bool':
+            tokens.append(('bool', match.group('bool').upper() == 'TRUE'))
+        else:
+            tokens.append(('op', match.group('op')))
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive-descent parser producing tuple nodes. Precedence from lowest to highest follows Excel:
+    comparison, &, + -, * /, ^, %, unary minus.
+    """
+
+    def __init__(self, tokens: list[tuple]):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def expect(self, op: str) -> None:
+        if self.take() != ('op', op):
+            raise UnsupportedFormula(f"expected {op!r}")
+
+    def parse(self):
+        node = self.comparison()
+        if self.position != len(self.tokens):
+            raise UnsupportedFormula(f"unexpected token {self.peek()[1]!r}")
+        return node
+
+    def _binary(self, operators: tuple, operand):
+        node = operand()
+        while self.peek()[0] == 'op' and self.peek()[1] in operators:
+            node = ('bin', self.take()[1], node, operand())
+        return node
+
+    def comparison(self):
+        return self._binary(('=', '<>', '<', '>', '<=', '>='), self.concatenation)
+
+    def concatenation(self):
+        return self._binary(('&',), self.additive)
+
+    def additive(self):
+        return self._binary(('+', '-'), self.multiplicative)
+
+    def multiplicative(self):
+        return self._binary(('*', '/'), self.power)
+
+    def power(self):
+        return self._binary(('^',), self.percent)
+
+    def percent(self):
+        node = self.unary()
+        while self.peek() == ('op', '%'):
+            self.take()
+            node = ('pct', node)
+        return node
+
+    def unary(self):
+        if self.peek() in (('op', '-'), ('op', '+')):
+            sign = self.take()[1]
+            operand = self.unary()
+            return ('neg', operand) if sign == '-' else operand
+        return self.primary()
+
+    def primary(self):
+        kind, value = self.take()
+        if kind in ('num', 'str', 'bool', 'err'):
+            return ('const', value)
+        if kind == 'ref':
+            return ('ref', *value)
+        if kind == 'func':
+            args = []
+            if self.peek() != ('op', ')'):
+                args.append(self.comparison())
+                while self.peek() == ('op', ','):
+                    self.take()
+                    args.append(self.comparison())
+            self.expect(')')
+            return ('call', value, args)
+        if (kind, value) == ('op', '('):
+            node = self.comparison()
+            self.expect(')')
+            return node
+        raise UnsupportedFormula(f"unexpected token {value!r}")
+
+
+def parse_formula(formula: str):
+    """Parses a formula (with or without the leading "=") into a tree of tuple nodes."""
+    return _Parser(_tokenize(formula.lstrip('='))).parse()
+
+
+# --- Value coercion ------------------------------------------------------------------------------------
+
+def _to_number(value):
+    """Coerces an operand for arithmetic: blanks are 0, numeric text is parsed, other text is #VALUE!."""
+    if isinstance(value, ExcelError):
+        return value
+    if value is None:
+        return 0.0
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(str(value).strip())
+    except ValueError:
+        return ExcelError('#VALUE!')
+
+
+def _to_text(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return str(value)
+
+
+def _to_bool(value):
+    if isinstance(value, ExcelError):
+        return value
+    if value is None:
+        return False
+    if isinstance(value, str):
+        if value.upper() in ('TRUE', 'FALSE'):
+            return value.upper() == 'TRUE'
+        return ExcelError('#VALUE!')
+    return bool(value)
+
+
+def _first_error(values):
+    for value in values:
+        if isinstance(value, ExcelError):
+            return value
+    return None
+
+
+def _compare(op: str, left, right):
+    # Excel orders numbers < text < booleans; text compares case-insensitively and blanks match 0 or ""
+    def rank(value):
+        if isinstance(value, bool):
+            return 2, value
+        if isinstance(value, str):
+            return 1, value.lower()
+        return 0, value
+    if left is None:
+        left = "" if isinstance(right, str) else 0.0
+    if right is None:
+        right = "" if isinstance(left, str) else 0.0
+    left, right = rank(left), rank(right)
+    return {
+        '=': left == right, '<>': left != right, '<': left < right,
+        '>': left > right, '<=': left <= right, '>=': left >= right,
+    }[op]
+
+
+def _round(number: float, digits: int, mode: str) -> float:
+    factor = 10 ** digits
+    scaled = abs(number) * factor
+    if mode == 'up':
+        scaled = math.ceil(scaled - 1e-9)
+    elif mode == 'down':
+        scaled = math.floor(scaled + 1e-9)
+    else:
+        scaled = math.floor(scaled + 0.5 + 1e-9)  # half away from zero, as Excel does
+    return math.copysign(scaled / factor, number)
+
+
+# --- Evaluation ----------------------------------------------------------------------------------------
+
+def _aggregate_numbers(function: str, numbers: list):
+    if function == 'SUM':
+        return math.fsum(numbers)
+    if function == 'AVERAGE':
+        return math.fsum(numbers) / len(numbers) if numbers else ExcelError('#DIV/0!')
+    if function == 'MIN':
+        return min(numbers) if numbers else 0.0
+    if function == 'MAX':
+        return max(numbers) if numbers else 0.0
+    if function == 'PRODUCT':
+        return math.prod(numbers) if numbers else 0.0
+    return float(len(numbers))  # COUNT
+
+
+class _WorkbookEvaluator:
+    """
+    Evaluates the formulas of an openpyxl workbook. Cell results are memoized, and every range is
+    resolved once into a flat list that all aggregates over the same range share, so SUM/AVERAGE/MIN/MAX
+    run as single passes of the builtins over a list instead of per-cell recursion.
+    """
+
+    _AGGREGATES = ('SUM', 'AVERAGE', 'MIN', 'MAX', 'COUNT', 'PRODUCT')
+
+    def __init__(self, wb):
+        self.wb = wb
+        self.sheets = {ws.title: ws for ws in wb.worksheets}
+        self.results = {}       # (sheet, row, col) -> value
+        self.unsupported = {}   # (sheet, row, col) -> reason
+        self.ranges = {}        # (sheet, bounds) -> [values]
+        self.parsed = {}        # formula text -> node
+        self.in_progress = set()
+
+    def cell_value(self, sheet: str, row: int, col: int):
+        key = (sheet, row, col)
+        if key in self.results:
+            return self.results[key]
+        if key in self.unsupported:
+            raise UnsupportedFormula(self.unsupported[key])
+        ws = self.sheets.get(sheet)
+        if ws is None:
+            return ExcelError('#REF!')
+        # Read through the cell store directly: ws.cell() would create (and later save) empty cells
+        cell = ws._cells.get((row, col))
+        if cell is None:
+            return None
+        value = cell.value
+        if cell.data_type != 'f':
+            if isinstance(value, (datetime.datetime, datetime.date, datetime.time, datetime.timedelta)):
+                return to_excel(value)
+            if cell.data_type == 'e':
+                return ExcelError(value)
+            return value
+        if not isinstance(value, str):
+            raise UnsupportedFormula(f"{type(value).__name__} formulas are not supported")
+        if key in self.in_progress:
+            raise UnsupportedFormula("circular reference")
+        self.in_progress.add(key)
+        try:
+            node = self.parsed.get(value)
+            if node is None:
+                node = self.parsed[value] = parse_formula(value)
+            result = self.evaluate(node, sheet)
+            if isinstance(result, list):  # a bare range in a cell formula
+                raise UnsupportedFormula("array result")
+            if isinstance(result, float) and (math.isnan(result) or math.isinf(result)):
+                result = ExcelError('#NUM!')
+        except UnsupportedFormula as e:
+            self.unsupported[key] = str(e)
+            raise
+        finally:
+            self.in_progress.discard(key)
+        self.results[key] = result
+        return result
+
+    def range_values(self, sheet: str, bounds: tuple) -> list:
+        key = (sheet, bounds)
+        values = self.ranges.get(key)
+        if values is None:
+            min_col, min_row, max_col, max_row = bounds
+            values = self.ranges[key] = [
+                self.cell_value(sheet, row, col)
+                for row in range(min_row, max_row + 1)
+                for col in range(min_col, max_col + 1)
+            ]
+        return values
+
+    def evaluate(self, node, sheet: str):
+        kind = node[0]
+        if kind == 'const':
+            return node[1]
+        if kind == 'ref':
+            target_sheet, bounds = node[1] or sheet, node[2]
+            if bounds[0] == bounds[2] and bounds[1] == bounds[3]:
+                return self.cell_value(target_sheet, bounds[1], bounds[0])
+            return self.range_values(target_sheet, bounds)
+        if kind == 'neg':
+            value = _to_number(self.scalar(node[1], sheet))
+            return value if isinstance(value, ExcelError) else -value
+        if kind == 'pct':
+            value = _to_number(self.scalar(node[1], sheet))
+            return value if isinstance(value, ExcelError) else value / 100
+        if kind == 'bin':
+            return self.binary(node[1], self.scalar(node[2], sheet), self.scalar(node[3], sheet))
+        return self.call(node[1], node[2], sheet)
+
+    def scalar(self, node, sheet: str):
+        value = self.evaluate(node, sheet)
+        if isinstance(value, list):
+            raise UnsupportedFormula("range used as a single value")
+        return value
+
+    def binary(self, op: str, left, right):
+        error = _first_error((left, right))
+        if error:
+            return error
+        if op == '&':
+            return _to_text(left) + _to_text(right)
+        if op in ('=', '<>', '<', '>', '<=', '>='):
+            return _compare(op, left, right)
+        left, right = _to_number(left), _to_number(right)
+        error = _first_error((left, right))
+        if error:
+            return error
+        if op == '+':
+            return left + right
+        if op == '-':
+            return left - right
+        if op == '*':
+            return left * right
+        if op == '/':
+            return left / right if right else ExcelError('#DIV/0!')
+        try:
+            return float(left) ** right
+        except (OverflowError, ZeroDivisionError, ValueError):
+            return ExcelError('#NUM!')
+
+    def numbers(self, args: list, sheet: str, count_text: bool = False):
+        """
+        Collects the numbers of aggregate arguments with Excel's rules: inside references only numbers
+        count (text, booleans and blanks are skipped), while literal arguments are coerced.
+        Returns the list, or the first error value met.
+        """
+        numbers = []
+        for arg in args:
+            value = self.evaluate(arg, sheet)
+            if arg[0] == 'ref':
+                values = value if isinstance(value, list) else [value]
+                error = _first_error(values)
+                if error:
+                    return error
+                if count_text:
+                    numbers.extend(1 for v in values if v is not None and v != "")
+                else:
+                    numbers.extend(v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool))
+            elif count_text:
+                numbers.append(1)
+            else:
+                value = _to_number(value)
+                if isinstance(value, ExcelError):
+                    return value
+                numbers.append(value)
+        return numbers
+
+    def call(self, function: str, args: list, sheet: str):
+        if function in self._AGGREGATES:
+            numbers = self.numbers(args, sheet)
+            return numbers if isinstance(numbers, ExcelError) else _aggregate_numbers(function, numbers)
+        if function == 'COUNTA':
+            numbers = self.numbers(args, sheet, count_text=True)
+            return numbers if isinstance(numbers, ExcelError) else float(len(numbers))
+        if function == 'IF':
+            if not 2 <= len(args) <= 3:
+                raise UnsupportedFormula("IF takes 2 or 3 arguments")
+            condition = _to_bool(self.scalar(args[0], sheet))
+            if isinstance(condition, ExcelError):
+                return condition
+            if condition:
+                return self.scalar(args[1], sheet)
+            return self.scalar(args[2], sheet) if len(args) == 3 else False
+        if function == 'IFERROR':
+            value = self.scalar(args[0], sheet)
+            return self.scalar(args[1], sheet) if isinstance(value, ExcelError) else value
+        if function in ('AND', 'OR'):
+            values = []
+            for arg in args:
+                value = self.evaluate(arg, sheet)
+                for item in (value if isinstance(value, list) else [value]):
+                    if isinstance(item, ExcelError):
+                        return item
+                    if arg[0] == 'ref' and not isinstance(item, (bool, int, float)):
+                        continue
+                    item = _to_bool(item)
+                    if isinstance(item, ExcelError):
+                        return item
+                    values.append(item)
+            if not values:
+                return ExcelError('#VALUE!')
+            return all(values) if function == 'AND' else any(values)
+
+        values = [self.scalar(arg, sheet) for arg in args]
+        error = _first_error(values)
+        if error:
+            return error
+        if function == 'NOT' and len(values) == 1:
+            value = _to_bool(values[0])
+            return value if isinstance(value, ExcelError) else not value
+        if function == 'CONCATENATE':
+            return ''.join(_to_text(value) for value in values)
+        if function == 'LEN' and len(values) == 1:
+            return float(len(_to_text(values[0])))
+        numbers = [_to_number(value) for value in values]
+        error = _first_error(numbers)
+        if error:
+            return error
+        if function == 'ABS' and len(numbers) == 1:
+            return abs(numbers[0])
+        if function == 'INT' and len(numbers) == 1:
+            return float(math.floor(numbers[0]))
+        if function == 'SQRT' and len(numbers) == 1:
+            return math.sqrt(numbers[0]) if numbers[0] >= 0 else ExcelError('#NUM!')
+        if function == 'MOD' and len(numbers) == 2:
+            number, divisor = numbers
+            return number - divisor * math.floor(number / divisor) if divisor else ExcelError('#DIV/0!')
+        if function in ('ROUND', 'ROUNDUP', 'ROUNDDOWN') and len(numbers) == 2:
+            mode = {'ROUND': 'half', 'ROUNDUP': 'up', 'ROUNDDOWN': 'down'}[function]
+            return _round(numbers[0], int(numbers[1]), mode)
+        raise UnsupportedFormula(f"function {function} with {len(args)} arguments is not supported")
+
+
+def recalculate_workbook(wb) -> dict[int, dict[str, object]]:
+    """
+    Evaluates every formula of the workbook. Returns {sheet index: {cell ref: value}} with numbers,
+    strings, booleans and ExcelError values; formulas the engine cannot evaluate are left out.
+    """
+    evaluator = _WorkbookEvaluator(wb)
+    results = {}
+    supported = unsupported = 0
+    for index, ws in enumerate(wb.worksheets):
+        sheet_results = results[index] = {}
+        for (row, col), cell in list(ws._cells.items()):
+            if cell.data_type != 'f':
+                continue
+            try:
+                sheet_results[cell.coordinate] = evaluator.cell_value(ws.title, row, col)
+                supported += 1
+            except UnsupportedFormula as e:
+                print(f"Formula in {ws.title}!{cell.coordinate} left for Excel to calculate: {e}")
+                unsupported += 1
+    increment_counter("excel_agent_formulas_recalculated_total", supported, description="Formulas evaluated after filling", result="evaluated")
+    increment_counter("excel_agent_formulas_recalculated_total", unsupported, result="unsupported")
+    return results
+
+
+# --- Writing cached values -----------------------------------------------------------------------------
+
+_FORMULA_CELL_PATTERN = re.compile(r'<c r="([A-Z]+\d+)"([^>]*)><f>(.*?)</f><v\s*/>(?:</v>)?</c>', re.DOTALL)
+
+
+def _cached_value_xml(value) -> tuple[str, str]:
+    """Returns the cell type attribute and the <v> text for a formula result."""
+    if isinstance(value, ExcelError):
+        return ' t="e"', escape(value)
+    if isinstance(value, bool):
+        return ' t="b"', '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return '', _to_text(value)
+    return ' t="str"', escape(_to_text(value))
+
+
+def write_cached_values(xlsx_path: str, results: dict[int, dict[str, object]]) -> None:
+    """
+    Adds the results of recalculate_workbook to a workbook just saved by openpyxl, which writes every
+    formula cell with an empty <v/>. Sheets are stored by openpyxl as xl/worksheets/sheet<index + 1>.xml.
+    """
+    tmp_path = xlsx_path + '.recalc'
+    with zipfile.ZipFile(xlsx_path) as source, zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED) as target:
+        for item in source.infolist():
+            data = source.read(item.filename)
+            match = re.fullmatch(r'xl/worksheets/sheet(\d+)\.xml', item.filename)
+            sheet_results = results.get(int(match.group(1)) - 1) if match else None
+            if sheet_results:
+                def add_value(cell_match):
+                    ref, attributes, formula = cell_match.groups()
+                    if ref not in sheet_results:
+                        return cell_match.group(0)
+                    type_attribute, text = _cached_value_xml(sheet_results[ref])
+                    attributes = re.sub(r'\s+t="[^"]*"', '', attributes)
+                    return f'<c r="{ref}"{attributes}{type_attribute}><f>{formula}</f><v>{text}</v></c>'
+                data = _FORMULA_CELL_PATTERN.sub(add_value, data.decode('utf-8')).encode('utf-8')
+            target.writestr(item, data)
+    os.replace(tmp_path, xlsx_path)
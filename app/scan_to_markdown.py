@@ -1,35 +1,40 @@
-from utils.aws_utils import extract_text_and_tables, get_textract_client
+from utils.aws_utils import extract_text_and_tables, get_textract_client, read_textract_structure
 from utils.file_utils import save_upload_file_tmp, cleanup_files
 from utils.gemini_utils import generate_markdown_from_scan, get_gemini_client
+from utils.page_filter_utils import filter_pages, kept_pages, format_page_decisions
 import os
 from PIL import Image
 import io
 import uuid
 from typing import Tuple
 from fastapi import UploadFile, HTTPException
+# Routes receive Starlette's UploadFile, which fastapi.UploadFile subclasses
+from starlette.datastructures import UploadFile as StarletteUploadFile
 
 
 async def convert_scan_to_markdown(
     request_id: uuid.UUID,
     document_input: UploadFile | str,
     original_filename: str | None = None # Used if document_input is str
-) -> Tuple[str, str, str, str]: # Returns: markdown_content, doc_path, raw_text_path, table_path
+) -> Tuple[str, str, str, str, str, list]: # Returns: markdown_content, doc_path, raw_text_path, table_path, structure_path, page_decisions
     """
     Processes a scanned document (PDF or image) from an UploadFile or a file path.
     Extracts text/tables using AWS Textract, enhances using Gemini, returns Markdown.
     Manages cleanup for internally generated temp files (raw_text, tables).
     The caller is responsible for cleaning up the input doc_path if it was provided as a string.
-    Returns: (markdown_content, doc_path, raw_text_path, table_path)
+    Blank pages are left out; without a template there is nothing to judge relevance by, so all others are kept.
+    Returns: (markdown_content, doc_path, raw_text_path, table_path, structure_path, page_decisions)
     """
     input_doc_path = None
     saved_doc_path = None # Path if we saved an UploadFile
     raw_text_path = None
     table_path = None
+    structure_path = None
     cleanup_list_internal = [] # Files created *by this function* to clean up
 
     try:
         # --- 1. Determine Input Path --- 
-        if isinstance(document_input, UploadFile):
+        if isinstance(document_input, StarletteUploadFile):
             document = document_input
             file_ext = os.path.splitext(document.filename)[1].lower()
             print(f"[{request_id}] Saving uploaded document: {document.filename}")
@@ -47,25 +52,29 @@ async def convert_scan_to_markdown(
             raise TypeError("document_input must be UploadFile or str")
 
         # --- 2. Initialize Clients --- 
-        print(f"[{request_id}] Initializing AWS Textract and Google Gemini clients...")
-        textract_client = get_textract_client()
+        # The Textract client is only created if the document has no usable text layer
+        print(f"[{request_id}] Initializing Google Gemini client...")
         gemini_model = get_gemini_client()
 
         # --- 3. Process with Textract --- 
         print(f"[{request_id}] Starting Textract processing for: {input_doc_path}")
         # extract_text_and_tables creates and returns paths to temp files
-        raw_text_path, table_path = extract_text_and_tables(textract_client, input_doc_path)
-        cleanup_list_internal.extend([raw_text_path, table_path]) # Add Textract temps for internal cleanup
+        raw_text_path, table_path, structure_path = extract_text_and_tables(get_textract_client, input_doc_path)
+        cleanup_list_internal.extend([raw_text_path, table_path, structure_path]) # Add Textract temps for internal cleanup
         print(f"[{request_id}] Textract processing complete. Raw text: {raw_text_path}, Tables: {table_path}")
 
+        structure = read_textract_structure(structure_path)
+        page_decisions = filter_pages(structure)
+        print(f"[{request_id}] Page filter: {format_page_decisions(page_decisions)}")
+
         # --- 4. Enhance with Gemini --- 
         print(f"[{request_id}] Starting Gemini enhancement...")
-        markdown_content = generate_markdown_from_scan(gemini_model, input_doc_path, raw_text_path, table_path)
+        markdown_content = generate_markdown_from_scan(gemini_model, input_doc_path, raw_text_path, table_path, pages=kept_pages(page_decisions), structure=structure)
         print(f"[{request_id}] Gemini enhancement complete.")
 
         # --- 5. Return Results --- 
         # Return the markdown, the input_doc_path (caller might need it), and the paths to the intermediate files
-        return markdown_content, input_doc_path, raw_text_path, table_path
+        return markdown_content, input_doc_path, raw_text_path, table_path, structure_path, page_decisions
 
     except Exception as e:
         print(f"[{request_id}] Error during scan_to_markdown: {str(e)}")
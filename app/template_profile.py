@@ -0,0 +1,288 @@
+import os
+import re
+import json
+import fcntl
+import hashlib
+import threading
+from contextlib import contextmanager
+from openpyxl.utils import column_index_from_string, range_boundaries
+
+from app.excel_to_markdown import parse_excel_markdown
+from utils.file_utils import get_data_dir
+
+# An anchor is trusted once it has been confirmed by this many Gemini mappings
+MIN_ANCHOR_HITS = int(os.getenv('TEMPLATE_PROFILE_MIN_HITS', '3'))
+# Textract key/value pairs below this confidence are left to Gemini
+MIN_KEY_VALUE_CONFIDENCE = float(os.getenv('TEMPLATE_PROFILE_MIN_CONFIDENCE', '90'))
+
+
+
+def template_fingerprint(template_markdown: str) -> str:
+    """
+    Returns a stable hash of a template's cell content.
+    The filename header is ignored, so the same template uploaded under different temp names matches.
+    """
+    cells = parse_excel_markdown(template_markdown)
+    digest = hashlib.sha256()
+    for cell_id in sorted(cells):
+        digest.update(f"{cell_id}={cells[cell_id]['value']}|{cells[cell_id]['merged_range']}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _profile_path(fingerprint: str) -> str:
+    return os.path.join(get_data_dir('profiles'), f"{fingerprint}.json")
+
+
+def load_template_profile(fingerprint: str) -> dict:
+    """Loads the mapping profile of a template, or returns an empty profile if none exists yet."""
+    try:
+        with open(_profile_path(fingerprint), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"fingerprint": fingerprint, "observations": 0, "fields": {}}
+
+
+@contextmanager
+def _profile_file_lock(fingerprint: str):
+    """
+    Holds an exclusive lock on a template's profile across threads and uvicorn worker processes
+    (flock locks per open file, so threads of one process exclude each other as well).
+    """
+    with open(f"{_profile_path(fingerprint)}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _write_template_profile(profile: dict) -> None:
+    path = _profile_path(profile["fingerprint"])
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(profile, f)
+    os.replace(tmp_path, path)
+
+
+def save_template_profile(profile: dict) -> None:
+    """Atomically writes a template profile to the profile directory."""
+    with _profile_file_lock(profile["fingerprint"]):
+        _write_template_profile(profile)
+
+
+def _normalize_text(text) -> str:
+    return re.sub(r'[^a-z0-9]', '', str(text).lower())
+
+
+def _to_number(value):
+    """Returns value as int/float if it is numeric, otherwise None."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    text = str(value).strip()
+    if not re.fullmatch(r'[-+]?(\d+\.?\d*|\.\d+)', text):
+        return None
+    return float(text) if '.' in text else int(text)
+
+
+def _values_match(ocr_value, mapped_value) -> bool:
+    ocr_number, mapped_number = _to_number(ocr_value), _to_number(mapped_value)
+    if ocr_number is not None and mapped_number is not None:
+        return abs(ocr_number - mapped_number) < 1e-9
+    normalized = _normalize_text(ocr_value)
+    return normalized != '' and normalized == _normalize_text(mapped_value)
+
+
+def _index_structure(structure: list[dict]) -> tuple[dict, dict]:
+    """
+    Indexes the Textract structure by anchor location.
+    Key/value pairs are keyed by (normalized key, occurrence) and table grids by (header signature, occurrence),
+    so anchors survive tables or forms moving between pages.
+    """
+    key_values, tables = {}, {}
+    key_counts, table_counts = {}, {}
+    for page in structure:
+        for kv in page.get("key_values", []):
+            key = _normalize_text(kv["key"])
+            if not key:
+                continue
+            occurrence = key_counts.get(key, 0)
+            key_counts[key] = occurrence + 1
+            key_values[(key, occurrence)] = kv
+        for grid in page.get("tables", []):
+            if not grid:
+                continue
+            signature = '|'.join(_normalize_text(cell) for cell in grid[0])
+            occurrence = table_counts.get(signature, 0)
+            table_counts[signature] = occurrence + 1
+            tables[(signature, occurrence)] = grid
+    return key_values, tables
+
+
+def _read_anchor(anchor: dict, key_values: dict, tables: dict) -> str | None:
+    """Returns the OCR text at an anchor's location, or None if the location is missing or unreliable."""
+    if anchor["kind"] == "key_value":
+        kv = key_values.get((anchor["key"], anchor["occurrence"]))
+        if not kv or not kv["value"].strip() or kv.get("confidence", 100.0) < MIN_KEY_VALUE_CONFIDENCE:
+            return None
+        return kv["value"].strip()
+    grid = tables.get((anchor["table"], anchor["occurrence"]))
+    if not grid or anchor["row"] >= len(grid) or anchor["col"] >= len(grid[anchor["row"]]):
+        return None
+    return grid[anchor["row"]][anchor["col"]].strip() or None
+
+
+def resolve_with_template_profile(profile: dict, structure: list[dict]) -> tuple[dict, list[str]]:
+    """
+    Fills the fields of a template deterministically from Textract key/value and table output.
+
+    Returns:
+        A tuple containing:
+        - dict: cell IDs mapped to values for every field the profile could resolve.
+        - list: cell IDs the profile expects but could not resolve (to be mapped by Gemini).
+    """
+    key_values, tables = _index_structure(structure)
+    resolved, unresolved = {}, []
+    for cell_id, field in profile["fields"].items():
+        anchor = field.get("anchor")
+        value = None
+        if anchor and field["hits"] >= MIN_ANCHOR_HITS and field["hits"] > field["misses"]:
+            value = _read_anchor(anchor, key_values, tables)
+            if value is not None and field.get("numeric"):
+                value = _to_number(value)
+        if value is not None:
+            resolved[cell_id] = value
+        elif field["seen"] * 2 >= profile["observations"]:
+            # Fields that show up in most mappings still have to come from Gemini
+            unresolved.append(cell_id)
+    return resolved, unresolved
+
+
+def is_profile_ready(profile: dict) -> bool:
+    """A profile is only used once enough mappings have been observed for its anchors to be trusted."""
+    return profile["observations"] >= MIN_ANCHOR_HITS
+
+
+def _label_index(template_cells: dict) -> dict:
+    """
+    Maps (row, column) of every cell that can hold a label's value to the label: the cell directly right of
+    the label (end of a merged label range) and, for checkboxes, the cell directly left of it.
+    """
+    index = {}
+    for label_id, label in template_cells.items():
+        min_col, min_row, max_col, _ = range_boundaries(label["merged_range"] or label_id)
+        index.setdefault((min_row, max_col + 1), label["value"])
+        index.setdefault((min_row, min_col - 1), label["value"])
+    return index
+
+
+def _label_for_cell(cell_id: str, label_index: dict) -> str | None:
+    """Finds the template label that a value cell belongs to."""
+    col_letters = re.match(r'[A-Z]+', cell_id).group()
+    return label_index.get((int(cell_id[len(col_letters):]), column_index_from_string(col_letters)))
+
+
+def _find_anchor(cell_id, value, label_index, key_values, tables, row_hints, col_hints) -> dict | None:
+    """Looks for a unique location in the Textract structure that holds the mapped value."""
+    kv_candidates = [location for location, kv in key_values.items() if _values_match(kv["value"], value)]
+    label = _label_for_cell(cell_id, label_index)
+    if label is not None:
+        labelled = [location for location in kv_candidates if location[0] == _normalize_text(label)]
+        kv_candidates = labelled or kv_candidates
+    if len(kv_candidates) == 1:
+        key, occurrence = kv_candidates[0]
+        return {"kind": "key_value", "key": key, "occurrence": occurrence}
+
+    table_candidates = [
+        (table_key, row_idx, col_idx)
+        for table_key, grid in tables.items()
+        for row_idx, row in enumerate(grid)
+        for col_idx, cell in enumerate(row)
+        if _values_match(cell, value)
+    ]
+    if len(table_candidates) > 1 and row_hints is not None:
+        # Repeated values (e.g. measurements) are disambiguated by the rows and columns
+        # that unambiguous cells of the same template row/column landed in
+        col_letters = re.match(r'[A-Z]+', cell_id).group()
+        template_row = int(cell_id[len(col_letters):])
+        if template_row in row_hints:
+            table_candidates = [c for c in table_candidates if (c[0], c[1]) in row_hints[template_row]]
+        if col_letters in col_hints:
+            table_candidates = [c for c in table_candidates if (c[0], c[2]) in col_hints[col_letters]]
+        else:
+            claimed = set().union(*col_hints.values()) if col_hints else set()
+            table_candidates = [c for c in table_candidates if (c[0], c[2]) not in claimed]
+    if len(table_candidates) == 1:
+        (signature, occurrence), row_idx, col_idx = table_candidates[0]
+        return {"kind": "table", "table": signature, "occurrence": occurrence, "row": row_idx, "col": col_idx}
+    return None
+
+
+def learn_template_profile(profile: dict, template_markdown: str, structure: list[dict], mapping: dict, resolved: dict | None = None) -> dict:
+    """
+    Updates a template profile from a successful Gemini mapping and saves it.
+    Existing anchors are confirmed or penalized; new anchors are learned for fields that have none.
+    Cells in resolved were filled by the profile itself and count as seen without touching their anchors.
+
+    The stored profile is re-read and updated under a file lock, so concurrent requests for the same
+    template, in any worker process, do not overwrite each other's observations; profile is updated in place to the saved state.
+    """
+    with _profile_file_lock(profile["fingerprint"]):
+        current = load_template_profile(profile["fingerprint"])
+        _merge_mapping(current, template_markdown, structure, mapping, resolved or {})
+        _write_template_profile(current)
+    profile.clear()
+    profile.update(current)
+    return profile
+
+
+def _merge_mapping(profile: dict, template_markdown: str, structure: list[dict], mapping: dict, resolved: dict) -> None:
+    label_index = _label_index(parse_excel_markdown(template_markdown))
+    key_values, tables = _index_structure(structure)
+    fields = profile["fields"]
+    profile["observations"] += 1
+    for cell_id in resolved:
+        if cell_id in fields and cell_id not in mapping:
+            fields[cell_id]["seen"] += 1
+
+    pending = []
+    for cell_id, value in mapping.items():
+        field = fields.setdefault(cell_id, {"anchor": None, "hits": 0, "misses": 0, "seen": 0})
+        field["seen"] += 1
+        field["numeric"] = _to_number(value) is not None
+        if field["anchor"]:
+            ocr_value = _read_anchor(field["anchor"], key_values, tables)
+            if ocr_value is not None and _values_match(ocr_value, value):
+                field["hits"] += 1
+                continue
+            field["misses"] += 1
+            if field["misses"] <= field["hits"]:
+                continue
+        pending.append((cell_id, value))
+
+    # First pass learns unambiguous anchors, the second uses their rows/columns as hints
+    row_hints, col_hints = {}, {}
+    for field_id, field in fields.items():
+        anchor = field["anchor"]
+        if anchor and anchor["kind"] == "table":
+            col_letters = re.match(r'[A-Z]+', field_id).group()
+            table_key = (anchor["table"], anchor["occurrence"])
+            row_hints.setdefault(int(field_id[len(col_letters):]), set()).add((table_key, anchor["row"]))
+            col_hints.setdefault(col_letters, set()).add((table_key, anchor["col"]))
+    for hints in (None, (row_hints, col_hints)):
+        still_pending = []
+        for cell_id, value in pending:
+            anchor = _find_anchor(cell_id, value, label_index, key_values, tables, *(hints or (None, None)))
+            if anchor is None:
+                still_pending.append((cell_id, value))
+                continue
+            fields[cell_id].update({"anchor": anchor, "hits": 1, "misses": 0})
+            if anchor["kind"] == "table":
+                col_letters = re.match(r'[A-Z]+', cell_id).group()
+                table_key = (anchor["table"], anchor["occurrence"])
+                row_hints.setdefault(int(cell_id[len(col_letters):]), set()).add((table_key, anchor["row"]))
+                col_hints.setdefault(col_letters, set()).add((table_key, anchor["col"]))
+        pending = still_pending
+    for cell_id, _ in pending:
+        fields[cell_id].update({"anchor": None, "hits": 0, "misses": 0})
@@ -0,0 +1,43 @@
+import time
+from PIL import Image
+
+from utils.aws_utils import get_textract_client
+from utils.gemini_utils import get_gemini_client, read_prompt_file
+
+PROMPT_FILES = (
+    'markdown-generation.md', 'markdown-generation-regions.md', 'excel-mapping.md', 'excel-mapping-direct.md', 'excel-mapping-followup.md'
+)
+
+
+def _import_sdks() -> None:
+    import boto3  # noqa: F401
+    import braintrust  # noqa: F401
+    import pyexcel  # noqa: F401
+    from google import generativeai  # noqa: F401
+    Image.init()  # registers all PIL image plugins, otherwise done by the first Image.open
+
+
+def _load_prompts() -> None:
+    for filename in PROMPT_FILES:
+        read_prompt_file(filename)
+
+
+def warm_up() -> dict:
+    """
+    Imports the lazily loaded SDKs, creates the shared Textract and Gemini clients and caches the prompts.
+    Steps that fail (e.g. missing credentials) are skipped. Returns the seconds spent per step.
+    """
+    timings = {}
+    for step, func in (
+        ("sdk_imports", _import_sdks),
+        ("textract_client", get_textract_client),
+        ("gemini_client", get_gemini_client),
+        ("prompts", _load_prompts),
+    ):
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            print(f"Warm-up step {step} skipped: {getattr(e, 'detail', None) or e}")
+        timings[step] = time.perf_counter() - start
+    return timings
@@ -0,0 +1 @@
+# Offline benchmark suite: every pipeline stage runs against recorded Textract and Gemini fixtures.
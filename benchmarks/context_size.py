@@ -0,0 +1,91 @@
+import sys
+import json
+import argparse
+
+from benchmarks import fixtures
+from utils.aws_utils import parse_textract_page, render_textract_context
+
+# Rough Gemini tokenization for English text and numbers, used when no live token count is requested
+CHARS_PER_TOKEN = 4
+
+
+def render_legacy_context(responses: list[dict]) -> tuple[str, str]:
+    """
+    The context extract_text_and_tables wrote before the compact renderer: the Text of every non-CELL
+    block (LINE and WORD blocks alike) and every table again with each cell padded to 20 characters.
+    """
+    raw_text, table_data = [], []
+    for page_num, response in enumerate(responses, start=1):
+        raw_text.append(f"\n\n=== Page {page_num} ===\n\n")
+        table_data.append(f"\n\n=== Page {page_num} ===\n\n")
+        blocks = response.get('Blocks', [])
+        raw_text.extend(block['Text'] + '\n' for block in blocks if 'Text' in block and block['BlockType'] != 'CELL')
+        tables = parse_textract_page(blocks)["tables"]
+        if tables:
+            table_data.append(f"Found {len(tables)} tables on page {page_num}\n\n")
+            for table_num, table_rows in enumerate(tables, 1):
+                table_data.append(f"Table {table_num}:\n")
+                table_data.extend(' | '.join(cell.ljust(20) for cell in row_data) + '\n' for row_data in table_rows)
+                table_data.append('\n' + '-' * 80 + '\n\n')
+    return ''.join(raw_text), ''.join(table_data)
+
+
+def render_compact_context(responses: list[dict]) -> tuple[str, str]:
+    pages = []
+    for page_num, response in enumerate(responses, start=1):
+        page = parse_textract_page(response.get('Blocks', []))
+        page["page"] = page_num
+        pages.append(page)
+    return render_textract_context(pages)
+
+
+def _count_tokens(text: str, gemini_model) -> int:
+    if gemini_model is None:
+        return round(len(text) / CHARS_PER_TOKEN)
+    return gemini_model.count_tokens(text).total_tokens
+
+
+def measure(responses: list[dict], gemini_model=None) -> dict:
+    """Characters and tokens of the legacy and compact context for the same Textract responses."""
+    results = {}
+    for name, render in (("legacy", render_legacy_context), ("compact", render_compact_context)):
+        raw_text, table_data = render(responses)
+        results[name] = {
+            "raw_text_chars": len(raw_text),
+            "table_chars": len(table_data),
+            "tokens": _count_tokens(raw_text, gemini_model) + _count_tokens(table_data, gemini_model),
+        }
+    results["token_savings"] = 1 - results["compact"]["tokens"] / results["legacy"]["tokens"]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the Gemini context size of the legacy and compact Textract renderings.")
+    parser.add_argument("--scale", type=int, default=1, help="Repeat the recorded pages this many times")
+    parser.add_argument("--count-tokens", action="store_true", help="Count tokens with the Gemini API instead of estimating them")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    responses = fixtures.scale_textract_pages(fixtures.load_textract_pages(), args.scale)
+    gemini_model = None
+    if args.count_tokens:
+        from dotenv import load_dotenv
+        from utils.gemini_utils import get_gemini_client
+        load_dotenv()
+        gemini_model = get_gemini_client()
+
+    results = measure(responses, gemini_model)
+    unit = "tokens" if gemini_model else f"tokens (~{CHARS_PER_TOKEN} chars each)"
+    print(f"{'context':<10} {'raw text chars':>15} {'table chars':>12} {unit:>26}")
+    for name in ("legacy", "compact"):
+        result = results[name]
+        print(f"{name:<10} {result['raw_text_chars']:>15} {result['table_chars']:>12} {result['tokens']:>26}")
+    print(f"Token savings: {results['token_savings'] * 100:.0f}% over {len(responses)} page(s)")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+import json
+import math
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks import fixtures
+
+
+class BackendProfile:
+    """
+    Latency and error distribution of a stand-in backend. Latency is log-normal around latency_median
+    (sigma 0 makes it constant). A share error_rate of the calls fail, throttle_share of those with a throttling error.
+    """
+
+    def __init__(self, latency_median: float = 0.0, latency_sigma: float = 0.0, error_rate: float = 0.0, throttle_share: float = 0.5):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_share = throttle_share
+
+    def sample_latency(self) -> float:
+        if self.latency_median <= 0:
+            return 0.0
+        return self.latency_median * math.exp(random.gauss(0, self.latency_sigma)) if self.latency_sigma else self.latency_median
+
+    def sample_error(self) -> str | None:
+        """Returns None, "throttle" or "server"."""
+        if random.random() >= self.error_rate:
+            return None
+        return "throttle" if random.random() < self.throttle_share else "server"
+
+
+class _BackendServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, profile: BackendProfile):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.profile = profile
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def next_call(self) -> tuple[int, str | None]:
+        error = self.profile.sample_error()
+        with self._lock:
+            self.calls += 1
+            if error:
+                self.errors += 1
+            return self.calls, error
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _send_json(self, status: int, payload) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _TextractHandler(_Handler):
+    """Speaks the Textract JSON protocol for AnalyzeDocument and replays the recorded pages in turn."""
+
+    def do_POST(self):
+        self._read_body()
+        call, error = self.server.next_call()
+        time.sleep(self.server.profile.sample_latency())
+        if self.headers.get('X-Amz-Target') != 'Textract.AnalyzeDocument':
+            self._send_json(400, {"__type": "UnknownOperationException", "Message": self.headers.get('X-Amz-Target')})
+        elif error == "throttle":
+            self._send_json(400, {"__type": "ThrottlingException", "Message": "Rate exceeded"})
+        elif error == "server":
+            self._send_json(500, {"__type": "InternalServerError", "Message": "Internal server error"})
+        else:
+            pages = self.server.pages
+            self._send_json(200, pages[(call - 1) % len(pages)])
+
+
+class _GeminiHandler(_Handler):
+    """
+    Answers generateContent and streamGenerateContent on the Gemini REST API: recorded Markdown for
+    multimodal requests and the recorded mapping for JSON-mode requests. Latency is the time to first byte.
+    """
+
+    def do_POST(self):
+        body = self._read_body()
+        _, error = self.server.next_call()
+        time.sleep(self.server.profile.sample_latency())
+        if error == "throttle":
+            self._send_json(429, {"error": {"code": 429, "message": "Resource has been exhausted", "status": "RESOURCE_EXHAUSTED"}})
+            return
+        if error == "server":
+            self._send_json(503, {"error": {"code": 503, "message": "The model is overloaded", "status": "UNAVAILABLE"}})
+            return
+
+        request = json.loads(body or b'{}')
+        config = request.get('generationConfig') or request.get('generation_config') or {}
+        is_json = (config.get('responseMimeType') or config.get('response_mime_type')) == "application/json"
+        text = self.server.mapping_text if is_json else self.server.markdown
+        # Rough 4-characters-per-token estimate, as in the offline fixtures
+        usage = {"promptTokenCount": len(body) // 4, "candidatesTokenCount": len(text) // 4}
+
+        if ':streamGenerateContent' not in self.path:
+            self._send_json(200, self._response(text, usage))
+            return
+        # The REST transport reads the stream as one JSON array of GenerateContentResponse objects
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        chunk_size = self.server.chunk_size
+        chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)] or [""]
+        self.wfile.write(b'[')
+        for i, chunk in enumerate(chunks):
+            last = i == len(chunks) - 1
+            payload = self._response(chunk, usage if last else None, finished=last)
+            self.wfile.write((json.dumps(payload) + ('' if last else ',')).encode('utf-8'))
+            self.wfile.flush()
+        self.wfile.write(b']')
+        # HTTP/1.0 responses without Content-Length end when the connection closes
+        self.close_connection = True
+
+    @staticmethod
+    def _response(text: str, usage: dict | None, finished: bool = True) -> dict:
+        candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+        if finished:
+            candidate["finishReason"] = "STOP"
+        response = {"candidates": [candidate]}
+        if usage:
+            response["usageMetadata"] = dict(usage, totalTokenCount=usage["promptTokenCount"] + usage["candidatesTokenCount"])
+        return response
+
+
+def _serve(server: _BackendServer) -> _BackendServer:
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_fake_textract(profile: BackendProfile, pages: list[dict] | None = None) -> _BackendServer:
+    """Starts the Textract stand-in on a free local port. Point AWS_TEXTRACT_ENDPOINT_URL at server.url."""
+    server = _BackendServer(_TextractHandler, profile)
+    server.pages = pages or fixtures.load_textract_pages()
+    return _serve(server)
+
+
+def start_fake_gemini(profile: BackendProfile, markdown: str | None = None, mapping_text: str | None = None, chunk_size: int = 256) -> _BackendServer:
+    """Starts the Gemini stand-in on a free local port. Point GEMINI_API_ENDPOINT at server.url."""
+    server = _BackendServer(_GeminiHandler, profile)
+    server.markdown = markdown if markdown is not None else fixtures.load_gemini_markdown()
+    server.mapping_text = mapping_text if mapping_text is not None else fixtures.mapping_to_response_text(fixtures.load_gemini_mapping())
+    server.chunk_size = chunk_size
+    return _serve(server)
@@ -0,0 +1,370 @@
+import os
+import re
+import copy
+import json
+import time
+import argparse
+from PIL import Image, ImageDraw
+from openpyxl import Workbook, load_workbook
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+TEMPLATE_PATH = os.path.join(ROOT_DIR, 'input', 'IGEG1688I.xlsx')
+SCAN_PDF_PATH = os.path.join(ROOT_DIR, 'input', 'sulzer.pdf')
+TEXTRACT_FIXTURE_PATH = os.path.join(FIXTURES_DIR, 'sulzer_textract.json')
+# Recorded Gemini outputs for input/sulzer.pdf against input/IGEG1688I.xlsx
+GEMINI_MARKDOWN_PATH = os.path.join(ROOT_DIR, 'output', 'sulzer_markdown.md')
+GEMINI_MAPPING_PATH = os.path.join(ROOT_DIR, 'test.json')
+# Per mapping mode, the Gemini responses of one run, written by `mapping_modes --live --record`
+GEMINI_RECORDING_PATTERN = os.path.join(FIXTURES_DIR, 'sulzer_gemini_{mode}.json')
+
+
+# --- Recorded responses ---
+
+def load_textract_pages() -> list[dict]:
+    """Returns the recorded analyze_document responses (one per page) for input/sulzer.pdf."""
+    with open(TEXTRACT_FIXTURE_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f)["pages"]
+
+
+def load_gemini_markdown() -> str:
+    with open(GEMINI_MARKDOWN_PATH, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def load_gemini_mapping() -> dict:
+    with open(GEMINI_MAPPING_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_gemini_recording(mode: str) -> dict | None:
+    """
+    Returns the Gemini responses recorded for a mapping mode: the scan Markdown (None in direct mode), the
+    mapping response text and the coverage follow-up response texts. None when the mode was not recorded.
+    """
+    path = GEMINI_RECORDING_PATTERN.format(mode=mode)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def mapping_to_response_text(mapping: dict) -> str:
+    """Renders a cell mapping in the structured-output format Gemini streams back."""
+    items = [
+        {"cell": cell_id, "number": value} if isinstance(value, (int, float)) else {"cell": cell_id, "text": str(value)}
+        for cell_id, value in mapping.items()
+    ]
+    return json.dumps(items)
+
+
+def scale_textract_pages(pages: list[dict], factor: int) -> list[dict]:
+    """Repeats the recorded pages factor times, with block IDs made unique per copy."""
+    scaled = []
+    for copy_index in range(factor):
+        for page in pages:
+            page_copy = copy.deepcopy(page)
+            for block in page_copy["Blocks"]:
+                block["Id"] = f"{copy_index}-{block['Id']}"
+                for relationship in block.get("Relationships", []):
+                    relationship["Ids"] = [f"{copy_index}-{block_id}" for block_id in relationship["Ids"]]
+            scaled.append(page_copy)
+    return scaled
+
+
+def scale_mapping(mapping: dict, factor: int, row_offset: int) -> dict:
+    """Repeats a cell mapping factor times, shifting rows by row_offset for every copy."""
+    scaled = {}
+    for copy_index in range(factor):
+        for cell_id, value in mapping.items():
+            col_letters = re.match(r'[A-Z]+', cell_id).group()
+            row = int(cell_id[len(col_letters):]) + copy_index * row_offset
+            scaled[f"{col_letters}{row}"] = value
+    return scaled
+
+
+# --- Stand-in clients ---
+
+class FakeTextractClient:
+    """Replays recorded analyze_document responses page by page, with optional latency per call."""
+
+    def __init__(self, pages: list[dict], latency: float = 0.0):
+        self.pages = pages
+        self.latency = latency
+        self.calls = 0
+
+    def analyze_document(self, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        page = self.pages[self.calls % len(self.pages)]
+        self.calls += 1
+        return page
+
+
+class _FakeUsage:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+
+class _FakeChunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGeminiResponse:
+    def __init__(self, text: str, prompt_chars: int, chunk_size: int):
+        self.text = text
+        self._chunk_size = chunk_size
+        # Rough 4-characters-per-token estimate, good enough for relative comparisons
+        self.usage_metadata = _FakeUsage(prompt_chars // 4, len(text) // 4)
+
+    def __iter__(self):
+        for start in range(0, len(self.text), self._chunk_size):
+            yield _FakeChunk(self.text[start:start + self._chunk_size])
+
+
+class FakeGeminiModel:
+    """
+    Replays recorded Gemini responses: the Markdown for multimodal requests and the mapping
+    for JSON-mode requests. Latency is applied once per call. With followup_texts, JSON-mode
+    requests after the first (coverage follow-ups) get those in order, then an empty mapping.
+    """
+
+    def __init__(self, markdown: str, mapping_text: str, latency: float = 0.0, chunk_size: int = 64, followup_texts: list[str] | None = None):
+        self.markdown = markdown
+        self.mapping_text = mapping_text
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.followup_texts = followup_texts
+        self.calls = 0
+        self.json_calls = 0
+        self.prompt_chars = []
+
+    def generate_content(self, contents, generation_config=None, stream=False, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        self.calls += 1
+        parts = contents if isinstance(contents, list) else [contents]
+        prompt_chars = sum(len(part) for part in parts if isinstance(part, str))
+        self.prompt_chars.append(prompt_chars)
+        is_json = generation_config is not None and getattr(generation_config, 'response_mime_type', None) == "application/json"
+        if isinstance(generation_config, dict):
+            is_json = generation_config.get("response_mime_type") == "application/json"
+        if not is_json:
+            return FakeGeminiResponse(self.markdown, prompt_chars, self.chunk_size)
+        self.json_calls += 1
+        text = self.mapping_text
+        if self.followup_texts is not None and self.json_calls > 1:
+            followups = self.followup_texts[self.json_calls - 2:]
+            text = followups[0] if followups else "[]"
+        return FakeGeminiResponse(text, prompt_chars, self.chunk_size)
+
+
+class _RecordedStream:
+    """A streamed live response that keeps the text of its chunks as they are read."""
+
+    def __init__(self, response, texts: list, index: int):
+        self._response = response
+        self._texts = texts
+        self._index = index
+
+    def __iter__(self):
+        for chunk in self._response:
+            self._texts[self._index] += chunk.text
+            yield chunk
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class RecordingGeminiModel:
+    """Passes calls on to a live model and keeps the response texts, to be saved with recording()."""
+
+    def __init__(self, gemini_model):
+        self.gemini_model = gemini_model
+        self.model_name = getattr(gemini_model, 'model_name', 'default')
+        self.markdown_texts = []
+        self.json_texts = []  # the mapping, then the coverage follow-ups
+
+    def generate_content(self, contents, generation_config=None, stream=False, **kwargs):
+        response = self.gemini_model.generate_content(contents, generation_config=generation_config, stream=stream, **kwargs)
+        is_json = getattr(generation_config, 'response_mime_type', None) == "application/json"
+        texts = self.json_texts if is_json else self.markdown_texts
+        if not stream:
+            texts.append(response.text)
+            return response
+        texts.append("")
+        return _RecordedStream(response, texts, len(texts) - 1)
+
+    def recording(self, source: str) -> dict:
+        return {
+            "source": source,
+            "markdown": '\n\n'.join(self.markdown_texts) or None,
+            "mapping": self.json_texts[0] if self.json_texts else "[]",
+            "followups": self.json_texts[1:],
+        }
+
+
+class _NullLogger:
+    def log(self, *args, **kwargs):
+        pass
+
+
+def install_offline_stubs() -> None:
+    """Keeps the Gemini helpers from reaching Braintrust while benchmarking."""
+    import utils.gemini_utils as gemini_utils
+    gemini_utils.init_logger = lambda **kwargs: _NullLogger()
+
+
+# --- Synthetic inputs ---
+
+def build_scaled_workbook(output_path: str, factor: int) -> int:
+    """
+    Writes a workbook whose Sheet1 holds factor vertical copies of the template's cells and merges.
+    Returns the row offset between copies.
+    """
+    source = load_workbook(TEMPLATE_PATH)["Sheet1"]
+    row_offset = source.max_row
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Sheet1"
+    for copy_index in range(factor):
+        shift = copy_index * row_offset
+        for row in source.iter_rows():
+            for cell in row:
+                if cell.value is not None:
+                    ws.cell(row=cell.row + shift, column=cell.column, value=cell.value)
+        for merged_range in source.merged_cells.ranges:
+            ws.merge_cells(
+                start_row=merged_range.min_row + shift, start_column=merged_range.min_col,
+                end_row=merged_range.max_row + shift, end_column=merged_range.max_col
+            )
+    wb.save(output_path)
+    return row_offset
+
+
+def build_page_image(lines: list[str], size: tuple[int, int] = (1700, 2200)) -> Image.Image:
+    """Draws text lines onto a white letter-size page at 200 dpi, roughly what pdf2image produces."""
+    image = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text((100, 100 + i * 28), line, fill='black')
+    return image
+
+
+def build_synthetic_pdf(output_path: str, pages: int) -> None:
+    """Writes a multi-page PDF with the recorded Markdown text drawn on every page."""
+    lines = [line for line in load_gemini_markdown().splitlines() if line.strip()][:70]
+    images = [build_page_image(lines) for _ in range(pages)]
+    images[0].save(output_path, format='PDF', save_all=True, append_images=images[1:], resolution=200)
+
+
+# --- Textract fixture synthesis ---
+
+def markdown_to_textract_page(markdown: str) -> dict:
+    """
+    Builds an analyze_document response (LINE/WORD, TABLE/CELL, KEY_VALUE_SET and SELECTION_ELEMENT blocks)
+    from recorded Gemini Markdown of the same document. Used when no live Textract recording is available.
+    """
+    blocks = []
+    counter = [0]
+
+    def new_block(block_type: str, top: float, left: float = 0.05, width: float = 0.5, **fields) -> dict:
+        counter[0] += 1
+        block = {
+            "Id": f"b{counter[0]}",
+            "BlockType": block_type,
+            "Confidence": 99.0,
+            "Geometry": {"BoundingBox": {"Left": left, "Top": top, "Width": width, "Height": 0.012}},
+        }
+        block.update(fields)
+        blocks.append(block)
+        return block
+
+    def add_words(text: str, top: float, left: float, width: float) -> list[str]:
+        words = text.split()
+        ids = []
+        for i, word in enumerate(words):
+            # Numbers in the recorded scan are handwritten, so they get a lower confidence
+            confidence = 82.0 if re.fullmatch(r'[\d.\-]+', word) else 99.0
+            block = new_block("WORD", top, left + width * i / max(len(words), 1), width / max(len(words), 1),
+                              Text=word, TextType="HANDWRITING" if confidence < 90 else "PRINTED")
+            block["Confidence"] = confidence
+            ids.append(block["Id"])
+        return ids
+
+    def add_line(text: str, top: float, left: float = 0.05, width: float = 0.5) -> list[str]:
+        word_ids = add_words(text, top, left, width)
+        new_block("LINE", top, left, width, Text=text, Relationships=[{"Type": "CHILD", "Ids": word_ids}])
+        return word_ids
+
+    def add_key_value(key: str, value_child_ids: list[str], top: float, left: float) -> None:
+        key_word_ids = add_words(key, top, left, 0.05)
+        value_block = new_block("KEY_VALUE_SET", top, left + 0.05, 0.1, EntityTypes=["VALUE"],
+                                Relationships=[{"Type": "CHILD", "Ids": value_child_ids}])
+        new_block("KEY_VALUE_SET", top, left, 0.05, EntityTypes=["KEY"], Relationships=[
+            {"Type": "VALUE", "Ids": [value_block["Id"]]},
+            {"Type": "CHILD", "Ids": key_word_ids},
+        ])
+
+    lines = markdown.splitlines()
+    total = max(len(lines), 1)
+    table_rows = []
+
+    def flush_table(top: float) -> None:
+        if not table_rows:
+            return
+        cell_ids = []
+        n_cols = max(len(row) for row in table_rows)
+        for row_index, row in enumerate(table_rows, start=1):
+            for col_index, text in enumerate(row, start=1):
+                left = 0.05 + 0.9 * (col_index - 1) / n_cols
+                word_ids = add_line(text, top, left, 0.9 / n_cols) if text else []
+                cell = new_block("CELL", top, left, 0.9 / n_cols, RowIndex=row_index, ColumnIndex=col_index,
+                                 RowSpan=1, ColumnSpan=1, Relationships=[{"Type": "CHILD", "Ids": word_ids}])
+                cell_ids.append(cell["Id"])
+                key_value = re.match(r'^([^:]+:)\s+(.+)$', text)
+                if key_value:
+                    key, value = key_value.groups()
+                    add_key_value(key, word_ids[len(key.split()):], top, left)
+        new_block("TABLE", top, 0.05, 0.9, Relationships=[{"Type": "CHILD", "Ids": cell_ids}])
+        table_rows.clear()
+
+    for line_index, line in enumerate(lines):
+        top = line_index / total
+        stripped = line.strip()
+        if stripped.startswith('|'):
+            cells = [cell.strip().strip('"') for cell in stripped.strip('|').split('|')]
+            if not all(re.fullmatch(r':?-*:?', cell) for cell in cells):
+                table_rows.append(cells)
+            continue
+        flush_table(top)
+        checkbox = re.match(r'^- \[( |x)\] (.+)$', stripped)
+        if checkbox:
+            selected, label = checkbox.groups()
+            selection = new_block("SELECTION_ELEMENT", top, 0.04, 0.01,
+                                  SelectionStatus="SELECTED" if selected == 'x' else "NOT_SELECTED")
+            add_line(label, top)
+            add_key_value(label, [selection["Id"]], top, 0.05)
+            continue
+        text = re.sub(r'[#*_]+', '', stripped).strip()
+        if text:
+            add_line(text, top)
+    flush_table(1.0)
+    return {"DocumentMetadata": {"Pages": 1}, "Blocks": blocks}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds the offline Textract fixture from the recorded Gemini Markdown.")
+    parser.parse_args()
+    page = markdown_to_textract_page(load_gemini_markdown())
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    with open(TEXTRACT_FIXTURE_PATH, 'w', encoding='utf-8') as f:
+        json.dump({"source": "synthesized from output/sulzer_markdown.md", "pages": [page]}, f)
+    print(f"Wrote {len(page['Blocks'])} blocks to {TEXTRACT_FIXTURE_PATH}")
+
+
+if __name__ == "__main__":
+    main()
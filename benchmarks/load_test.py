@@ -0,0 +1,285 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import httpx
+
+from benchmarks import fixtures
+from benchmarks.fake_backends import BackendProfile, start_fake_textract, start_fake_gemini
+from utils.metrics_utils import LAG_BUCKETS
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+ENDPOINTS = ("/excel-to-markdown/", "/fill-excel-with-json/", "/scan-to-markdown/", "/fill-excel-with-scan/")
+
+
+def _percentile(sorted_values: list[float], fraction: float) -> float | None:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _document_media_type(path: str) -> str:
+    return {'.pdf': 'application/pdf', '.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg'}[os.path.splitext(path)[1].lower()]
+
+
+def build_requests(template_path: str, document_path: str) -> dict:
+    """Returns the multipart payload (files, data) for every endpoint, read once so the driver does no file I/O."""
+    with open(template_path, 'rb') as f:
+        template = (os.path.basename(template_path), f.read(), XLSX_MEDIA_TYPE)
+    with open(document_path, 'rb') as f:
+        document = (os.path.basename(document_path), f.read(), _document_media_type(document_path))
+    mapping = json.dumps(fixtures.load_gemini_mapping())
+    return {
+        "/excel-to-markdown/": ({"excel_file": template}, {}),
+        "/fill-excel-with-json/": ({"excel_template": template}, {"data_json": mapping}),
+        "/scan-to-markdown/": ({"document": document}, {}),
+        "/fill-excel-with-scan/": ({"excel_template": template, "document": document}, {}),
+    }
+
+
+# --- Event-loop lag from /metrics ---
+
+_LAG_PATTERN = re.compile(r'^excel_agent_event_loop_lag_seconds_(bucket\{le="([^"]+)"\}|sum|count) (\S+)$', re.MULTILINE)
+
+
+async def read_lag_histogram(client: httpx.AsyncClient) -> dict:
+    response = await client.get("/metrics")
+    histogram = {"buckets": {}, "sum": 0.0, "count": 0}
+    for kind, bound, value in _LAG_PATTERN.findall(response.text):
+        if kind == 'sum':
+            histogram["sum"] = float(value)
+        elif kind == 'count':
+            histogram["count"] = int(float(value))
+        elif bound != '+Inf':
+            histogram["buckets"][float(bound)] = int(float(value))
+    return histogram
+
+
+def summarize_lag(before: dict, after: dict) -> dict:
+    """Mean lag and bucket upper bounds of p99 and the worst wake-up between two /metrics scrapes."""
+    count = after["count"] - before["count"]
+    if count <= 0:
+        return {"lag_mean_ms": None, "lag_p99_ms": None, "lag_max_ms": None}
+    deltas = sorted((bound, after["buckets"][bound] - before["buckets"].get(bound, 0)) for bound in after["buckets"])
+
+    def bucket_bound(rank: int) -> float | None:
+        for bound, cumulative in deltas:
+            if cumulative >= rank:
+                return bound * 1000
+        return None  # beyond the largest bucket
+
+    return {
+        "lag_mean_ms": (after["sum"] - before["sum"]) / count * 1000,
+        "lag_p99_ms": bucket_bound(max(1, round(count * 0.99))),
+        "lag_max_ms": bucket_bound(count),
+    }
+
+
+# --- Load generation ---
+
+async def run_level(client: httpx.AsyncClient, endpoint: str, payload: tuple, concurrency: int, duration: float) -> dict:
+    """Keeps concurrency requests in flight against one endpoint for duration seconds."""
+    files, data = payload
+    latencies = []
+    errors = {}
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                response = await client.post(endpoint, files=files, data=data)
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - start
+            if status == 200:
+                latencies.append(elapsed)
+            else:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+
+    lag_before = await read_lag_histogram(client)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    lag_after = await read_lag_histogram(client)
+
+    latencies.sort()
+    result = {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": len(latencies) + sum(errors.values()),
+        "errors": errors,
+        "throughput_per_s": len(latencies) / wall,
+        "p50_ms": None, "p95_ms": None, "p99_ms": None,
+    }
+    for name, fraction in (("p50_ms", 0.50), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+        value = _percentile(latencies, fraction)
+        result[name] = value * 1000 if value is not None else None
+    result.update(summarize_lag(lag_before, lag_after))
+    return result
+
+
+async def run_load_test(base_url: str, requests: dict, endpoints: list[str], levels: list[int], duration: float) -> list[dict]:
+    limits = httpx.Limits(max_connections=max(levels) + 4, max_keepalive_connections=max(levels) + 4)
+    results = []
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=limits) as client:
+        for endpoint in endpoints:
+            for concurrency in levels:
+                print(f"{endpoint} at concurrency {concurrency}...", file=sys.stderr)
+                results.append(await run_level(client, endpoint, requests[endpoint], concurrency, duration))
+    return results
+
+
+# --- App under test ---
+
+def start_app(port: int, workdir: str, textract_url: str, gemini_url: str, workers: int, template_profiles: bool) -> subprocess.Popen:
+    """Starts app/main.py under uvicorn in a subprocess, pointed at the stand-in backends."""
+    env = dict(
+        os.environ,
+        AWS_TEXTRACT_ENDPOINT_URL=textract_url,
+        AWS_ACCESS_KEY_ID="load-test",
+        AWS_SECRET_ACCESS_KEY="load-test",
+        GEMINI_API_ENDPOINT=gemini_url,
+        GEMINI_API_KEY="load-test",
+        # The stand-in has no cachedContents API
+        GEMINI_CONTEXT_CACHE="local",
+        EXCEL_AGENT_DATA_DIR=os.path.join(workdir, 'data'),
+        TEMPLATE_PROFILES_ENABLED="true" if template_profiles else "false",
+        JOB_WORKERS="0",
+        TMPDIR=workdir,
+    )
+    log = open(os.path.join(workdir, 'app.log'), 'w')
+    return subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'benchmarks.load_test_app:app', '--host', '127.0.0.1', '--port', str(port),
+         '--workers', str(workers), '--log-level', 'warning'],
+        cwd=workdir, env=dict(env, PYTHONPATH=os.pathsep.join(filter(None, [fixtures.ROOT_DIR, env.get('PYTHONPATH')]))),
+        stdout=log, stderr=subprocess.STDOUT
+    )
+
+
+def wait_until_ready(base_url: str, process: subprocess.Popen, timeout: float = 60.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited with code {process.returncode} during startup")
+        try:
+            if httpx.get(f"{base_url}/", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"App did not become ready within {timeout:.0f}s")
+
+
+# --- Report ---
+
+def saturation(results: list[dict]) -> dict:
+    """Best throughput per endpoint and the concurrency it was reached at."""
+    best = {}
+    for result in results:
+        current = best.get(result["endpoint"])
+        if current is None or result["throughput_per_s"] > current["throughput_per_s"]:
+            best[result["endpoint"]] = result
+    return {endpoint: {"throughput_per_s": r["throughput_per_s"], "concurrency": r["concurrency"]} for endpoint, r in best.items()}
+
+
+def _fmt(value: float | None, width: int, digits: int = 1) -> str:
+    return f"{value:>{width}.{digits}f}" if value is not None else f"{'-':>{width}}"
+
+
+def _fmt_lag_bound(result: dict, key: str, width: int) -> str:
+    # None with a known mean means the wake-up was later than the largest histogram bucket
+    if result[key] is None and result["lag_mean_ms"] is not None:
+        return f"{'>' + str(int(LAG_BUCKETS[-1] * 1000)):>{width}}"
+    return _fmt(result[key], width)
+
+
+def print_report(results: list[dict]) -> None:
+    print(f"{'endpoint':<24} {'conc':>5} {'reqs':>6} {'errs':>5} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'lag avg':>8} {'lag p99':>8} {'lag max':>8}")
+    for r in results:
+        print(f"{r['endpoint']:<24} {r['concurrency']:>5} {r['requests']:>6} {sum(r['errors'].values()):>5} "
+              f"{r['throughput_per_s']:>8.2f} {_fmt(r['p50_ms'], 9)} {_fmt(r['p95_ms'], 9)} {_fmt(r['p99_ms'], 9)} "
+              f"{_fmt(r['lag_mean_ms'], 8)} {_fmt_lag_bound(r, 'lag_p99_ms', 8)} {_fmt_lag_bound(r, 'lag_max_ms', 8)}")
+    print("\nEvent-loop lag is in ms; p99 and max are histogram bucket upper bounds.")
+    print("Saturation throughput:")
+    for endpoint, best in saturation(results).items():
+        print(f"  {endpoint:<24} {best['throughput_per_s']:.2f} req/s at concurrency {best['concurrency']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-tests the HTTP API against local stand-in Textract and Gemini backends.")
+    parser.add_argument("--endpoints", help="Comma-separated substrings of the endpoints to drive (default: all four)")
+    parser.add_argument("--levels", default="1,2,4,8,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per concurrency level")
+    parser.add_argument("--template", default=fixtures.TEMPLATE_PATH, help="Excel template to upload")
+    parser.add_argument("--document", help="Scan to upload (default: a synthetic one-page PNG)")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes (event-loop lag is read from whichever serves /metrics)")
+    parser.add_argument("--template-profiles", action="store_true", help="Let learned template profiles skip Gemini calls")
+    for backend, latency in (("textract", 1.0), ("gemini", 3.0)):
+        parser.add_argument(f"--{backend}-latency", type=float, default=latency, help=f"Median {backend} latency in seconds")
+        parser.add_argument(f"--{backend}-sigma", type=float, default=0.3, help=f"Log-normal sigma of the {backend} latency")
+        parser.add_argument(f"--{backend}-error-rate", type=float, default=0.0, help=f"Share of failed {backend} calls")
+        parser.add_argument(f"--{backend}-throttle-share", type=float, default=0.5, help=f"Share of {backend} failures that are throttling errors")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    endpoints = list(ENDPOINTS)
+    if args.endpoints:
+        filters = [f.strip() for f in args.endpoints.split(',') if f.strip()]
+        endpoints = [endpoint for endpoint in endpoints if any(f in endpoint for f in filters)]
+    levels = [int(level) for level in args.levels.split(',')]
+
+    textract = start_fake_textract(BackendProfile(args.textract_latency, args.textract_sigma, args.textract_error_rate, args.textract_throttle_share))
+    gemini = start_fake_gemini(BackendProfile(args.gemini_latency, args.gemini_sigma, args.gemini_error_rate, args.gemini_throttle_share))
+
+    workdir = tempfile.mkdtemp(prefix='excel-agent-load-')
+    document_path = args.document
+    if not document_path:
+        document_path = os.path.join(workdir, 'scan.png')
+        lines = [line for line in fixtures.load_gemini_markdown().splitlines() if line.strip()][:70]
+        fixtures.build_page_image(lines).save(document_path)
+
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    process = start_app(port, workdir, textract.url, gemini.url, args.workers, args.template_profiles)
+    try:
+        wait_until_ready(base_url, process)
+        results = asyncio.run(run_load_test(base_url, build_requests(args.template, document_path), endpoints, levels, args.duration))
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        textract.shutdown()
+        gemini.shutdown()
+
+    print_report(results)
+    print(f"\nBackend calls: textract {textract.calls} ({textract.errors} injected errors), "
+          f"gemini {gemini.calls} ({gemini.errors} injected errors). App log: {os.path.join(workdir, 'app.log')}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"results": results, "saturation": saturation(results)}, f, indent=2)
+    # Keep the app log for inspection, drop everything else
+    for name in os.listdir(workdir):
+        if name != 'app.log':
+            path = os.path.join(workdir, name)
+            shutil.rmtree(path, ignore_errors=True) if os.path.isdir(path) else os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+# ASGI entry point for the load test: the unchanged app from app/main.py, with Braintrust logging stubbed out.
+from benchmarks.fixtures import install_offline_stubs
+
+install_offline_stubs()
+
+from app.main import app  # noqa: E402
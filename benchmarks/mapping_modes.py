@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+from benchmarks import fixtures
+
+
+def _normalize(value):
+    """Compares numbers numerically and text without case and surrounding or repeated whitespace."""
+    try:
+        return round(float(str(value).strip()), 6)
+    except ValueError:
+        return ' '.join(str(value).split()).lower()
+
+
+def _filled_cells(template_path: str, output_path: str) -> dict:
+    """Cells whose value in the filled workbook differs from the template, i.e. what the mapping wrote."""
+    from openpyxl import load_workbook
+    template = load_workbook(template_path)["Sheet1"]
+    output = load_workbook(output_path)["Sheet1"]
+    return {
+        cell.coordinate: cell.value
+        for row in output.iter_rows() for cell in row
+        if cell.value is not None and cell.value != template[cell.coordinate].value
+    }
+
+
+def score_mapping(filled: dict, reference: dict) -> dict:
+    """Precision, recall and exact-match counts of the filled cells against the reference mapping."""
+    correct = sum(1 for cell, value in filled.items() if cell in reference and _normalize(value) == _normalize(reference[cell]))
+    return {
+        "cells": len(filled),
+        "correct": correct,
+        "precision": correct / len(filled) if filled else 0.0,
+        "recall": correct / len(reference) if reference else 0.0,
+    }
+
+
+def run_mode(mode: str, runs: int, template_path: str, doc_path: str, reference: dict | None, workdir: str) -> dict:
+    import app.fill_excel_with_scan as fill_module
+    latencies, scores = [], []
+    for run in range(runs):
+        run_dir = os.path.join(workdir, f"{mode}-{run}")
+        os.makedirs(run_dir)
+        run_template = shutil.copy(template_path, os.path.join(run_dir, 'template.xlsx'))
+        start = time.perf_counter()
+        output_path, _, _, raw_text_path, table_path, structure_path, _ = asyncio.run(fill_module.fill_excel_with_scan(
+            uuid.uuid4(), run_template, doc_path, os.path.basename(doc_path), 'template.xlsx', mode
+        ))
+        latencies.append(time.perf_counter() - start)
+        if reference is not None:
+            scores.append(score_mapping(_filled_cells(run_template, output_path), reference))
+        for path in (raw_text_path, table_path, structure_path):
+            os.remove(path)
+    latencies.sort()
+    result = {
+        "mode": mode,
+        "runs": runs,
+        "p50_s": latencies[len(latencies) // 2],
+        "mean_s": sum(latencies) / len(latencies),
+    }
+    if scores:
+        result.update({key: sum(score[key] for score in scores) / len(scores) for key in ("cells", "correct", "precision", "recall")})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the two-call (scan Markdown + mapping) and the single-call direct mapping "
+                    "for latency and accuracy, with Textract replayed from the recorded fixture."
+    )
+    parser.add_argument("--modes", default="markdown,direct", help="Comma-separated mapping modes to run")
+    parser.add_argument("--runs", type=int, default=3, help="Runs per mode")
+    parser.add_argument("--live", action="store_true",
+                        help="Use the Gemini API (GEMINI_API_KEY); otherwise every mode replays its own recorded "
+                             "Gemini responses with --gemini-latency per call. Both are scored against the reference")
+    parser.add_argument("--record", action="store_true",
+                        help="With --live, save each mode's Gemini responses as its offline recording (one run per mode)")
+    parser.add_argument("--gemini-latency", type=float, default=5.0, help="Seconds per replayed Gemini call (offline only)")
+    parser.add_argument("--textract-latency", type=float, default=0.0, help="Seconds per replayed Textract page")
+    parser.add_argument("--document", help="Scan to process (default: input/sulzer.pdf live, a rendered page image offline)")
+    parser.add_argument("--reference", default=fixtures.GEMINI_MAPPING_PATH, help="Expected mapping (cell -> value) for scoring")
+    parser.add_argument("--no-images", action="store_true", help="Direct mode without page images")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    if args.record and not args.live:
+        parser.error("--record needs --live")
+
+    workdir = tempfile.mkdtemp(prefix='excel-agent-mapping-')
+    # Every run must reach Gemini: learned template profiles would skip it after a few runs
+    os.environ["TEMPLATE_PROFILES_ENABLED"] = "false"
+    os.environ["EXCEL_AGENT_DATA_DIR"] = os.path.join(workdir, 'data')
+    os.environ["SCAN_MAPPING_DIRECT_IMAGES"] = "false" if args.no_images else "true"
+    if args.record:
+        # A provider-side context cache would bind a new model and bypass the recording wrapper
+        os.environ["GEMINI_CONTEXT_CACHE"] = "local"
+    os.chdir(workdir)  # Relative output paths land in the scratch directory
+    try:
+        import app.fill_excel_with_scan as fill_module
+        textract_pages = fixtures.load_textract_pages()
+        fill_module.get_textract_client = lambda: fixtures.FakeTextractClient(textract_pages, latency=args.textract_latency)
+
+        with open(args.reference, 'r', encoding='utf-8') as f:
+            reference = json.load(f)
+        # Cells the reference lists with a formula result such as #DIV/0! are template content, not mapped values
+        from openpyxl import load_workbook
+        template_path = fixtures.TEMPLATE_PATH
+        template = load_workbook(template_path, data_only=True)["Sheet1"]
+        reference = {cell: value for cell, value in reference.items() if template[cell].value != value}
+
+        if args.live:
+            from dotenv import load_dotenv
+            load_dotenv(os.path.join(fixtures.ROOT_DIR, '.env'))
+            doc_path = args.document or fixtures.SCAN_PDF_PATH
+            live_model = fill_module.get_gemini_client()
+        else:
+            fixtures.install_offline_stubs()
+            doc_path = args.document
+            if doc_path is None:
+                doc_path = os.path.join(workdir, 'page.png')
+                lines = [line for line in fixtures.load_gemini_markdown().splitlines() if line.strip()][:70]
+                fixtures.build_page_image(lines).save(doc_path)
+
+        results = []
+        for mode in [m.strip() for m in args.modes.split(',') if m.strip()]:
+            print(f"Running {mode} mode...", file=sys.stderr)
+            mode_reference, runs = reference, args.runs
+            if args.live and args.record:
+                model, runs = fixtures.RecordingGeminiModel(live_model), 1
+            elif args.live:
+                model = live_model
+            else:
+                recording = fixtures.load_gemini_recording(mode)
+                if recording is None:
+                    # Without a recording of its own the mode replays the reference, which says nothing about accuracy
+                    recording = {"markdown": None, "mapping": fixtures.mapping_to_response_text(fixtures.load_gemini_mapping()), "followups": None}
+                    mode_reference = None
+                model = fixtures.FakeGeminiModel(
+                    recording["markdown"] or fixtures.load_gemini_markdown(), recording["mapping"],
+                    latency=args.gemini_latency, followup_texts=recording["followups"]
+                )
+            fill_module.get_gemini_client = lambda: model
+            results.append(run_mode(mode, runs, template_path, doc_path, mode_reference, workdir))
+            if args.live and args.record:
+                recording_path = fixtures.GEMINI_RECORDING_PATTERN.format(mode=mode)
+                with open(recording_path, 'w', encoding='utf-8') as f:
+                    json.dump(model.recording(f"recorded from {os.path.basename(doc_path)} in {mode} mode"), f, indent=2)
+                print(f"Wrote {recording_path}", file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'mode':<10} {'runs':>5} {'p50 s':>8} {'mean s':>8} {'cells':>7} {'precision':>10} {'recall':>8}")
+    for result in results:
+        accuracy = (f"{result['cells']:>7.0f} {result['precision']:>10.1%} {result['recall']:>8.1%}"
+                    if "precision" in result else f"{'n/a (mode not recorded)':>27}")
+        print(f"{result['mode']:<10} {result['runs']:>5} {result['p50_s']:>8.2f} {result['mean_s']:>8.2f} {accuracy}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
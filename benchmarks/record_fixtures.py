@@ -0,0 +1,39 @@
+import os
+import json
+import argparse
+from pdf2image import convert_from_path
+import io
+from dotenv import load_dotenv
+
+from benchmarks.fixtures import SCAN_PDF_PATH, TEXTRACT_FIXTURE_PATH
+from utils.aws_utils import get_textract_client
+
+
+def main():
+    """Records live analyze_document responses for input/sulzer.pdf (needs AWS credentials in .env)."""
+    parser = argparse.ArgumentParser(description="Records Textract responses used by the offline benchmarks.")
+    parser.add_argument("--document", default=SCAN_PDF_PATH, help="PDF to record")
+    parser.add_argument("--output", default=TEXTRACT_FIXTURE_PATH, help="Fixture file to write")
+    args = parser.parse_args()
+    load_dotenv()
+
+    client = get_textract_client()
+    pages = []
+    for page_num, image in enumerate(convert_from_path(args.document), start=1):
+        img_byte_arr = io.BytesIO()
+        image.save(img_byte_arr, format='PNG')
+        response = client.analyze_document(
+            Document={'Bytes': img_byte_arr.getvalue()},
+            FeatureTypes=["TABLES", "FORMS", "SIGNATURES"]
+        )
+        response.pop('ResponseMetadata', None)
+        pages.append(response)
+        print(f"Recorded page {page_num}: {len(response.get('Blocks', []))} blocks")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({"source": f"recorded from {os.path.basename(args.document)}", "pages": pages}, f)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
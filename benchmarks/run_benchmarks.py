@@ -0,0 +1,320 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import traceback
+import subprocess
+import multiprocessing
+
+from benchmarks import fixtures
+
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+BENCHMARKS = {}  # name -> setup function returning the callable to time
+
+
+class BenchmarkSkipped(Exception):
+    """Raised from a benchmark setup when the stage cannot run in this environment."""
+
+
+def benchmark(name: str):
+    """Registers a benchmark. The decorated function does the untimed setup and returns the callable to time."""
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+
+def _textract_outputs(doc_path: str, pages: list[dict]) -> tuple[str, str, str]:
+    from utils.aws_utils import extract_text_and_tables
+    return extract_text_and_tables(lambda: fixtures.FakeTextractClient(pages), doc_path)
+
+
+def _write_page_image(workdir: str) -> str:
+    path = os.path.join(workdir, 'page.png')
+    lines = [line for line in fixtures.load_gemini_markdown().splitlines() if line.strip()][:70]
+    fixtures.build_page_image(lines).save(path)
+    return path
+
+
+def _require_poppler() -> None:
+    if shutil.which('pdftoppm') is None:
+        raise BenchmarkSkipped("poppler (pdftoppm) is not installed")
+
+
+# --- Stages ---
+
+@benchmark("xls_conversion")
+def bench_xls_conversion(workdir: str):
+    import pyexcel
+    from utils.file_utils import convert_xls_to_xlsx
+    xls_path = os.path.join(workdir, 'template.xls')
+    try:
+        pyexcel.save_book_as(file_name=fixtures.TEMPLATE_PATH, dest_file_name=xls_path)
+    except Exception as e:
+        raise BenchmarkSkipped(f"cannot write .xls fixtures here: {e}")
+    return lambda: convert_xls_to_xlsx(xls_path)
+
+
+@benchmark("excel_to_markdown[IGEG1688I]")
+def bench_excel_to_markdown(workdir: str):
+    from app.excel_to_markdown import convert_excel_to_markdown
+    return lambda: convert_excel_to_markdown(fixtures.TEMPLATE_PATH)
+
+
+@benchmark("excel_to_markdown[x10]")
+def bench_excel_to_markdown_scaled(workdir: str):
+    from app.excel_to_markdown import convert_excel_to_markdown
+    path = os.path.join(workdir, 'scaled.xlsx')
+    fixtures.build_scaled_workbook(path, 10)
+    return lambda: convert_excel_to_markdown(path)
+
+
+@benchmark("rasterization[sulzer.pdf]")
+def bench_rasterization(workdir: str):
+    _require_poppler()
+    from pdf2image import convert_from_path
+    return lambda: convert_from_path(fixtures.SCAN_PDF_PATH)
+
+
+@benchmark("rasterization[x10 pages]")
+def bench_rasterization_scaled(workdir: str):
+    _require_poppler()
+    from pdf2image import convert_from_path
+    path = os.path.join(workdir, 'scaled.pdf')
+    fixtures.build_synthetic_pdf(path, 10)
+    return lambda: convert_from_path(path)
+
+
+@benchmark("textract_parsing[sulzer]")
+def bench_textract_parsing(workdir: str):
+    from utils.aws_utils import parse_textract_page
+    pages = fixtures.load_textract_pages()
+    return lambda: [parse_textract_page(page["Blocks"]) for page in pages]
+
+
+@benchmark("textract_parsing[x20 pages]")
+def bench_textract_parsing_scaled(workdir: str):
+    from utils.aws_utils import parse_textract_page
+    pages = fixtures.scale_textract_pages(fixtures.load_textract_pages(), 20)
+    return lambda: [parse_textract_page(page["Blocks"]) for page in pages]
+
+
+@benchmark("extract_text_and_tables[png]")
+def bench_extract_text_and_tables(workdir: str):
+    from utils.file_utils import cleanup_files
+    doc_path = _write_page_image(workdir)
+    pages = fixtures.load_textract_pages()
+    return lambda: cleanup_files(*_textract_outputs(doc_path, pages))
+
+
+@benchmark("markdown_prompt_assembly[png]")
+def bench_markdown_prompt(workdir: str):
+    from utils.gemini_utils import generate_markdown_from_scan
+    doc_path = _write_page_image(workdir)
+    raw_text_path, table_path, _ = _textract_outputs(doc_path, fixtures.load_textract_pages())
+    model = fixtures.FakeGeminiModel(fixtures.load_gemini_markdown(), "[]")
+    return lambda: generate_markdown_from_scan(model, doc_path, raw_text_path, table_path)
+
+
+@benchmark("mapping_prompt_and_stream")
+def bench_mapping_call(workdir: str):
+    from app.excel_to_markdown import convert_excel_to_markdown
+    from utils.gemini_utils import generate_excel_mapping_from_markdown
+    _, template_markdown = convert_excel_to_markdown(fixtures.TEMPLATE_PATH)
+    model = fixtures.FakeGeminiModel("", fixtures.mapping_to_response_text(fixtures.load_gemini_mapping()))
+    scan_markdown = fixtures.load_gemini_markdown()
+    return lambda: generate_excel_mapping_from_markdown(model, template_markdown, scan_markdown)
+
+
+@benchmark("mapping_parsing[recorded]")
+def bench_mapping_parsing(workdir: str):
+    from utils.json_stream_utils import IncrementalMappingParser
+    text = fixtures.mapping_to_response_text(fixtures.load_gemini_mapping())
+    chunks = [text[i:i + 64] for i in range(0, len(text), 64)]
+
+    def run():
+        parser = IncrementalMappingParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+    return run
+
+
+@benchmark("mapping_parsing[x10]")
+def bench_mapping_parsing_scaled(workdir: str):
+    from utils.json_stream_utils import IncrementalMappingParser
+    text = fixtures.mapping_to_response_text(fixtures.scale_mapping(fixtures.load_gemini_mapping(), 10, 100))
+    chunks = [text[i:i + 64] for i in range(0, len(text), 64)]
+
+    def run():
+        parser = IncrementalMappingParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+    return run
+
+
+@benchmark("fill_excel_template[IGEG1688I]")
+def bench_fill(workdir: str):
+    from app.fill_excel_with_json import fill_excel_template
+    mapping = fixtures.load_gemini_mapping()
+    output_path = os.path.join(workdir, 'filled.xlsx')
+    return lambda: fill_excel_template(fixtures.TEMPLATE_PATH, output_path, mapping)
+
+
+@benchmark("fill_excel_template[x10]")
+def bench_fill_scaled(workdir: str):
+    from app.fill_excel_with_json import fill_excel_template
+    path = os.path.join(workdir, 'scaled.xlsx')
+    row_offset = fixtures.build_scaled_workbook(path, 10)
+    mapping = fixtures.scale_mapping(fixtures.load_gemini_mapping(), 10, row_offset)
+    output_path = os.path.join(workdir, 'filled.xlsx')
+    return lambda: fill_excel_template(path, output_path, mapping)
+
+
+def _cold_start(code: str):
+    # A fresh interpreter per iteration; dummy credentials let the warm-up create both clients without network calls
+    env = dict(os.environ, AWS_ACCESS_KEY_ID="bench", AWS_SECRET_ACCESS_KEY="bench", GEMINI_API_KEY="bench")
+    return lambda: subprocess.run([sys.executable, '-c', code], cwd=fixtures.ROOT_DIR, env=env, check=True, capture_output=True)
+
+
+@benchmark("cold_start[import app.main]")
+def bench_cold_start_import(workdir: str):
+    return _cold_start("import app.main")
+
+
+@benchmark("cold_start[import + warm_up]")
+def bench_cold_start_warm_up(workdir: str):
+    return _cold_start("import app.main; from app.warmup import warm_up; warm_up()")
+
+
+# --- Runner ---
+
+def _percentile(sorted_values: list[float], fraction: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _run_in_subprocess(name: str, iterations: int, min_seconds: float, result_queue) -> None:
+    """Runs one benchmark in a fresh process so that peak RSS is attributable to that stage alone."""
+    workdir = tempfile.mkdtemp(prefix='excel-agent-bench-')
+    # Stage output and temp files land in the scratch directory
+    os.chdir(workdir)
+    tempfile.tempdir = workdir
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        fixtures.install_offline_stubs()
+        run = BENCHMARKS[name](workdir)
+        run()  # warm-up
+        latencies = []
+        started = time.perf_counter()
+        while len(latencies) < iterations or time.perf_counter() - started < min_seconds:
+            start = time.perf_counter()
+            run()
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        result_queue.put({
+            "name": name,
+            "iterations": len(latencies),
+            "throughput_per_s": len(latencies) / sum(latencies),
+            "p50_ms": _percentile(latencies, 0.50) * 1000,
+            "p95_ms": _percentile(latencies, 0.95) * 1000,
+            "p99_ms": _percentile(latencies, 0.99) * 1000,
+            # ru_maxrss is reported in kilobytes on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        })
+    except BenchmarkSkipped as e:
+        result_queue.put({"name": name, "skipped": str(e)})
+    except Exception as e:
+        result_queue.put({"name": name, "error": f"{e}\n{traceback.format_exc()}"})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_benchmark(name: str, iterations: int, min_seconds: float) -> dict:
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    process = context.Process(target=_run_in_subprocess, args=(name, iterations, min_seconds, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    return result
+
+
+def compare_to_baseline(results: list[dict], baseline: dict, threshold: float) -> list[str]:
+    """Returns a message for every stage whose p50 latency or peak RSS grew beyond the threshold."""
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["name"])
+        if not previous or "p50_ms" not in result or "p50_ms" not in previous:
+            continue
+        for metric in ("p50_ms", "peak_rss_mb"):
+            if result[metric] > previous[metric] * (1 + threshold):
+                regressions.append(
+                    f"{result['name']}: {metric} {result[metric]:.2f} vs baseline {previous[metric]:.2f} "
+                    f"(+{(result[metric] / previous[metric] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def print_report(results: list[dict]) -> None:
+    print(f"{'stage':<36} {'iters':>6} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'RSS MB':>8}")
+    for result in results:
+        if "skipped" in result:
+            print(f"{result['name']:<36} skipped: {result['skipped']}")
+        elif "error" in result:
+            print(f"{result['name']:<36} ERROR: {result['error'].splitlines()[0]}")
+        else:
+            print(f"{result['name']:<36} {result['iterations']:>6} {result['throughput_per_s']:>9.1f} "
+                  f"{result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['peak_rss_mb']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the offline stage benchmarks.")
+    parser.add_argument("--only", help="Comma-separated substrings of benchmark names to run")
+    parser.add_argument("--iterations", type=int, default=10, help="Minimum timed iterations per stage")
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="Minimum timed duration per stage")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="Baseline results file")
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed relative regression (0.25 = 25%%)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    names = list(BENCHMARKS)
+    if args.only:
+        filters = [f.strip() for f in args.only.split(',') if f.strip()]
+        names = [name for name in names if any(f in name for f in filters)]
+
+    results = []
+    for name in names:
+        print(f"Running {name}...", file=sys.stderr)
+        results.append(run_benchmark(name, args.iterations, args.min_seconds))
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({r["name"]: r for r in results if "p50_ms" in r}, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    exit_code = 1 if any("error" in r for r in results) else 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_to_baseline(results, json.load(f), args.threshold)
+        if regressions:
+            print("\nRegressions beyond threshold:")
+            for message in regressions:
+                print(f"  {message}")
+            exit_code = 1
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
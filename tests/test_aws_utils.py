@@ -0,0 +1,46 @@
+from benchmarks import fixtures
+from utils import aws_utils
+from utils.file_utils import cleanup_files
+
+
+def _client_factory(created: list, pages=None):
+    def get_client():
+        if pages is None:
+            raise AssertionError("Textract client created for a digital PDF")
+        created.append(None)
+        return fixtures.FakeTextractClient(pages)
+    return get_client
+
+
+def _read(path: str) -> str:
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def test_digital_pdf_is_read_without_the_textract_client_or_quota(monkeypatch, tmp_path):
+    monkeypatch.setattr(aws_utils, "read_pdf_text_layer", lambda doc_path: ["Job No:    4711\nCustomer:  ACME Corporation Ltd"])
+    admitted = []
+    monkeypatch.setattr(aws_utils, "check_admission", lambda *upstreams: admitted.extend(upstreams))
+
+    paths = aws_utils.extract_text_and_tables(_client_factory([]), str(tmp_path / "digital.pdf"))
+    try:
+        assert "ACME Corporation" in _read(paths[0]) + _read(paths[1]) + _read(paths[2])
+    finally:
+        cleanup_files(*paths)
+    assert admitted == []
+
+
+def test_scan_checks_the_quota_and_creates_the_textract_client(monkeypatch, tmp_path):
+    admitted = []
+    monkeypatch.setattr(aws_utils, "check_admission", lambda *upstreams: admitted.extend(upstreams))
+    doc_path = str(tmp_path / "scan.png")
+    fixtures.build_page_image(["Job No: 4711", "Customer: ACME Corporation Ltd"]).save(doc_path)
+    created = []
+
+    paths = aws_utils.extract_text_and_tables(_client_factory(created, fixtures.load_textract_pages()), doc_path)
+    try:
+        assert [page["page"] for page in aws_utils.read_textract_structure(paths[2])] == [1]
+    finally:
+        cleanup_files(*paths)
+    assert admitted == ["textract"]
+    assert created == [None]
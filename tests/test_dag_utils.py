@@ -0,0 +1,43 @@
+import time
+import asyncio
+
+import pytest
+
+from utils.dag_utils import StageDAG
+
+
+def test_failed_stage_waits_for_running_thread_stages_and_cleans_them_up():
+    cleaned = []
+
+    def slow_stage():
+        time.sleep(0.3)
+        return "slow result"
+
+    def failing_stage():
+        time.sleep(0.05)
+        raise RuntimeError("stage failed")
+
+    dag = StageDAG("test", "test")
+    dag.add("slow", slow_stage, cleanup=cleaned.append)
+    dag.add("failing", failing_stage)
+    dag.add("after", lambda slow, failing: None, deps=("slow", "failing"), cleanup=cleaned.append)
+
+    with pytest.raises(RuntimeError, match="stage failed"):
+        asyncio.run(dag.run())
+    assert cleaned == ["slow result"]
+
+
+def test_finished_stages_are_cleaned_up_in_reverse_order():
+    cleaned = []
+
+    def failing_stage(first):
+        raise RuntimeError("stage failed")
+
+    dag = StageDAG("test", "test")
+    dag.add("first", lambda: "first result", cleanup=cleaned.append)
+    dag.add("second", lambda first: "second result", deps=("first",), cleanup=cleaned.append)
+    dag.add("failing", failing_stage, deps=("second",))
+
+    with pytest.raises(RuntimeError, match="stage failed"):
+        asyncio.run(dag.run())
+    assert cleaned == ["second result", "first result"]
@@ -0,0 +1,89 @@
+import time
+import threading
+
+import pytest
+
+from utils import deadline_utils
+from utils.deadline_utils import (
+    DeadlineExceeded, call_hedged, get_hedge_policy, reset_request_deadline, run_with_deadline, stage_deadline,
+    start_request_deadline
+)
+
+
+@pytest.fixture
+def hedging(monkeypatch):
+    monkeypatch.setattr(deadline_utils, "GEMINI_HEDGE_ENABLED", True)
+    monkeypatch.setattr(deadline_utils, "GEMINI_HEDGE_MAX_RATE", 1.0)
+    monkeypatch.setattr(deadline_utils, "_hedge_policies", {})
+
+
+def _warm_up(stage: str, latency: float) -> None:
+    policy = get_hedge_policy(stage)
+    for _ in range(deadline_utils.GEMINI_HEDGE_MIN_SAMPLES):
+        policy.record(latency)
+
+
+def test_run_with_deadline_calls_on_the_callers_thread():
+    token = start_request_deadline(10)
+    try:
+        with stage_deadline("textract"):
+            assert run_with_deadline(threading.get_ident) == threading.get_ident()
+    finally:
+        reset_request_deadline(token)
+
+
+def test_sdk_timeout_after_the_deadline_is_answered_as_deadline_exceeded(monkeypatch):
+    monkeypatch.setitem(deadline_utils.STAGE_DEADLINE_SHARES, "textract", 0.5)
+
+    def timed_out_call():
+        time.sleep(0.1)
+        raise TimeoutError("read timeout")
+
+    token = start_request_deadline(0.1)
+    try:
+        with stage_deadline("textract"), pytest.raises(DeadlineExceeded):
+            run_with_deadline(timed_out_call)
+    finally:
+        reset_request_deadline(token)
+
+
+def test_calls_are_not_hedged_before_the_latency_percentile_is_known(hedging):
+    assert call_hedged("gemini_test", threading.get_ident) == threading.get_ident()
+
+
+def test_hedged_call_uses_the_faster_answer_and_discards_the_slower_one(hedging):
+    _warm_up("gemini_test", 0.05)
+    calls = []
+    discarded = []
+    released = threading.Event()
+
+    def call():
+        calls.append(None)
+        # The first call is the slow primary, the hedged duplicate answers at once
+        if len(calls) == 1:
+            time.sleep(0.3)
+            return "primary"
+        return "hedge"
+
+    def discard(result):
+        discarded.append(result)
+        released.set()
+
+    assert call_hedged("gemini_test", call, discard=discard) == "hedge"
+    assert released.wait(2)
+    assert discarded == ["primary"]
+
+
+def test_calls_are_not_hedged_while_all_workers_are_busy(hedging, monkeypatch):
+    _warm_up("gemini_test", 0.05)
+    monkeypatch.setattr(deadline_utils, "_hedge_slots", threading.BoundedSemaphore(1))
+    calls = []
+
+    def call():
+        calls.append(threading.get_ident())
+        time.sleep(0.15)
+        return "primary"
+
+    assert call_hedged("gemini_test", call) == "primary"
+    assert len(calls) == 1
+    assert calls[0] != threading.get_ident()
@@ -0,0 +1,39 @@
+import datetime
+
+from openpyxl import Workbook
+
+from app.excel_to_json import convert_excel_to_json
+
+
+def _convert(tmp_path, cells: dict[str, tuple[object, str]]) -> dict[str, tuple[str, object]]:
+    wb = Workbook()
+    ws = wb.active
+    for cell_id, (value, number_format) in cells.items():
+        ws[cell_id] = value
+        ws[cell_id].number_format = number_format
+    path = str(tmp_path / "dates.xlsx")
+    wb.save(path)
+
+    success, result = convert_excel_to_json(path)
+    assert success, result
+    sheet_cells = result["sheets"][0]["cells"]
+    return {ref: (value_type, value) for ref, value_type, value in zip(sheet_cells["ref"], sheet_cells["type"], sheet_cells["value"])}
+
+
+def test_date_formats_without_a_time_part_are_dates(tmp_path):
+    moment = datetime.datetime(2024, 3, 15, 0, 0)
+    cells = _convert(tmp_path, {
+        "A1": (moment, "yyyy-mm-dd"),
+        "A2": (moment, "[$-409]d-mmm-yy;@"),
+        "A3": (moment, 'dd"th of "mmmm'),
+        "A4": (moment.replace(hour=9, minute=30), "yyyy-mm-dd hh:mm"),
+        "A5": (moment.replace(hour=9, minute=30), "m/d/yy h:mm AM/PM"),
+        "A6": (42, "0.00"),
+    })
+
+    assert cells["A1"] == ("date", "2024-03-15")
+    assert cells["A2"] == ("date", "2024-03-15")
+    assert cells["A3"] == ("date", "2024-03-15")
+    assert cells["A4"] == ("datetime", "2024-03-15T09:30:00")
+    assert cells["A5"] == ("datetime", "2024-03-15T09:30:00")
+    assert cells["A6"] == ("number", 42)
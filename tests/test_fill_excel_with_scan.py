@@ -0,0 +1,84 @@
+import io
+import json
+import asyncio
+import shutil
+import uuid
+import zipfile
+
+from openpyxl import load_workbook
+
+import app.batch as batch_module
+import app.fill_excel_with_json as fill_json_module
+import app.fill_excel_with_scan as fill_module
+import utils.gemini_utils as gemini_utils
+from benchmarks import fixtures
+from utils.file_utils import cleanup_files
+
+
+def test_scan_fill_stores_recalculated_formula_values(tmp_path, monkeypatch):
+    monkeypatch.setenv("EXCEL_AGENT_DATA_DIR", str(tmp_path / "data"))
+    monkeypatch.setattr(fill_json_module, "FORMULA_RECALC_ENABLED", True)
+    monkeypatch.setattr(fill_module, "TEMPLATE_PROFILES_ENABLED", False)
+    monkeypatch.setattr(gemini_utils, "init_logger", lambda **kwargs: fixtures._NullLogger())
+    textract_pages = fixtures.load_textract_pages()
+    monkeypatch.setattr(fill_module, "get_textract_client", lambda: fixtures.FakeTextractClient(textract_pages))
+    model = fixtures.FakeGeminiModel(fixtures.load_gemini_markdown(), fixtures.mapping_to_response_text(fixtures.load_gemini_mapping()))
+    monkeypatch.setattr(fill_module, "get_gemini_client", lambda: model)
+
+    template_path = tmp_path / "template.xlsx"
+    shutil.copyfile(fixtures.TEMPLATE_PATH, template_path)
+    doc_path = tmp_path / "page.png"
+    lines = [line for line in fixtures.load_gemini_markdown().splitlines() if line.strip()][:70]
+    fixtures.build_page_image(lines).save(doc_path)
+
+    output_path, *temp_paths, _ = asyncio.run(fill_module.fill_excel_with_scan(
+        uuid.uuid4(), str(template_path), str(doc_path), "page.png", "template.xlsx", mapping_mode="direct"
+    ))
+    try:
+        filled = load_workbook(output_path)["Sheet1"]
+        cached = load_workbook(output_path, data_only=True)["Sheet1"]
+        assert filled["AJ20"].value == "=AVERAGE(D20:AI20)"
+        assert isinstance(cached["AJ20"].value, (int, float))
+    finally:
+        cleanup_files(output_path, *temp_paths[2:])
+
+
+def test_batch_fills_documents_like_the_single_scan_pipeline(tmp_path, monkeypatch):
+    monkeypatch.setenv("EXCEL_AGENT_DATA_DIR", str(tmp_path / "data"))
+    monkeypatch.setattr(fill_json_module, "FORMULA_RECALC_ENABLED", False)
+    monkeypatch.setattr(fill_module, "TEMPLATE_PROFILES_ENABLED", False)
+    monkeypatch.setattr(batch_module, "SCAN_MAPPING_MODE", "markdown")
+    monkeypatch.setattr(gemini_utils, "init_logger", lambda **kwargs: fixtures._NullLogger())
+    textract_pages = fixtures.load_textract_pages()
+    monkeypatch.setattr(fill_module, "get_textract_client", lambda: fixtures.FakeTextractClient(textract_pages))
+    model = fixtures.FakeGeminiModel(fixtures.load_gemini_markdown(), fixtures.mapping_to_response_text(fixtures.load_gemini_mapping()))
+    monkeypatch.setattr(fill_module, "get_gemini_client", lambda: model)
+
+    template_path = tmp_path / "template.xlsx"
+    shutil.copyfile(fixtures.TEMPLATE_PATH, template_path)
+    doc_path = tmp_path / "page.png"
+    lines = [line for line in fixtures.load_gemini_markdown().splitlines() if line.strip()][:70]
+    fixtures.build_page_image(lines).save(doc_path)
+
+    output_path, *temp_paths, _ = asyncio.run(fill_module.fill_excel_with_scan(
+        uuid.uuid4(), str(template_path), str(doc_path), "page.png", "template.xlsx", mapping_mode="markdown"
+    ))
+    try:
+        single = {cell.coordinate: cell.value for row in load_workbook(output_path)["Sheet1"].iter_rows() for cell in row}
+    finally:
+        cleanup_files(output_path, *temp_paths[2:])
+
+    async def run_batch():
+        excel_markdown, profile, template_flags = batch_module.prepare_batch_template("batch", str(template_path))
+        documents = [{"filename": "page.png", "path": str(doc_path)}, {"filename": "notes.txt", "error": "Invalid document file type '.txt'"}]
+        return b''.join([chunk async for chunk in batch_module.stream_batch_zip(
+            "batch", str(template_path), excel_markdown, profile, template_flags, documents, []
+        )])
+
+    with zipfile.ZipFile(io.BytesIO(asyncio.run(run_batch()))) as archive:
+        manifest = json.loads(archive.read("manifest.json"))
+        assert [result["status"] for result in manifest["results"]] == ["succeeded", "rejected"]
+        with archive.open(manifest["results"][0]["output"]) as output:
+            batch = {cell.coordinate: cell.value for row in load_workbook(output)["Sheet1"].iter_rows() for cell in row}
+    assert manifest["results"][0]["cells"] > 0
+    assert batch == single
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+from fastapi.responses import StreamingResponse
+from starlette.requests import Request
+
+import app.idempotency as idempotency
+import app.main as main
+from app.idempotency import load_idempotent_response, store_idempotent_response, request_fingerprint
+
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("EXCEL_AGENT_DATA_DIR", str(tmp_path / "data"))
+
+
+def _store(key: str, body: bytes = b"body", fingerprint: str = "fp"):
+    store_idempotent_response("/route/", key, fingerprint, 200, {
+        "content-type": "text/plain", "ETag": '"abc"', "X-Page-Filter": "1=kept;score=1.00",
+        "transfer-encoding": "chunked", "connection": "keep-alive"
+    }, body)
+
+
+def test_stored_responses_are_replayed_with_their_headers():
+    _store("key")
+    stored = load_idempotent_response("/route/", "key")
+    assert stored["body"] == b"body"
+    assert stored["fingerprint"] == "fp"
+    assert stored["headers"] == {"content-type": "text/plain", "ETag": '"abc"', "X-Page-Filter": "1=kept;score=1.00"}
+    assert load_idempotent_response("/other-route/", "key") is None
+
+
+def test_expired_responses_are_dropped(monkeypatch):
+    _store("key")
+    now = idempotency.time.time()
+    monkeypatch.setattr(idempotency.time, "time", lambda: now + idempotency.IDEMPOTENCY_TTL_SECONDS + 1)
+    assert load_idempotent_response("/route/", "key") is None
+
+
+def test_oldest_responses_are_evicted_beyond_the_size_cap(monkeypatch):
+    monkeypatch.setattr(idempotency, "IDEMPOTENCY_STORE_MAX_BYTES", 25)
+    clock = iter(range(1000, 2000))
+    monkeypatch.setattr(idempotency.time, "time", lambda: next(clock))
+    for key in ("first", "second", "third"):
+        _store(key, body=b"x" * 10)
+    assert load_idempotent_response("/route/", "first") is None
+    assert load_idempotent_response("/route/", "second") is not None
+    assert load_idempotent_response("/route/", "third") is not None
+
+
+def test_fingerprint_ignores_the_multipart_boundary_but_not_the_body():
+    def multipart(boundary: str, content: bytes) -> tuple[str, bytes]:
+        return f"multipart/form-data; boundary={boundary}", b"--" + boundary.encode() + b"\r\n" + content + b"\r\n--" + boundary.encode() + b"--\r\n"
+
+    first = request_fingerprint("POST", "/route/", *multipart("aaa111", b"upload"))
+    assert first == request_fingerprint("POST", "/route/", *multipart("bbb222", b"upload"))
+    assert first != request_fingerprint("POST", "/route/", *multipart("aaa111", b"other upload"))
+    assert first != request_fingerprint("POST", "/other-route/", *multipart("aaa111", b"upload"))
+
+
+def _request(body: bytes, key: str = "key") -> Request:
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    scope = {
+        "type": "http", "method": "POST", "path": "/route/", "raw_path": b"/route/", "query_string": b"",
+        "headers": [(b"idempotency-key", key.encode()), (b"content-type", b"application/octet-stream")],
+    }
+    return Request(scope, receive)
+
+
+def test_middleware_replays_and_rejects_a_reused_key():
+    calls = []
+
+    async def call_next(request):
+        # Like Starlette's call_next, the route's response is streamed back to the middleware
+        calls.append(1)
+        return StreamingResponse(iter([b"fil", b"led"]), headers={"ETag": '"v1"'})
+
+    async def scenario():
+        first = await main.replay_idempotent_requests(_request(b"upload"), call_next)
+        retry = await main.replay_idempotent_requests(_request(b"upload"), call_next)
+        other = await main.replay_idempotent_requests(_request(b"different upload"), call_next)
+        return first, retry, other
+
+    first, retry, other = asyncio.run(scenario())
+    assert calls == [1]
+    assert retry.body == first.body == b"filled"
+    assert retry.headers["etag"] == '"v1"'
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert other.status_code == 422
+
+
+def test_retry_waiting_on_a_disconnected_first_attempt_still_gets_its_result():
+    async def call_next(request):
+        await asyncio.sleep(0.1)
+        return StreamingResponse(iter([b"filled"]))
+
+    async def scenario():
+        first = asyncio.ensure_future(main.replay_idempotent_requests(_request(b"upload"), call_next))
+        await asyncio.sleep(0.02)
+        retry = asyncio.ensure_future(main.replay_idempotent_requests(_request(b"upload"), call_next))
+        await asyncio.sleep(0.02)
+        first.cancel()  # the first client timed out and disconnected
+        return await retry
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert response.body == b"filled"
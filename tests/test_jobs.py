@@ -0,0 +1,79 @@
+import time
+import asyncio
+
+import app.jobs as jobs
+
+
+def _enqueue(tmp_path, monkeypatch, name: str, page_count: int) -> str:
+    monkeypatch.setattr(jobs, "count_document_pages", lambda path: page_count)
+    template_path, document_path = tmp_path / f"{name}.xlsx", tmp_path / f"{name}.pdf"
+    template_path.write_bytes(b"")
+    document_path.write_bytes(b"")
+    return jobs.enqueue_job(str(template_path), str(document_path), template_path.name, document_path.name)["id"]
+
+
+def test_general_workers_claim_small_lane_jobs_first(tmp_path, monkeypatch):
+    monkeypatch.setenv("EXCEL_AGENT_DATA_DIR", str(tmp_path / "data"))
+    jobs.init_job_store()
+    large_id = _enqueue(tmp_path, monkeypatch, "large", page_count=jobs.SMALL_JOB_MAX_PAGES + 5)
+    small_id = _enqueue(tmp_path, monkeypatch, "small", page_count=1)
+
+    assert jobs._claim_next_job(small_lane_only=False)["id"] == small_id
+    assert jobs._claim_next_job(small_lane_only=False)["id"] == large_id
+    assert jobs._claim_next_job(small_lane_only=False) is None
+
+
+def test_small_lane_workers_never_claim_large_jobs(tmp_path, monkeypatch):
+    monkeypatch.setenv("EXCEL_AGENT_DATA_DIR", str(tmp_path / "data"))
+    jobs.init_job_store()
+    _enqueue(tmp_path, monkeypatch, "large", page_count=jobs.SMALL_JOB_MAX_PAGES + 5)
+
+    assert jobs._claim_next_job(small_lane_only=True) is None
+
+
+def test_enqueue_from_a_worker_thread_wakes_idle_workers_right_away(tmp_path, monkeypatch):
+    monkeypatch.setenv("EXCEL_AGENT_DATA_DIR", str(tmp_path / "data"))
+    jobs.init_job_store()
+
+    async def scenario():
+        monkeypatch.setattr(jobs, "_job_available", asyncio.Event())
+        monkeypatch.setattr(jobs, "_worker_loop_ref", asyncio.get_running_loop())
+        await asyncio.to_thread(_enqueue, tmp_path, monkeypatch, "small", 1)
+        await asyncio.wait_for(jobs._job_available.wait(), timeout=1)
+
+    asyncio.run(scenario())
+
+
+def test_restarts_leave_running_jobs_alone_until_their_lease_runs_out(tmp_path, monkeypatch):
+    monkeypatch.setenv("EXCEL_AGENT_DATA_DIR", str(tmp_path / "data"))
+    jobs.init_job_store()
+    job_id = _enqueue(tmp_path, monkeypatch, "small", page_count=1)
+    assert jobs._claim_next_job(small_lane_only=False)["id"] == job_id
+
+    # Another worker process starting up must not take over the running job
+    jobs.init_job_store()
+    assert jobs._claim_next_job(small_lane_only=False) is None
+    assert jobs.get_job(job_id)["status"] == "running"
+
+    # Once the owner stops renewing the lease, the job is picked up again
+    now = time.time()
+    monkeypatch.setattr(jobs.time, "time", lambda: now + jobs.JOB_LEASE_SECONDS + 1)
+    reclaimed = jobs._claim_next_job(small_lane_only=False)
+    assert reclaimed["id"] == job_id
+    assert jobs.get_job(job_id)["lease_expires_at"] > now + jobs.JOB_LEASE_SECONDS + 1
+
+
+def test_renewed_leases_keep_the_job(tmp_path, monkeypatch):
+    monkeypatch.setenv("EXCEL_AGENT_DATA_DIR", str(tmp_path / "data"))
+    jobs.init_job_store()
+    job_id = _enqueue(tmp_path, monkeypatch, "small", page_count=1)
+    jobs._claim_next_job(small_lane_only=False)
+
+    now = time.time()
+    monkeypatch.setattr(jobs.time, "time", lambda: now + jobs.JOB_LEASE_SECONDS / 2)
+    jobs._renew_lease(job_id)
+    monkeypatch.setattr(jobs.time, "time", lambda: now + jobs.JOB_LEASE_SECONDS + 1)
+    assert jobs._claim_next_job(small_lane_only=False) is None
+
+    jobs._release_leases()
+    assert jobs._claim_next_job(small_lane_only=False)["id"] == job_id
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from utils.json_stream_utils import IncrementalMappingParser
+
+
+def _feed_in_chunks(text: str, size: int) -> list:
+    parser = IncrementalMappingParser()
+    pairs = []
+    for start in range(0, len(text), size):
+        pairs.extend(parser.feed(text[start:start + size]))
+    return pairs
+
+
+ARRAY_RESPONSE = json.dumps([
+    {"cell": "A1", "text": 'He said "yes", then {left}'},
+    {"cell": "B2", "number": 12.5},
+    {"cell": "C3", "text": "back\\slash, comma [bracket]"},
+    {"cell": "D4", "text": "unicode é and \n newline"},
+])
+ARRAY_PAIRS = [
+    ("A1", 'He said "yes", then {left}'),
+    ("B2", 12.5),
+    ("C3", "back\\slash, comma [bracket]"),
+    ("D4", "unicode é and \n newline"),
+]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 10_000])
+def test_array_pairs_survive_any_chunk_boundary(size):
+    assert _feed_in_chunks(ARRAY_RESPONSE, size) == ARRAY_PAIRS
+
+
+def test_chunk_boundary_inside_an_escape_sequence():
+    parser = IncrementalMappingParser()
+    assert parser.feed('[{"cell": "A1", "text": "a\\') == []
+    assert parser.feed('"b"}]') == [("A1", 'a"b')]
+
+
+def test_pairs_are_emitted_as_soon_as_they_are_complete():
+    parser = IncrementalMappingParser()
+    assert parser.feed('[{"cell": "A1", "number": 1}, {"cell": "B1"') == [("A1", 1)]
+    assert parser.feed(', "text": "x"}]') == [("B1", "x")]
+
+
+def test_text_before_the_json_is_ignored():
+    response = 'Here is the mapping:\n```json\n{"A1": "x", "B1": 2}\n```'
+    assert _feed_in_chunks(response, 5) == [("A1", "x"), ("B1", 2)]
+
+
+def test_object_form_keeps_nested_values_whole():
+    response = '{"A1": {"nested": [1, {"deep": "]"}]}, "B1": [1, 2], "C1": "plain"}'
+    assert _feed_in_chunks(response, 3) == [("A1", {"nested": [1, {"deep": "]"}]}), ("B1", [1, 2]), ("C1", "plain")]
+
+
+def test_nested_values_inside_array_elements_do_not_split_them():
+    response = '[{"cell": "A1", "text": "x", "meta": {"a": [1, 2]}}, {"cell": "B1", "number": 3}]'
+    assert _feed_in_chunks(response, 4) == [("A1", "x"), ("B1", 3)]
+
+
+def test_truncated_stream_emits_only_complete_elements():
+    parser = IncrementalMappingParser()
+    pairs = parser.feed('[{"cell": "A1", "text": "done"}, {"cell": "B1", "text": "cut of')
+    assert pairs == [("A1", "done")]
+    assert parser.skipped_elements == []
+
+
+def test_malformed_elements_are_skipped_not_fatal():
+    parser = IncrementalMappingParser()
+    pairs = parser.feed('[{"cell": "A1"}, {"text": "no cell"}, {"cell": "C1", "number": null, "text": "t"}, oops]')
+    assert pairs == [("C1", "t")]
+    assert len(parser.skipped_elements) == 3
+
+
+def test_text_after_the_container_is_ignored():
+    parser = IncrementalMappingParser()
+    assert parser.feed('{"A1": 1}') == [("A1", 1)]
+    assert parser.feed(' {"B1": 2}') == []
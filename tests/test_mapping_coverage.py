@@ -0,0 +1,50 @@
+from openpyxl import Workbook
+
+from app.fill_excel_with_json import load_excel_template
+from app.mapping_coverage import index_form_values, find_missing_values, template_cell_flags, cell_issue, check_mapping_coverage
+
+TEMPLATE_MARKDOWN = 'A1: "Job No:" (merged range: A1:C1)  \nA2: "Customer:"  \nA3: "SEG: 4-12"  \n'
+
+
+def test_index_form_values_reads_label_values_table_cells_and_numbers():
+    form = "=== Page 1 ===\n**Job No:** 12,345\n| Customer | Acme Drilling |\n|---|---|\n- Reading: 3.5 mm\n"
+    values = [(item["value"], item["number"]) for item in index_form_values(form)]
+    assert ("12,345", 12345.0) in values
+    assert ("Acme Drilling", None) in values
+    assert ("3.5", 3.5) in values
+    assert ("3.5 mm", None) in values
+    assert all(value != "=== Page 1 ===" for value, _ in values)
+
+
+def test_values_in_the_mapping_or_template_are_not_missing():
+    form = "Job No: 12345\nCustomer: ACME  drilling\nSEG: 4\nRemarks: pump replaced\n"
+    mapping = {"B1": 12345, "B2": "Acme Drilling"}
+    missing = [item["value"] for item in find_missing_values(form, TEMPLATE_MARKDOWN, mapping)]
+    assert missing == ["pump replaced"]
+
+
+def test_numbers_match_inside_longer_mapped_text():
+    form = "Depth: 1,250.5\n"
+    assert find_missing_values(form, TEMPLATE_MARKDOWN, {"B1": "1250.5 ft"}) == []
+
+
+def test_profile_resolved_values_count_as_mapped():
+    form = "Job No: 12345\nCustomer: Acme Drilling\n"
+    assert check_mapping_coverage("test", form, TEMPLATE_MARKDOWN, {"B1": 12345, "B2": "Acme Drilling"}, {})["missing"] == []
+    assert [item["value"] for item in check_mapping_coverage("test", form, TEMPLATE_MARKDOWN, {"B2": "Acme Drilling"}, {})["missing"]] == ["12345"]
+
+
+def test_cell_issue_flags_formulas_and_non_master_merged_cells(tmp_path):
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Sheet1"
+    ws["A1"] = "=1+1"
+    ws.merge_cells("B2:D2")
+    wb.save(tmp_path / "template.xlsx")
+    _, ws, merged_ranges = load_excel_template(tmp_path / "template.xlsx")
+    flags = template_cell_flags(ws, merged_ranges)
+
+    assert cell_issue(flags, "A1") == "contains a formula"
+    assert "B2:D2" in cell_issue(flags, "C2")
+    assert cell_issue(flags, "B2") is None
+    assert cell_issue(flags, "E5") is None
@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict
+
+import pytest
+from fastapi import HTTPException
+from PIL import Image, ImageDraw
+
+import app.query_document as query_module
+from app.query_document import normalize_questions, query_document
+
+
+class FakeQueryClient:
+    """Answers every query with "<question> answer", at a confidence that differs per page."""
+
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def analyze_document(self, Document, FeatureTypes, QueriesConfig):
+        queries = [query['Text'] for query in QueriesConfig['Queries']]
+        with self._lock:
+            self.calls.append(queries)
+            call = len(self.calls)
+        blocks = []
+        for i, question in enumerate(queries):
+            blocks.append({"Id": f"q{call}-{i}", "BlockType": "QUERY", "Query": {"Text": question},
+                           "Relationships": [{"Type": "ANSWER", "Ids": [f"a{call}-{i}"]}]})
+            blocks.append({"Id": f"a{call}-{i}", "BlockType": "QUERY_RESULT", "Text": f"{question} answer",
+                           "Confidence": 50.0 + len(Document['Bytes']) % 40})
+        return {"Blocks": blocks}
+
+
+def _page(text: str):
+    image = Image.new('RGB', (400, 300), 'white')
+    draw = ImageDraw.Draw(image)
+    for row in range(8):
+        draw.text((20, 20 + row * 30), f"{text} line {row}", fill='black')
+    return image
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = FakeQueryClient()
+    pages = [_page("first"), Image.new('RGB', (400, 300), 'white'), _page("third")]
+    monkeypatch.setattr(query_module, "get_textract_client", lambda: client)
+    monkeypatch.setattr(query_module, "rasterize_document", lambda path: pages)
+    monkeypatch.setattr(query_module, "_answer_cache", OrderedDict())
+    return client
+
+
+def test_questions_are_batched_per_call_and_blank_pages_skipped(client, monkeypatch):
+    monkeypatch.setattr(query_module, "TEXTRACT_MAX_QUERIES_PER_CALL", 15)
+    questions = [f"Question {i}?" for i in range(20)]
+    result = query_document("test", "doc.pdf", questions)
+
+    assert result["textract_calls"] == 4  # two calls for each of the two non-blank pages
+    assert sorted(len(call) for call in client.calls) == [5, 5, 15, 15]
+    assert result["pages"] == 3
+    first = result["answers"][0]
+    assert first["question"] == "Question 0?"
+    assert sorted(answer["page"] for answer in first["answers"]) == [1, 3]
+    assert first["answer"] == max(first["answers"], key=lambda answer: answer["confidence"])
+
+
+def test_repeated_questions_are_answered_from_the_cache(client):
+    query_document("test", "doc.pdf", ["What is the job number?"])
+    result = query_document("test", "doc.pdf", ["What is the job number?", "Who signed?"])
+
+    assert result["cached_answers"] == 2  # one cached question on each non-blank page
+    assert result["textract_calls"] == 2
+    assert client.calls[-2:] == [["Who signed?"], ["Who signed?"]]
+    again = query_document("test", "doc.pdf", ["Who signed?", "What is the job number?"])
+    assert again["textract_calls"] == 0
+
+
+def test_questions_without_an_answer_are_cached_too(client, monkeypatch):
+    monkeypatch.setattr(client, "analyze_document", lambda **kwargs: client.calls.append(1) or {"Blocks": []})
+    result = query_document("test", "doc.pdf", ["Anything?"])
+    assert result["answers"] == [{"question": "Anything?", "answer": None, "answers": []}]
+    query_document("test", "doc.pdf", ["Anything?"])
+    assert len(client.calls) == 2
+
+
+def test_normalize_questions_strips_and_deduplicates():
+    assert normalize_questions(["  What  is\nit? ", "What is it?", "", "Other?"]) == ["What is it?", "Other?"]
+
+
+@pytest.mark.parametrize("questions", [[], ["  "], ["x" * 201], [f"Q{i}" for i in range(61)]])
+def test_normalize_questions_rejects_unusable_input(questions):
+    with pytest.raises(HTTPException) as error:
+        normalize_questions(questions)
+    assert error.value.status_code == 400
@@ -0,0 +1,103 @@
+import pytest
+
+import utils.rate_limit_utils as rate_limit_utils
+from utils.rate_limit_utils import TokenBucket, UpstreamBusyError, call_with_rate_limit, check_admission, is_throttling_error
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit_utils.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(rate_limit_utils.time, "sleep", clock.sleep)
+    monkeypatch.setattr(rate_limit_utils.random, "uniform", lambda low, high: high)
+    monkeypatch.setattr(rate_limit_utils, "_limiters", {})
+    return clock
+
+
+class ThrottlingError(Exception):
+    response = {"Error": {"Code": "ThrottlingException"}}
+
+
+def test_burst_is_free_then_callers_wait_for_the_refill(clock):
+    bucket = TokenBucket("test", rate_per_second=2, burst=2, max_wait=10, max_queue=10)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == pytest.approx(0.5)
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+
+def test_waits_beyond_max_wait_are_rejected_with_retry_after(clock):
+    bucket = TokenBucket("test", rate_per_second=0.1, burst=1, max_wait=5, max_queue=10)
+    bucket.acquire()
+    with pytest.raises(UpstreamBusyError) as error:
+        bucket.acquire()
+    assert error.value.status_code == 429
+    assert error.value.headers["Retry-After"] == "10"
+
+
+def test_drain_drops_the_saved_up_burst(clock):
+    bucket = TokenBucket("test", rate_per_second=1, burst=5, max_wait=10, max_queue=10)
+    bucket.drain()
+    assert bucket.estimated_wait() == pytest.approx(1.0)
+
+
+def test_admission_rejects_requests_for_a_saturated_upstream_only(clock, monkeypatch):
+    monkeypatch.setattr(rate_limit_utils, "RATE_LIMIT_MAX_WAIT_SECONDS", 1)
+    limiter = rate_limit_utils.get_rate_limiter("gemini", "model-a")
+    limiter.drain()
+    limiter._tokens = -10
+    with pytest.raises(UpstreamBusyError):
+        check_admission("gemini")
+    check_admission("textract")
+
+
+def test_throttled_calls_are_retried_with_backoff(clock, monkeypatch):
+    monkeypatch.setattr(rate_limit_utils, "TEXTRACT_BURST", 10)
+    monkeypatch.setattr(rate_limit_utils, "TEXTRACT_REQUESTS_PER_SECOND", 100)
+    outcomes = [ThrottlingError(), ThrottlingError(), "ok"]
+
+    def flaky():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    assert call_with_rate_limit("textract", flaky) == "ok"
+    backoffs = [seconds for seconds in clock.sleeps if seconds >= rate_limit_utils.THROTTLE_BACKOFF_BASE_SECONDS]
+    assert backoffs == [rate_limit_utils.THROTTLE_BACKOFF_BASE_SECONDS, rate_limit_utils.THROTTLE_BACKOFF_BASE_SECONDS * 2]
+
+
+def test_persistent_throttling_ends_in_429_and_other_errors_pass_through(clock, monkeypatch):
+    monkeypatch.setattr(rate_limit_utils, "THROTTLE_MAX_RETRIES", 1)
+    monkeypatch.setattr(rate_limit_utils, "TEXTRACT_REQUESTS_PER_SECOND", 100)
+
+    def always_throttled():
+        raise ThrottlingError()
+
+    with pytest.raises(UpstreamBusyError):
+        call_with_rate_limit("textract", always_throttled)
+
+    def broken():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        call_with_rate_limit("textract", broken)
+
+
+def test_throttling_errors_are_recognized_by_shape():
+    assert is_throttling_error(ThrottlingError())
+    assert is_throttling_error(type("TooManyRequests", (Exception,), {"code": 429})())
+    assert not is_throttling_error(ValueError())
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from utils.single_flight_utils import SingleFlight
+
+
+def test_followers_share_the_leaders_work():
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def scenario():
+        flight = SingleFlight("test")
+        return await asyncio.gather(*(flight.run("key", work, share=lambda result: f"copy of {result}") for _ in range(3)))
+
+    assert asyncio.run(scenario()) == ["result", "copy of result", "copy of result"]
+    assert calls == [1]
+
+
+def test_cancelling_the_leader_does_not_cancel_followers():
+    async def work():
+        await asyncio.sleep(0.1)
+        return "result"
+
+    async def scenario():
+        flight = SingleFlight("test")
+        leader = asyncio.ensure_future(flight.run("key", work, share=lambda result: f"copy of {result}"))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.run("key", work, share=lambda result: f"copy of {result}"))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        # The leader never picked up the result, so the follower takes over ownership of it
+        assert await follower == "result"
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+
+    asyncio.run(scenario())
+
+
+def test_work_is_cancelled_once_no_caller_waits_for_it():
+    cancelled = []
+
+    async def work():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def scenario():
+        flight = SingleFlight("test")
+        callers = [asyncio.ensure_future(flight.run("key", work)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        callers[0].cancel()
+        await asyncio.sleep(0.01)
+        assert cancelled == []
+        callers[1].cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert cancelled == [True]
+        assert flight._calls == {}
+
+    asyncio.run(scenario())
+
+
+def test_errors_reach_every_caller_and_the_key_is_freed():
+    async def failing():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    async def scenario():
+        flight = SingleFlight("test")
+        results = await asyncio.gather(*(flight.run("key", failing) for _ in range(2)), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert await flight.run("key", lambda: asyncio.sleep(0, result="fresh")) == "fresh"
+
+    asyncio.run(scenario())
@@ -1,119 +1,334 @@
 import os
-import boto3
 import tempfile
-from dotenv import load_dotenv
+import threading
 from fastapi import HTTPException
 import io
+import json
 from PIL import Image
 from pdf2image import convert_from_path
 
-# Load environment variables
-load_dotenv()
+from utils.metrics_utils import stage_timer, increment_counter
+from utils.rate_limit_utils import call_with_rate_limit, check_admission
+from utils.deadline_utils import stage_deadline, run_with_deadline
+from utils.pdf_text_utils import read_pdf_text_layer, parse_text_layer_page
+from utils.page_filter_utils import is_blank_page, blank_page
+from utils.region_utils import is_uncertain_word
+
+# Longest botocore waits for a Textract response; this is what ends a call that overruns its stage deadline
+TEXTRACT_READ_TIMEOUT_SECONDS = float(os.getenv('TEXTRACT_READ_TIMEOUT_SECONDS', '60'))
+
+# boto3 is imported on first use, and the client (thread-safe) is shared by all requests
+_textract_client = None
+_textract_client_lock = threading.Lock()
 
 def get_textract_client():
-    """Initializes and returns AWS Textract client."""
+    """Initializes (once per process) and returns AWS Textract client."""
+    global _textract_client
     AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
     AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
     AWS_REGION = os.getenv('AWS_REGION', 'us-east-2')
+    # Points the client at a different endpoint, e.g. the local stand-in used by the load test
+    AWS_TEXTRACT_ENDPOINT_URL = os.getenv('AWS_TEXTRACT_ENDPOINT_URL') or None
 
     if not AWS_ACCESS_KEY_ID or not AWS_SECRET_ACCESS_KEY:
         raise HTTPException(status_code=500, detail="AWS credentials not found in environment variables")
 
+    if _textract_client is not None:
+        return _textract_client
+
     try:
-        client = boto3.client(
-            'textract',
-            region_name=AWS_REGION,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-        )
-        return client
+        import boto3
+        from botocore.config import Config
+        with _textract_client_lock:
+            if _textract_client is None:
+                _textract_client = boto3.client(
+                    'textract',
+                    region_name=AWS_REGION,
+                    aws_access_key_id=AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                    endpoint_url=AWS_TEXTRACT_ENDPOINT_URL,
+                    # Throttling is retried by call_with_rate_limit, SDK retries would bypass the shared quota
+                    config=Config(retries={'max_attempts': 0}, read_timeout=TEXTRACT_READ_TIMEOUT_SECONDS)
+                )
+        return _textract_client
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to initialize AWS Textract client: {str(e)}")
 
-def extract_text_and_tables(client, doc_path: str) -> tuple[str, str]:
+def _get_child_text(block, blocks_map) -> str:
+    """Concatenates the text of all CHILD blocks (words) of a Textract block."""
+    words = []
+    for relationship in block.get('Relationships', []):
+        if relationship['Type'] == 'CHILD':
+            for child_id in relationship['Ids']:
+                child = blocks_map.get(child_id)
+                if not child:
+                    continue
+                if 'Text' in child:
+                    words.append(child['Text'])
+                elif child['BlockType'] == 'SELECTION_ELEMENT' and child.get('SelectionStatus') == 'SELECTED':
+                    words.append('X')
+    return ' '.join(words).strip()
+
+def parse_textract_tables(blocks, blocks_map) -> list[list[list[str]]]:
+    """Returns every TABLE block as a row-major grid of cell strings."""
+    tables = []
+    for table in (block for block in blocks if block['BlockType'] == "TABLE"):
+        table_cells = {}
+        max_row, max_col = 0, 0
+        for relationship in table.get('Relationships', []):
+            if relationship['Type'] == 'CHILD':
+                for cell_id in relationship['Ids']:
+                    cell = blocks_map.get(cell_id)
+                    if cell and cell['BlockType'] == 'CELL':
+                        row_index = cell['RowIndex']
+                        col_index = cell['ColumnIndex']
+                        max_row = max(max_row, row_index)
+                        max_col = max(max_col, col_index)
+                        cell_content = ''
+                        for cell_relationship in cell.get('Relationships', []):
+                            if cell_relationship['Type'] == 'CHILD':
+                                for word_id in cell_relationship['Ids']:
+                                    word_block = blocks_map.get(word_id)
+                                    if word_block and 'Text' in word_block:
+                                        cell_content += word_block['Text'] + ' '
+                        table_cells[(row_index, col_index)] = cell_content.strip()
+        tables.append([
+            [table_cells.get((row, col), '') for col in range(1, max_col + 1)]
+            for row in range(1, max_row + 1)
+        ])
+    return tables
+
+def parse_textract_key_values(blocks, blocks_map) -> list[dict]:
+    """Returns the FORMS key/value pairs detected by Textract."""
+    key_values = []
+    for block in blocks:
+        if block['BlockType'] != 'KEY_VALUE_SET' or 'KEY' not in block.get('EntityTypes', []):
+            continue
+        value_text = ''
+        confidence = block.get('Confidence', 0.0)
+        for relationship in block.get('Relationships', []):
+            if relationship['Type'] == 'VALUE':
+                for value_id in relationship['Ids']:
+                    value_block = blocks_map.get(value_id)
+                    if value_block:
+                        value_text = ' '.join(filter(None, [value_text, _get_child_text(value_block, blocks_map)]))
+                        confidence = min(confidence, value_block.get('Confidence', confidence))
+        key_values.append({
+            "key": _get_child_text(block, blocks_map),
+            "value": value_text,
+            "confidence": confidence,
+        })
+    return key_values
+
+def _child_ids(block) -> list[str]:
+    return [child_id for relationship in block.get('Relationships', []) if relationship['Type'] == 'CHILD' for child_id in relationship['Ids']]
+
+def _uncertain_lines(lines, blocks_map) -> list[dict]:
+    """Lines with a handwritten or low-confidence word, with their bounding box as [left, top, width, height]."""
+    uncertain = []
+    for line in lines:
+        words = [blocks_map[word_id] for word_id in _child_ids(line) if word_id in blocks_map]
+        if any(is_uncertain_word(word) for word in words):
+            box = line['Geometry']['BoundingBox']
+            uncertain.append({
+                "text": line['Text'],
+                "confidence": min(word.get('Confidence', 100.0) for word in words),
+                "box": [box['Left'], box['Top'], box['Width'], box['Height']],
+            })
+    return uncertain
+
+def parse_textract_page(blocks) -> dict:
+    """
+    Parses the Blocks of one analyze_document response into a plain structure:
+    {"lines": [...], "text_lines": [...], "key_values": [{"key", "value", "confidence"}], "tables": [grid, ...],
+     "uncertain_lines": [{"text", "confidence", "box"}]}
+    text_lines are the lines in reading order without those whose words all sit in table cells.
+    uncertain_lines are the lines that should be checked against the image (see region_utils).
+    """
+    blocks_map = {block['Id']: block for block in blocks}
+    table_words = {word_id for block in blocks if block['BlockType'] == 'CELL' for word_id in _child_ids(block)}
+    lines = [block for block in blocks if block['BlockType'] == 'LINE' and 'Text' in block]
+    return {
+        "lines": [line['Text'] for line in lines],
+        "text_lines": [
+            line['Text'] for line in lines
+            if not (_child_ids(line) and all(word_id in table_words for word_id in _child_ids(line)))
+        ],
+        "key_values": parse_textract_key_values(blocks, blocks_map),
+        "tables": parse_textract_tables(blocks, blocks_map),
+        "uncertain_lines": _uncertain_lines(lines, blocks_map),
+    }
+
+def parse_textract_query_answers(blocks) -> dict[str, list[dict]]:
+    """Maps the text of every QUERY block of an analyze_document response to its answers, [{"text", "confidence"}]."""
+    blocks_map = {block['Id']: block for block in blocks}
+    answers = {}
+    for block in blocks:
+        if block['BlockType'] != 'QUERY':
+            continue
+        results = [
+            blocks_map[answer_id]
+            for relationship in block.get('Relationships', []) if relationship['Type'] == 'ANSWER'
+            for answer_id in relationship['Ids'] if answer_id in blocks_map
+        ]
+        answers[block['Query']['Text']] = [
+            {"text": result.get('Text', ''), "confidence": round(result.get('Confidence', 0.0), 2)} for result in results
+        ]
+    return answers
+
+def read_textract_structure(structure_path: str) -> list[dict]:
+    """Loads the per-page structure file written by extract_text_and_tables."""
+    with open(structure_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _render_table(grid: list[list[str]]) -> list[str]:
+    """Renders a table grid as compact pipe-separated rows, without padding, empty rows or trailing empty cells."""
+    rows = []
+    for row in grid:
+        cells = [' '.join(cell.split()).replace('|', '/') for cell in row]
+        while cells and not cells[-1]:
+            cells.pop()
+        if cells:
+            rows.append(' | '.join(cells))
+    return rows
+
+def render_textract_context(pages: list[dict]) -> tuple[str, str]:
+    """
+    Renders the page structures as the raw-text and table context sent to Gemini, with "=== Page n ===" sections.
+    Every line appears once, in reading order, and lines that belong to a table only appear in its table.
+    Pages skipped as blank are left out.
+    """
+    raw_text, table_data = [], []
+    for page in pages:
+        if page.get("skipped"):
+            continue
+        raw_text.append(f"\n\n=== Page {page['page']} ===\n\n")
+        table_data.append(f"\n\n=== Page {page['page']} ===\n\n")
+        raw_text.extend(line + '\n' for line in page["text_lines"])
+        for table_num, grid in enumerate(page["tables"], 1):
+            rows = _render_table(grid)
+            if rows:
+                table_data.append(f"Table {table_num}:\n" + '\n'.join(rows) + '\n\n')
+    return ''.join(raw_text), ''.join(table_data)
+
+def render_key_value_context(pages: list[dict], min_confidence: float = 90.0) -> str:
+    """Renders the key/value pairs of the page structures as "Key: value" lines per page, flagging uncertain values."""
+    sections = []
+    for page in pages:
+        if page.get("skipped"):
+            continue
+        sections.append(f"\n\n=== Page {page['page']} ===\n\n")
+        for kv in page["key_values"]:
+            flag = " (low confidence)" if kv.get("confidence", 100.0) < min_confidence else ""
+            sections.append(f"{kv['key']}: {kv['value']}{flag}\n")
+    return ''.join(sections)
+
+def _extract_from_text_layer(text_layer: list[str]) -> list[dict]:
+    """Parses the pages of a PDF text layer into the same structure as Textract pages."""
+    increment_counter("excel_agent_pages_total", len(text_layer), description="Document pages processed", stage="text_layer")
+    pages = []
+    for page_num, page_text in enumerate(text_layer, start=1):
+        page = parse_text_layer_page(page_text)
+        page["page"] = page_num
+        pages.append(page)
+    return pages
+
+def rasterize_document(doc_path: str) -> list:
+    """Page images of a PDF, or the image itself as a single page."""
+    # Handle PDF or image file
+    file_ext = os.path.splitext(doc_path)[1].lower()
+    with stage_timer("rasterization"):
+        if file_ext == '.pdf':
+            return convert_from_path(doc_path)
+        # For image files, create a single-item list
+        return [Image.open(doc_path)]
+
+def _extract_with_textract(get_client, doc_path: str) -> list[dict]:
+    """
+    Rasterizes the document and runs every page through Textract, except blank pages. The client is only
+    created here, and the Textract quota only checked, once the document turned out to need Textract.
+    """
+    check_admission("textract")
+    client = get_client()
+    images = rasterize_document(doc_path)
+    increment_counter("excel_agent_pages_total", len(images), description="Document pages processed", stage="textract")
+
+    pages = []
+    # All pages share the Textract stage's part of the request deadline
+    with stage_deadline("textract"):
+        for page_num, image in enumerate(images, start=1):
+            with stage_timer("blank_check"):
+                blank = is_blank_page(image)
+            if blank:
+                increment_counter("excel_agent_pages_skipped_total", description="Pages left out before Textract or Gemini", reason="blank")
+                pages.append(blank_page(page_num))
+                continue
+            pages.append(_analyze_page(client, image, page_num))
+    return pages
+
+def _analyze_page(client, image, page_num: int) -> dict:
+    """Sends one page image to Textract and parses the response."""
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format='PNG')
+    img_byte_arr = img_byte_arr.getvalue()
+    increment_counter("excel_agent_image_bytes_total", len(img_byte_arr), description="Image bytes sent upstream", upstream="textract")
+
+    try:
+        with stage_timer("textract"):
+            response = run_with_deadline(
+                call_with_rate_limit,
+                "textract",
+                client.analyze_document,
+                Document={'Bytes': img_byte_arr},
+                FeatureTypes=["TABLES", "FORMS", "SIGNATURES"]
+            )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"AWS Textract API error on page {page_num}: {str(e)}")
+
+    page = parse_textract_page(response.get('Blocks', []))
+    page["page"] = page_num
+    return page
+
+def extract_text_and_tables(get_client, doc_path: str) -> tuple[str, str, str]:
     """
     Processes a document (PDF or image) using Textract, saves raw text and table data to temporary files, 
     and returns the paths to these files.
+    A third file holds the parsed per-page structure (lines, key/value pairs, table grids) as JSON.
+    PDFs with a usable text layer on every page are read from it directly, without rasterizing or Textract;
+    get_client (e.g. get_textract_client) is only called for documents that need Textract.
     """
     base_filename = os.path.splitext(os.path.basename(doc_path))[0]
     # Use temp files instead of writing to output dir directly in this utility
     raw_text_file_path = tempfile.mktemp(suffix=f"_{base_filename}_rawtext.txt")
     table_file_path = tempfile.mktemp(suffix=f"_{base_filename}_tables.txt")
+    structure_file_path = tempfile.mktemp(suffix=f"_{base_filename}_structure.json")
 
     try:
-        with open(raw_text_file_path, 'w', encoding='utf-8') as raw_text_file, \
-             open(table_file_path, 'w', encoding='utf-8') as table_file:
-
-            # Handle PDF or image file
-            file_ext = os.path.splitext(doc_path)[1].lower()
-            if file_ext == '.pdf':
-                images = convert_from_path(doc_path)
-            else:
-                # For image files, create a single-item list
-                images = [Image.open(doc_path)]
-
-            for page_num, image in enumerate(images, start=1):
-                raw_text_file.write(f"\n\n=== Page {page_num} ===\n\n")
-                table_file.write(f"\n\n=== Page {page_num} ===\n\n")
-
-                img_byte_arr = io.BytesIO()
-                image.save(img_byte_arr, format='PNG')
-                img_byte_arr = img_byte_arr.getvalue()
-
-                try:
-                    response = client.analyze_document(
-                        Document={'Bytes': img_byte_arr},
-                        FeatureTypes=["TABLES", "FORMS", "SIGNATURES"]
-                    )
-                except Exception as e:
-                     raise HTTPException(status_code=500, detail=f"AWS Textract API error on page {page_num}: {str(e)}")
-
-                blocks = response.get('Blocks', [])
-                blocks_map = {block['Id']: block for block in blocks}
-                table_blocks = [block for block in blocks if block['BlockType'] == "TABLE"]
-
-                # Process non-table text
-                for block in blocks:
-                    if 'Text' in block and block['BlockType'] != 'CELL':
-                        raw_text_file.write(block['Text'] + '\n')
-
-                # Process tables
-                if table_blocks:
-                    table_file.write(f"Found {len(table_blocks)} tables on page {page_num}\n\n")
-                    for table_num, table in enumerate(table_blocks, 1):
-                        table_file.write(f"Table {table_num}:\n")
-                        if 'Relationships' in table:
-                            table_cells = {}
-                            max_row, max_col = 0, 0
-                            for relationship in table['Relationships']:
-                                if relationship['Type'] == 'CHILD':
-                                    for cell_id in relationship['Ids']:
-                                        cell = blocks_map.get(cell_id)
-                                        if cell and cell['BlockType'] == 'CELL':
-                                            row_index = cell['RowIndex']
-                                            col_index = cell['ColumnIndex']
-                                            max_row = max(max_row, row_index)
-                                            max_col = max(max_col, col_index)
-                                            cell_content = ''
-                                            if 'Relationships' in cell:
-                                                for cell_relationship in cell['Relationships']:
-                                                    if cell_relationship['Type'] == 'CHILD':
-                                                        for word_id in cell_relationship['Ids']:
-                                                            word_block = blocks_map.get(word_id)
-                                                            if word_block and 'Text' in word_block:
-                                                                cell_content += word_block['Text'] + ' '
-                                            table_cells[(row_index, col_index)] = cell_content.strip()
-                            
-                            for row in range(1, max_row + 1):
-                                row_data = [table_cells.get((row, col), '') for col in range(1, max_col + 1)]
-                                formatted_row = ' | '.join(cell.ljust(20) for cell in row_data) # Keep basic formatting
-                                table_file.write(formatted_row + '\n')
-                            table_file.write('\n' + '-'*80 + '\n\n')
-
-        return raw_text_file_path, table_file_path
+        with stage_timer("text_layer"):
+            text_layer = read_pdf_text_layer(doc_path)
+        if text_layer is not None:
+            pages = _extract_from_text_layer(text_layer)
+        else:
+            pages = _extract_with_textract(get_client, doc_path)
+
+        raw_text, table_data = render_textract_context(pages)
+        with open(raw_text_file_path, 'w', encoding='utf-8') as raw_text_file:
+            raw_text_file.write(raw_text)
+        with open(table_file_path, 'w', encoding='utf-8') as table_file:
+            table_file.write(table_data)
+        with open(structure_file_path, 'w', encoding='utf-8') as structure_file:
+            json.dump(pages, structure_file)
 
+        return raw_text_file_path, table_file_path, structure_file_path
+
+    except HTTPException:
+        from .file_utils import cleanup_files # Avoid circular import at top level
+        cleanup_files(raw_text_file_path, table_file_path, structure_file_path)
+        raise
     except Exception as e:
         # Clean up temp files if error occurs during processing
         from .file_utils import cleanup_files # Avoid circular import at top level
-        cleanup_files(raw_text_file_path, table_file_path)
-        raise HTTPException(status_code=500, detail=f"Error processing document with Textract: {str(e)}") 
\ No newline at end of file
+        cleanup_files(raw_text_file_path, table_file_path, structure_file_path)
+        raise HTTPException(status_code=500, detail=f"Error processing document with Textract: {str(e)}") 
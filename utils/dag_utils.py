@@ -0,0 +1,106 @@
+import time
+import asyncio
+import inspect
+
+from utils.metrics_utils import increment_counter, record_request_timing
+
+
+class StageDAG:
+    """
+    Runs the stages of a pipeline as a dependency graph: every stage starts as soon as the stages it
+    depends on have finished, so independent branches run concurrently. Synchronous stage functions run
+    in worker threads. A stage receives the results of its dependencies as positional arguments.
+
+    If a stage fails, the stages still running are cancelled. Stages already running in a worker thread
+    cannot be interrupted, so they are waited for. Then the cleanup of every finished stage is called with
+    its result, so temporary files created by earlier stages or by slow siblings do not leak.
+    """
+
+    def __init__(self, request_id, name: str):
+        self.request_id = request_id
+        self.name = name
+        self._stages = {}   # name -> (func, deps, cleanup)
+        self.results = {}
+        self.timings = {}   # name -> (start, end) in seconds since run() started
+
+    def add(self, name: str, func, deps: tuple = (), cleanup=None) -> None:
+        """Adds a stage. Dependencies must have been added before; cleanup(result) undoes the stage on failure."""
+        missing = [dep for dep in deps if dep not in self._stages]
+        if missing:
+            raise ValueError(f"Stage {name} depends on unknown stages {missing}")
+        self._stages[name] = (func, tuple(deps), cleanup)
+
+    async def _run_stage(self, name: str, tasks: dict, started: float):
+        func, deps, _ = self._stages[name]
+        args = [await tasks[dep] for dep in deps]
+        start = time.perf_counter() - started
+        try:
+            if inspect.iscoroutinefunction(func):
+                result = await func(*args)
+            else:
+                result = await self._run_in_thread(name, func, args)
+        finally:
+            self.timings[name] = (start, time.perf_counter() - started)
+        self.results[name] = result
+        return result
+
+    async def _run_in_thread(self, name: str, func, args: list):
+        thread = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        try:
+            return await asyncio.shield(thread)
+        except asyncio.CancelledError:
+            # The thread keeps running after a cancel: wait for it, so its result is cleaned up with the others
+            self.results[name] = await thread
+            raise
+
+    async def run(self) -> dict:
+        """Runs all stages and returns their results by name. Raises the first stage failure."""
+        started = time.perf_counter()
+        tasks = {}
+        for name in self._stages:  # dependencies are added first, so their tasks already exist
+            tasks[name] = asyncio.ensure_future(self._run_stage(name, tasks, started))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            for name, (_, _, cleanup) in reversed(list(self._stages.items())):
+                if cleanup is not None and name in self.results:
+                    try:
+                        cleanup(self.results[name])
+                    except Exception as e:
+                        print(f"[{self.request_id}] Cleanup of stage {name} failed: {e}")
+            raise
+        self._report_critical_path(time.perf_counter() - started)
+        return self.results
+
+    def critical_path(self) -> list[tuple[str, float]]:
+        """
+        The chain of stages that determined the wall-clock time: starting from the stage that finished last,
+        each step goes back to the dependency that finished last. Returns (stage, seconds) in execution order.
+        """
+        if not self.timings:
+            return []
+        path = []
+        name = max(self.timings, key=lambda stage: self.timings[stage][1])
+        while name is not None:
+            start, end = self.timings[name]
+            path.append((name, end - start))
+            deps = [dep for dep in self._stages[name][1] if dep in self.timings]
+            name = max(deps, key=lambda dep: self.timings[dep][1]) if deps else None
+        return list(reversed(path))
+
+    def _report_critical_path(self, wall_seconds: float) -> None:
+        path = self.critical_path()
+        for stage, seconds in path:
+            record_request_timing(f"cp.{stage}", seconds)
+            increment_counter(
+                "excel_agent_critical_path_seconds_total", seconds,
+                description="Seconds stages spent on the critical path of their pipeline", pipeline=self.name, stage=stage
+            )
+        stages_seconds = sum(end - start for start, end in self.timings.values())
+        print(
+            f"[{self.request_id}] {self.name} finished in {wall_seconds:.2f}s ({stages_seconds:.2f}s of stage time), "
+            f"critical path: " + " -> ".join(f"{stage} {seconds:.2f}s" for stage, seconds in path)
+        )
@@ -0,0 +1,260 @@
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from fastapi import HTTPException
+
+from utils.metrics_utils import increment_counter
+
+# End-to-end deadline of the routes that run the pipeline inline (0 = none). Background jobs have no deadline.
+REQUEST_DEADLINE_SECONDS = float(os.getenv('REQUEST_DEADLINE_SECONDS', '300'))
+# Share of the request deadline each upstream stage may take; a stage is also limited by what remains of it
+STAGE_DEADLINE_SHARES = {
+    stage.strip(): float(share)
+    for stage, share in (
+        item.split('=', 1) for item in os.getenv('STAGE_DEADLINE_SHARES', 'textract=0.4,gemini_markdown=0.4,gemini_mapping=0.4').split(',')
+        if '=' in item
+    )
+}
+# Hedging: when a Gemini call is still running after the stage's observed p95 latency, a duplicate is sent
+# and whichever answers first is used. At most GEMINI_HEDGE_MAX_RATE of the recent calls are hedged.
+GEMINI_HEDGE_ENABLED = os.getenv('GEMINI_HEDGE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+GEMINI_HEDGE_MAX_RATE = float(os.getenv('GEMINI_HEDGE_MAX_RATE', '0.05'))
+GEMINI_HEDGE_PERCENTILE = float(os.getenv('GEMINI_HEDGE_PERCENTILE', '0.95'))
+# Latencies needed before the percentile is trusted; until then calls are not hedged
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv('GEMINI_HEDGE_MIN_SAMPLES', '20'))
+# Workers shared by all hedged calls; each hedged call takes up to two of them
+GEMINI_HEDGE_MAX_WORKERS = int(os.getenv('GEMINI_HEDGE_MAX_WORKERS', '8'))
+HEDGE_WINDOW = 200
+
+_request_deadline = contextvars.ContextVar('request_deadline', default=None)
+_stage_deadline = contextvars.ContextVar('stage_deadline', default=None)
+
+
+class DeadlineExceeded(HTTPException):
+    """A stage ran out of its share of the request deadline; answered as 504."""
+
+    def __init__(self, stage: str, budget: float):
+        self.stage = stage
+        super().__init__(status_code=504, detail=f"{stage} did not finish within its deadline of {budget:.1f}s")
+
+
+class _Deadline:
+    def __init__(self, stage: str, seconds: float, end: float):
+        self.stage = stage
+        self.seconds = seconds
+        self.end = end
+
+    def remaining(self) -> float:
+        return self.end - time.monotonic()
+
+    def check(self) -> None:
+        """Raises DeadlineExceeded once the deadline has passed."""
+        if self.remaining() <= 0:
+            increment_counter("excel_agent_deadline_exceeded_total", description="Stages cancelled at their deadline", stage=self.stage)
+            raise DeadlineExceeded(self.stage, self.seconds)
+
+
+def start_request_deadline(seconds: float | None = None) -> contextvars.Token | None:
+    """Starts the end-to-end deadline of the current request. Returns a reset token, or None without a deadline."""
+    seconds = REQUEST_DEADLINE_SECONDS if seconds is None else seconds
+    if seconds <= 0:
+        return None
+    return _request_deadline.set(_Deadline("request", seconds, time.monotonic() + seconds))
+
+
+def reset_request_deadline(token: contextvars.Token | None) -> None:
+    if token is not None:
+        _request_deadline.reset(token)
+
+
+@contextmanager
+def stage_deadline(stage: str):
+    """
+    Limits the calls in the block to the stage's share of the request deadline (or what remains of it).
+    Without a request deadline, or for stages without a share, the calls are not limited.
+    """
+    request = _request_deadline.get()
+    share = STAGE_DEADLINE_SHARES.get(stage)
+    if request is None or share is None:
+        token = _stage_deadline.set(None)
+    else:
+        seconds = request.seconds * share
+        token = _stage_deadline.set(_Deadline(stage, seconds, min(request.end, time.monotonic() + seconds)))
+    try:
+        yield _stage_deadline.get()
+    finally:
+        _stage_deadline.reset(token)
+
+
+def current_stage_deadline():
+    return _stage_deadline.get()
+
+
+def run_with_deadline(func, *args, **kwargs):
+    """
+    Calls func on the caller's thread within the current stage deadline. The upstream call itself is bounded
+    by its SDK timeout (Gemini's request_options, botocore's read_timeout), so no thread is needed to give up
+    on it; a call that fails after the deadline has passed (typically that timeout) is answered with
+    DeadlineExceeded.
+    """
+    deadline = current_stage_deadline()
+    if deadline is None:
+        return func(*args, **kwargs)
+    deadline.check()
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        deadline.check()
+        raise
+
+
+class HedgePolicy:
+    """Tracks a stage's call latencies and decides when, and how often, a call may be hedged."""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self._latencies = deque(maxlen=HEDGE_WINDOW)
+        self._hedged = deque(maxlen=HEDGE_WINDOW)  # one entry per call, True if it was hedged
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def hedge_delay(self) -> float | None:
+        """The observed latency percentile after which a call is hedged, or None while too few calls were seen."""
+        with self._lock:
+            if len(self._latencies) < GEMINI_HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * GEMINI_HEDGE_PERCENTILE))]
+
+    def start_call(self) -> None:
+        with self._lock:
+            self._hedged.append(False)
+
+    def try_hedge(self) -> bool:
+        """Counts a hedge for the latest call unless that would exceed the hedging rate."""
+        with self._lock:
+            if not self._hedged or (sum(self._hedged) + 1) / len(self._hedged) > GEMINI_HEDGE_MAX_RATE:
+                return False
+            self._hedged[-1] = True
+            return True
+
+
+_hedge_policies = {}
+_hedge_policies_lock = threading.Lock()
+
+
+# Hedged calls run on a bounded pool; when all of its workers are busy, calls are made without hedging
+_hedge_executor = ThreadPoolExecutor(max_workers=GEMINI_HEDGE_MAX_WORKERS, thread_name_prefix="hedge")
+_hedge_slots = threading.BoundedSemaphore(GEMINI_HEDGE_MAX_WORKERS)
+
+
+def get_hedge_policy(stage: str) -> HedgePolicy:
+    with _hedge_policies_lock:
+        if stage not in _hedge_policies:
+            _hedge_policies[stage] = HedgePolicy(stage)
+        return _hedge_policies[stage]
+
+
+def _start_call(func) -> Future | None:
+    """
+    Runs func on the hedging pool with the caller's context (stage timings, deadlines), or returns None when
+    all of its workers are busy, so calls never queue behind each other.
+    """
+    if not _hedge_slots.acquire(blocking=False):
+        return None
+    context = contextvars.copy_context()
+    try:
+        future = _hedge_executor.submit(context.run, func)
+    except BaseException:
+        _hedge_slots.release()
+        raise
+    future.add_done_callback(lambda _: _hedge_slots.release())
+    return future
+
+
+def _abandon(future: Future, discard) -> None:
+    """Gives up on a call that lost the race: it is cancelled if it has not started, else discarded when it returns."""
+    if future.cancel() or discard is None:
+        return
+
+    def discard_result(done: Future):
+        if done.cancelled() or done.exception() is not None:
+            return
+        try:
+            discard(done.result())
+        except Exception as e:
+            print(f"Failed to release an abandoned hedged call: {e}")
+
+    future.add_done_callback(discard_result)
+
+
+def call_hedged(stage: str, func, *args, discard=None, **kwargs):
+    """
+    Calls func within the current stage deadline. With hedging enabled, a call still running after the
+    stage's observed p95 latency is duplicated and the first successful result is used. A failed call falls
+    back to the other one if it is still running. The call that is not used is abandoned: discard, if given,
+    is called with its result when it returns, e.g. to close a response stream nobody reads.
+    """
+    if not GEMINI_HEDGE_ENABLED:
+        return run_with_deadline(func, *args, **kwargs)
+    policy = get_hedge_policy(stage)
+    deadline = current_stage_deadline()
+    if deadline is not None:
+        deadline.check()
+    policy.start_call()
+    delay = policy.hedge_delay()
+
+    def timed_call():
+        start = time.monotonic()
+        result = func(*args, **kwargs)
+        policy.record(time.monotonic() - start)
+        return result
+
+    # Until the latency percentile is known there is nothing to hedge, and the call runs on the caller's thread
+    primary = _start_call(timed_call) if delay is not None else None
+    if primary is None:
+        return run_with_deadline(timed_call)
+    pending = {primary}
+    hedged = False
+    error = None
+    try:
+        while pending:
+            remaining = deadline.remaining() if deadline is not None else None
+            timeout = remaining
+            if not hedged:
+                timeout = delay if remaining is None else min(delay, remaining)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if hedged:
+                        increment_counter(
+                            "excel_agent_hedged_calls_total", description="Calls duplicated after the latency percentile",
+                            stage=stage, result="primary_won" if future is primary else "hedge_won"
+                        )
+                    return future.result()
+                error = future.exception()
+            if done:
+                continue
+            if deadline is not None and deadline.remaining() <= 0:
+                deadline.check()
+            if not hedged:
+                hedged = True
+                if policy.try_hedge():
+                    hedge = _start_call(timed_call)
+                    if hedge is None:
+                        print(f"{stage} call still running after {delay:.1f}s, but no worker is free for a hedged duplicate.")
+                        continue
+                    print(f"{stage} call still running after {delay:.1f}s, sending a hedged duplicate.")
+                    increment_counter("excel_agent_hedged_calls_total", description="Calls duplicated after the latency percentile", stage=stage, result="sent")
+                    pending.add(hedge)
+        raise error
+    finally:
+        for future in pending:
+            _abandon(future, discard)
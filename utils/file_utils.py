@@ -1,20 +1,112 @@
 import tempfile
-import shutil
 import os
-from fastapi import UploadFile
-import pyexcel
+import re
+import asyncio
+import hashlib
+from fastapi import UploadFile, HTTPException
+from pdf2image import pdfinfo_from_path
 
-async def save_upload_file_tmp(upload_file: UploadFile, suffix: str) -> str:
-    """Saves an uploaded file to a temporary file and returns the path."""
+from utils.metrics_utils import timed_stage, increment_counter
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Leading bytes of each accepted upload type, by extension
+FILE_SIGNATURES = {
+    '.pdf': b'%PDF-',
+    '.png': b'\x89PNG\r\n\x1a\n',
+    '.jpg': b'\xff\xd8\xff',
+    '.jpeg': b'\xff\xd8\xff',
+    '.xlsx': b'PK\x03\x04',  # zip container
+    '.xls': b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',  # OLE compound document
+}
+
+# Page objects in an uncompressed PDF page tree; pages inside compressed object streams are only counted after the write
+_PDF_PAGE_PATTERN = re.compile(rb'/Type\s*/Page(?![A-Za-z])')
+
+
+def _reject_upload(status_code: int, reason: str, detail: str) -> HTTPException:
+    increment_counter("excel_agent_upload_rejections_total", description="Uploads rejected during ingestion", reason=reason)
+    return HTTPException(status_code=status_code, detail=detail)
+
+
+def count_document_pages(document_path: str) -> int | None:
+    """Returns the page count of a PDF (1 for images), or None if poppler cannot read it."""
+    if os.path.splitext(document_path)[1].lower() != '.pdf':
+        return 1
+    try:
+        return int(pdfinfo_from_path(document_path)["Pages"])
+    except Exception as e:
+        print(f"Could not count pages of {document_path}: {e}")
+        return None
+
+
+async def ingest_upload_file(
+    upload_file: UploadFile,
+    suffix: str,
+    max_bytes: int | None = None,
+    max_pages: int | None = None
+) -> tuple[str, str]:
+    """
+    Streams an uploaded file to a temporary file in chunks without blocking the event loop,
+    hashing the content on the way. The magic bytes of the first chunk must match the extension,
+    and the upload is aborted as soon as it exceeds max_bytes or (for PDFs) max_pages.
+    Returns (path, sha256 hex digest). Nothing is left on disk when the upload is rejected.
+    """
+    name = upload_file.filename or f"upload{suffix}"
+    digest = hashlib.sha256()
+    size = 0
+    pages_seen = 0
+    tail = b''
+    tmp_path = None
     try:
         with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
-            shutil.copyfileobj(upload_file.file, tmp_file)
-            return tmp_file.name
+            tmp_path = tmp_file.name
+            while True:
+                chunk = await upload_file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if size == 0:
+                    signature = FILE_SIGNATURES.get(suffix.lower())
+                    if signature and not chunk.startswith(signature):
+                        raise _reject_upload(400, "signature", f"The content of {name} is not a valid {suffix} file")
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise _reject_upload(413, "size", f"{name} exceeds the upload limit of {max_bytes // (1024 * 1024)} MB")
+                if max_pages is not None and suffix.lower() == '.pdf':
+                    # Keep a few bytes of the previous chunk so that markers split across chunks are still found
+                    window = tail + chunk
+                    pages_seen += len(_PDF_PAGE_PATTERN.findall(window)) - len(_PDF_PAGE_PATTERN.findall(tail))
+                    tail = window[-32:]
+                    if pages_seen > max_pages:
+                        raise _reject_upload(413, "pages", f"{name} has more than {max_pages} pages")
+                digest.update(chunk)
+                await asyncio.to_thread(tmp_file.write, chunk)
+        if size == 0:
+            raise _reject_upload(400, "empty", f"{name} is empty")
+
+        if max_pages is not None and suffix.lower() == '.pdf':
+            page_count = await asyncio.to_thread(count_document_pages, tmp_path)
+            if page_count is not None and page_count > max_pages:
+                raise _reject_upload(413, "pages", f"{name} has {page_count} pages, the limit is {max_pages}")
+
+        increment_counter("excel_agent_upload_bytes_total", size, description="Bytes of accepted uploads", kind=suffix.lower().lstrip('.'))
+        return tmp_path, digest.hexdigest()
+    except BaseException:
+        cleanup_files(tmp_path)
+        raise
     finally:
         await upload_file.close() # Ensure the file pointer is closed
 
+
+async def save_upload_file_tmp(upload_file: UploadFile, suffix: str) -> str:
+    """Saves an uploaded file to a temporary file and returns the path."""
+    path, _ = await ingest_upload_file(upload_file, suffix)
+    return path
+
+@timed_stage("xls_conversion")
 def convert_xls_to_xlsx(xls_path: str) -> str:
     """Converts an XLS file to XLSX format."""
+    import pyexcel # Only needed for .xls uploads
     xlsx_path = xls_path.replace(".xls", ".xlsx")
     try:
         pyexcel.save_book_as(file_name=xls_path, dest_file_name=xlsx_path)
@@ -32,4 +124,14 @@ def cleanup_files(*file_paths):
                 os.remove(file_path)
             except OSError: 
                 # Log error or handle as needed, e.g., file not found
-                pass 
\ No newline at end of file
+                pass 
+
+def get_data_dir(*subdirs: str) -> str:
+    """
+    Returns (and creates) a local directory for data that should outlive a single request.
+    The root defaults to the system temp directory and can be set with EXCEL_AGENT_DATA_DIR.
+    """
+    root = os.getenv('EXCEL_AGENT_DATA_DIR', os.path.join(tempfile.gettempdir(), 'excel-agent'))
+    path = os.path.join(root, *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
@@ -0,0 +1,173 @@
+import os
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+
+from utils.metrics_utils import increment_counter
+
+# Where the static prompt prefix (instructions + template Markdown) is cached: "provider" uses Gemini's
+# context caching, "local" a stand-in that resends the prefix (for tests and offline benchmarks), "off" disables it
+GEMINI_CONTEXT_CACHE = os.getenv('GEMINI_CONTEXT_CACHE', 'provider').lower()
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv('GEMINI_CONTEXT_CACHE_TTL_SECONDS', '3600'))
+# Caches are extended when less than this remains, so a busy template's cache never expires mid-traffic
+GEMINI_CONTEXT_CACHE_REFRESH_SECONDS = int(os.getenv('GEMINI_CONTEXT_CACHE_REFRESH_SECONDS', '600'))
+# Gemini rejects caches below a minimum size; shorter prefixes are sent inline
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv('GEMINI_CONTEXT_CACHE_MIN_TOKENS', '1024'))
+GEMINI_CONTEXT_CACHE_MAX_ENTRIES = int(os.getenv('GEMINI_CONTEXT_CACHE_MAX_ENTRIES', '32'))
+CONTEXT_CACHE_MODES = ('provider', 'local', 'off')
+# Rough Gemini tokenization, only used to decide whether a prefix reaches the minimum
+_CHARS_PER_TOKEN = 4
+
+_entries = OrderedDict()  # (model, prefix hash) -> _CacheEntry, least recently used first
+_entries_lock = threading.Lock()
+
+
+class _CacheEntry:
+    def __init__(self, handle, model, expires_at: float):
+        self.handle = handle      # provider CachedContent, or None when creating the cache failed
+        self.model = model        # model bound to the cached prefix
+        self.expires_at = expires_at
+        self.lock = threading.Lock()
+
+
+class LocalCachedModel:
+    """
+    Stand-in for a model bound to a provider-side cache: it keeps the prefix itself and prepends it to
+    every request, so callers exercise the same prefix/suffix split without a Gemini cache.
+    """
+
+    def __init__(self, gemini_model, prefix_parts: list):
+        self.gemini_model = gemini_model
+        self.prefix_parts = list(prefix_parts)
+        self.model_name = getattr(gemini_model, 'model_name', 'default')
+
+    def generate_content(self, contents, **kwargs):
+        contents = contents if isinstance(contents, list) else [contents]
+        return self.gemini_model.generate_content(self.prefix_parts + contents, **kwargs)
+
+
+def _model_name(gemini_model) -> str:
+    return getattr(gemini_model, 'model_name', 'default').removeprefix('models/')
+
+
+def _prefix_key(gemini_model, prefix_parts: list) -> tuple:
+    digest = hashlib.sha256()
+    for part in prefix_parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return _model_name(gemini_model), digest.hexdigest()
+
+
+def _create_provider_cache(gemini_model, prefix_parts: list, key: tuple):
+    from google import generativeai as genai
+    handle = genai.caching.CachedContent.create(
+        model=gemini_model.model_name,
+        display_name=f"excel-agent-{key[1][:16]}",
+        contents=prefix_parts,
+        ttl=datetime.timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL_SECONDS)
+    )
+    return handle, genai.GenerativeModel.from_cached_content(handle)
+
+
+def _delete_provider_cache(handle) -> None:
+    try:
+        handle.delete()
+    except Exception as e:
+        print(f"Could not delete Gemini context cache: {e}")
+
+
+def _create_entry(gemini_model, prefix_parts: list, key: tuple, mode: str) -> _CacheEntry:
+    now = time.monotonic()
+    if mode == 'local':
+        return _CacheEntry(None, LocalCachedModel(gemini_model, prefix_parts), now + GEMINI_CONTEXT_CACHE_TTL_SECONDS)
+    try:
+        handle, cached_model = _create_provider_cache(gemini_model, prefix_parts, key)
+        increment_counter("excel_agent_gemini_context_caches_total", description="Gemini context caches created or refreshed", result="created")
+        return _CacheEntry(handle, cached_model, now + GEMINI_CONTEXT_CACHE_TTL_SECONDS)
+    except Exception as e:
+        # Not retried until the TTL is over, so an unsupported model or quota does not slow down every call
+        print(f"Could not create Gemini context cache, sending the prompt prefix inline: {e}")
+        increment_counter("excel_agent_gemini_context_caches_total", description="Gemini context caches created or refreshed", result="error")
+        return _CacheEntry(None, None, now + GEMINI_CONTEXT_CACHE_TTL_SECONDS)
+
+
+def _refresh_entry(entry: _CacheEntry) -> None:
+    """Extends the TTL of a cache that is about to expire; on failure it is recreated after expiring."""
+    with entry.lock:
+        if entry.expires_at - time.monotonic() > GEMINI_CONTEXT_CACHE_REFRESH_SECONDS:
+            return
+        try:
+            if entry.handle is not None:
+                entry.handle.update(ttl=datetime.timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL_SECONDS))
+                increment_counter("excel_agent_gemini_context_caches_total", description="Gemini context caches created or refreshed", result="refreshed")
+            entry.expires_at = time.monotonic() + GEMINI_CONTEXT_CACHE_TTL_SECONDS
+        except Exception as e:
+            print(f"Could not refresh Gemini context cache: {e}")
+
+
+def _get_entry(gemini_model, prefix_parts: list, mode: str) -> _CacheEntry:
+    key = _prefix_key(gemini_model, prefix_parts)
+    expired = None
+    with _entries_lock:
+        entry = _entries.get(key)
+        if entry is not None and entry.expires_at <= time.monotonic():
+            expired, entry = _entries.pop(key), None
+        if entry is not None:
+            _entries.move_to_end(key)
+    if expired is not None and expired.handle is not None:
+        _delete_provider_cache(expired.handle)
+    if entry is not None:
+        if entry.model is not None:
+            increment_counter("excel_agent_cache_hits_total", cache="gemini_context")
+            _refresh_entry(entry)
+        return entry
+
+    increment_counter("excel_agent_cache_misses_total", cache="gemini_context")
+    entry = _create_entry(gemini_model, prefix_parts, key, mode)
+    evicted = []
+    with _entries_lock:
+        existing = _entries.get(key)
+        if existing is not None:
+            # Another request created the same cache meanwhile; keep that one
+            evicted.append(entry)
+            entry = existing
+        else:
+            _entries[key] = entry
+            while len(_entries) > GEMINI_CONTEXT_CACHE_MAX_ENTRIES:
+                evicted.append(_entries.popitem(last=False)[1])
+    for stale in evicted:
+        if stale.handle is not None:
+            _delete_provider_cache(stale.handle)
+    return entry
+
+
+def with_cached_prefix(gemini_model, prefix_parts: list, suffix_parts: list, mode: str | None = None) -> tuple:
+    """
+    Returns (model, content_parts) for a request made of a static prefix (prompt instructions, template) and
+    a per-request suffix. With context caching the prefix is cached once per (prefix, model) and the returned
+    model is bound to that cache, so only the suffix is sent; otherwise the original model and all parts.
+    """
+    mode = mode or GEMINI_CONTEXT_CACHE
+    if mode not in CONTEXT_CACHE_MODES or mode == 'off' or not prefix_parts:
+        return gemini_model, prefix_parts + suffix_parts
+    if mode == 'provider' and not hasattr(gemini_model, 'model_name'):
+        # Test doubles and other non-Gemini models cannot hold a provider cache
+        mode = 'local'
+    if sum(len(part) for part in prefix_parts) / _CHARS_PER_TOKEN < GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+        return gemini_model, prefix_parts + suffix_parts
+    entry = _get_entry(gemini_model, prefix_parts, mode)
+    if entry.model is None:
+        return gemini_model, prefix_parts + suffix_parts
+    return entry.model, suffix_parts
+
+
+def clear_context_caches() -> None:
+    """Drops every cache entry, deleting provider caches (e.g. on shutdown, they would otherwise live until their TTL)."""
+    with _entries_lock:
+        entries = list(_entries.values())
+        _entries.clear()
+    for entry in entries:
+        if entry.handle is not None:
+            _delete_provider_cache(entry.handle)
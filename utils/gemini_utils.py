@@ -1,34 +1,90 @@
 import os
-from google import generativeai as genai
-from dotenv import load_dotenv
+import functools
+import threading
 from fastapi import HTTPException
 import io
 from PIL import Image
 from pdf2image import convert_from_path
 import base64
-import ast
-from braintrust import init_logger
+import re
+import itertools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
-# Load environment variables
-load_dotenv()
+from utils.json_stream_utils import IncrementalMappingParser
+from utils.gemini_cache_utils import with_cached_prefix
+from utils.deadline_utils import stage_deadline, current_stage_deadline, call_hedged
+from utils.metrics_utils import stage_timer, increment_counter
+from utils.rate_limit_utils import call_with_rate_limit
+from utils.region_utils import region_parts
+
+# Pages per Gemini Markdown request (0 = whole document in one request) and how many requests run at once
+SCAN_MARKDOWN_PAGES_PER_REQUEST = int(os.getenv('SCAN_MARKDOWN_PAGES_PER_REQUEST', '0'))
+SCAN_MARKDOWN_CONCURRENCY = int(os.getenv('SCAN_MARKDOWN_CONCURRENCY', '4'))
+# What the Markdown generation sees of the scan: "pages" sends every page image, "regions" only crops of
+# the regions Textract read with low confidence or that are handwritten (see region_utils)
+SCAN_MARKDOWN_IMAGE_MODES = ('pages', 'regions')
+SCAN_MARKDOWN_IMAGES = os.getenv('SCAN_MARKDOWN_IMAGES', 'pages').lower()
+# Longest a Gemini call may take (a streamed call: the whole stream), also when no request deadline applies
+GEMINI_REQUEST_TIMEOUT_SECONDS = float(os.getenv('GEMINI_REQUEST_TIMEOUT_SECONDS', '300'))
+
+_PAGE_MARKER_PATTERN = re.compile(r'\n\n=== Page (\d+) ===\n\n')
+
+# Structured-output schema for the mapping: one object per cell, with the value in "number" or "text"
+MAPPING_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "cell": {"type": "string"},
+            "text": {"type": "string"},
+            "number": {"type": "number"}
+        },
+        "required": ["cell"]
+    }
+}
+
+# google.generativeai and braintrust take over a second to import, so they are loaded on first use
+_gemini_model = None
+_gemini_model_lock = threading.Lock()
+
+def init_logger(**kwargs):
+    """Braintrust's init_logger, imported on first use."""
+    from braintrust import init_logger as braintrust_init_logger
+    return braintrust_init_logger(**kwargs)
 
 def get_gemini_client():
-    """Initializes and returns Google Gemini client."""
+    """Initializes (once per process) and returns Google Gemini client."""
+    global _gemini_model
     GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
     if not GEMINI_API_KEY:
         raise HTTPException(status_code=500, detail="GEMINI_API_KEY not found in environment variables")
-    
+    if _gemini_model is not None:
+        return _gemini_model
+
     try:
-        # Configure the client
-        genai.configure(api_key=GEMINI_API_KEY)
+        from google import generativeai as genai
+        # Configure the client. GEMINI_API_ENDPOINT (e.g. the load test's local stand-in) switches to the REST transport
+        GEMINI_API_ENDPOINT = os.getenv('GEMINI_API_ENDPOINT')
+        if GEMINI_API_ENDPOINT:
+            genai.configure(api_key=GEMINI_API_KEY, transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+        else:
+            genai.configure(api_key=GEMINI_API_KEY)
         # Initialize the generative model (adjust model name as needed)
-        model = genai.GenerativeModel("gemini-2.5-flash-preview-04-17")
-        return model
+        with _gemini_model_lock:
+            if _gemini_model is None:
+                _gemini_model = genai.GenerativeModel("gemini-2.5-flash-preview-04-17")
+        return _gemini_model
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to initialize Gemini client: {str(e)}")
 
+def _model_name(gemini_model) -> str:
+    """Model name used to pick the per-model rate limiter."""
+    return getattr(gemini_model, 'model_name', 'default').removeprefix('models/')
+
+@functools.lru_cache(maxsize=None)
 def read_prompt_file(filename):
-    """Read a prompt file from the prompt directory."""
+    """Read a prompt file from the prompt directory (once per process, the prompts do not change at runtime)."""
     prompt_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'prompts', filename)
     try:
         with open(prompt_path, 'r', encoding='utf-8') as f:
@@ -36,27 +92,139 @@ def read_prompt_file(filename):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to read prompt file {filename}: {str(e)}")
 
-def generate_markdown_from_scan(gemini_model, doc_path: str, raw_text_path: str, table_path: str) -> str:
+def record_token_usage(response, tool: str) -> None:
+    """Adds the prompt and response token counts of a Gemini response to the token counters."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    increment_counter("excel_agent_gemini_prompt_tokens_total", getattr(usage, 'prompt_token_count', 0) or 0,
+                      description="Gemini prompt tokens", tool=tool)
+    increment_counter("excel_agent_gemini_response_tokens_total", getattr(usage, 'candidates_token_count', 0) or 0,
+                      description="Gemini response tokens", tool=tool)
+    increment_counter("excel_agent_gemini_cached_tokens_total", getattr(usage, 'cached_content_token_count', 0) or 0,
+                      description="Gemini prompt tokens served from a context cache", tool=tool)
+
+def _request_options() -> dict:
+    """Per-call timeout for generate_content: GEMINI_REQUEST_TIMEOUT_SECONDS, or what remains of the current stage deadline."""
+    timeout = GEMINI_REQUEST_TIMEOUT_SECONDS
+    deadline = current_stage_deadline()
+    if deadline is not None:
+        timeout = min(timeout, max(1.0, deadline.remaining()))
+    return {"request_options": {"timeout": timeout}}
+
+def _close_stream(started) -> None:
+    """Closes the stream of a hedged mapping call that lost the race, so the connection is not held open."""
+    response, chunks, first_chunk = started
+    stream = getattr(response, '_iterator', None)
+    for close in (getattr(stream, 'cancel', None), getattr(stream, 'close', None)):
+        if callable(close):
+            close()
+            return
+
+def split_textract_pages(textract_output: str) -> dict[int, str]:
+    """Splits raw text or table output from extract_text_and_tables into sections per page number."""
+    parts = _PAGE_MARKER_PATTERN.split(textract_output)
+    # parts = [preamble, page_num, section, page_num, section, ...]
+    return {int(parts[i]): parts[i + 1] for i in range(1, len(parts) - 1, 2)}
+
+def select_textract_pages(textract_output: str, pages: list[int]) -> str:
+    """Keeps only the sections of the given page numbers from raw text or table output, in that order."""
+    sections = split_textract_pages(textract_output)
+    return ''.join(f"\n\n=== Page {page} ===\n\n{sections.get(page, '')}" for page in pages)
+
+def _generate_markdown_for_pages(gemini_model, prompt: str, visual_parts: list, raw_text: str, table_data: str) -> str:
     """
-    Generates markdown content from a document scan (PDF or image) using Gemini, aided by Textract output.
+    Sends one multimodal Markdown generation request for a set of pages: their Textract context and their
+    visual parts, page images or region crops with their captions.
     """
-    # Initialize Braintrust logger
-    logger = init_logger(
-        project="excel-agent-md-from-scan",
-        api_key=os.getenv("BRAINTRUST_API_KEY")
+    content_parts = [
+        f"Raw Text Context (from AWS Textract):\n{raw_text}",
+        f"Table Data Context (from AWS Textract):\n{table_data}"
+    ]
+
+    content_parts.extend(part if isinstance(part, str) else _image_part(part) for part in visual_parts)
+    # The prompt is the same for every scan and is sent from the context cache when it is large enough
+    gemini_model, content_parts = with_cached_prefix(gemini_model, [prompt], content_parts)
+
+    # Use generate_content for multimodal input
+    response = call_hedged(
+        "gemini_markdown", call_with_rate_limit, "gemini", gemini_model.generate_content, content_parts,
+        model=_model_name(gemini_model), **_request_options()
     )
+    record_token_usage(response, "markdown_generation")
+    markdown_content = response.text.strip()
+    # Clean potential markdown fences (though the prompt asks not to include them)
+    return markdown_content.removeprefix("```markdown").removesuffix("```").strip()
 
+def load_document_images(doc_path: str, stage: str, pages: list[int] | None = None) -> list:
+    """Rasterizes a PDF (or opens an image) for a multimodal Gemini request, keeping only the given page numbers if set."""
     try:
         # Handle PDF or image file
         file_ext = os.path.splitext(doc_path)[1].lower()
-        if file_ext == '.pdf':
-            images = convert_from_path(doc_path)
-        else:
-            # For image files, create a single-item list
-            images = [Image.open(doc_path)]
+        with stage_timer("rasterization"):
+            if file_ext == '.pdf':
+                images = convert_from_path(doc_path)
+            else:
+                # For image files, create a single-item list
+                images = [Image.open(doc_path)]
+        if pages is not None:
+            images = [images[page - 1] for page in pages]
+        increment_counter("excel_agent_pages_total", len(images), description="Document pages processed", stage=stage)
+        return images
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to process document for Gemini: {str(e)}")
 
+def _image_part(image):
+    """Re-encodes a page image as PNG, the form in which it is sent to Gemini."""
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format='PNG')
+    img_byte_arr = img_byte_arr.getvalue()
+    increment_counter("excel_agent_image_bytes_total", len(img_byte_arr), description="Image bytes sent upstream", upstream="gemini")
+    return Image.open(io.BytesIO(img_byte_arr))
+
+def _page_visual_parts(images: list, page_numbers: list[int], structure: list[dict] | None, image_mode: str) -> list[list]:
+    """The visual parts of every loaded page: the page image, or in "regions" mode its region crops and captions."""
+    if image_mode != 'regions' or structure is None:
+        return [[image] for image in images]
+    structure_pages = {page["page"]: page for page in structure}
+    visual_parts = []
+    for image, page_number in zip(images, page_numbers):
+        with stage_timer("region_crops"):
+            parts, kind = region_parts(image, structure_pages.get(page_number, {"page": page_number}))
+        increment_counter("excel_agent_region_pages_total", description="Pages sent as region crops, whole or not at all", kind=kind)
+        if kind == "crops":
+            # Every crop follows its caption
+            increment_counter("excel_agent_region_crops_total", len(parts) // 2, description="Region crops sent instead of page images")
+        visual_parts.append(parts)
+    return visual_parts
+
+def generate_markdown_from_scan(
+    gemini_model, doc_path: str, raw_text_path: str, table_path: str, pages_per_request: int | None = None,
+    pages: list[int] | None = None, structure: list[dict] | None = None, image_mode: str | None = None
+) -> str:
+    """
+    Generates markdown content from a document scan (PDF or image) using Gemini, aided by Textract output.
+    With pages_per_request set (default: SCAN_MARKDOWN_PAGES_PER_REQUEST), documents with more pages than that
+    are split into page groups that are sent to Gemini concurrently, each with only its own Textract sections,
+    and the resulting Markdown is joined in page order. 0 sends the whole document in a single request.
+    With pages set, only those page numbers (e.g. the ones kept by the page filter) are sent.
+    image_mode (default: SCAN_MARKDOWN_IMAGES) "regions" sends crops of the uncertain regions recorded in the
+    Textract structure instead of the page images; without a structure the page images are sent.
+    """
+    # Initialize Braintrust logger
+    logger = init_logger(
+        project="excel-agent-md-from-scan",
+        api_key=os.getenv("BRAINTRUST_API_KEY")
+    )
+    if pages_per_request is None:
+        pages_per_request = SCAN_MARKDOWN_PAGES_PER_REQUEST
+    image_mode = image_mode or SCAN_MARKDOWN_IMAGES
+
+    file_ext = os.path.splitext(doc_path)[1].lower()
+    images = load_document_images(doc_path, "gemini_markdown", pages)
+    # Page numbers of the loaded images, for the "=== Page n ===" sections that go with them
+    page_numbers = list(pages) if pages is not None else list(range(1, len(images) + 1))
+
     try:
         with open(raw_text_path, 'r', encoding='utf-8') as f:
             raw_text = f.read()
@@ -65,26 +233,45 @@ def generate_markdown_from_scan(gemini_model, doc_path: str, raw_text_path: str,
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to read Textract temp files: {str(e)}")
 
-    prompt = read_prompt_file('markdown-generation.md')
+    if pages is not None:
+        raw_text = select_textract_pages(raw_text, page_numbers)
+        table_data = select_textract_pages(table_data, page_numbers)
 
-    content_parts = [
-        prompt,
-        f"Raw Text Context (from AWS Textract):\n{raw_text}",
-        f"Table Data Context (from AWS Textract):\n{table_data}"
-    ]
+    prompt = read_prompt_file('markdown-generation.md')
+    visual_parts = _page_visual_parts(images, page_numbers, structure, image_mode)
+    if image_mode == 'regions' and structure is not None:
+        prompt += '\n\n' + read_prompt_file('markdown-generation-regions.md')
 
-    for image in images:
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='PNG')
-        img_byte_arr = img_byte_arr.getvalue()
-        content_parts.append(Image.open(io.BytesIO(img_byte_arr)))
-        
     try:
-        # Use generate_content for multimodal input
-        response = gemini_model.generate_content(content_parts)
-        markdown_content = response.text.strip()
-        # Clean potential markdown fences (though the prompt asks not to include them)
-        markdown_content = markdown_content.removeprefix("```markdown").removesuffix("```").strip()
+        with stage_deadline("gemini_markdown"), stage_timer("gemini_markdown"):
+            if pages_per_request <= 0 or len(images) <= pages_per_request:
+                markdown_content = _generate_markdown_for_pages(
+                    gemini_model, prompt, [part for parts in visual_parts for part in parts], raw_text, table_data
+                )
+            else:
+                raw_text_pages = split_textract_pages(raw_text)
+                table_pages = split_textract_pages(table_data)
+                page_groups = [
+                    range(start, min(start + pages_per_request, len(images)))
+                    for start in range(0, len(images), pages_per_request)
+                ]
+                # i indexes the loaded images, page_numbers[i] is the page it came from
+                with ThreadPoolExecutor(max_workers=SCAN_MARKDOWN_CONCURRENCY) as executor:
+                    # Each request runs in a copy of this context, so it sees the stage deadline
+                    futures = [
+                        executor.submit(
+                            contextvars.copy_context().run,
+                            _generate_markdown_for_pages,
+                            gemini_model,
+                            prompt,
+                            [part for i in group for part in visual_parts[i]],
+                            ''.join(f"\n\n=== Page {page_numbers[i]} ===\n\n{raw_text_pages.get(page_numbers[i], '')}" for i in group),
+                            ''.join(f"\n\n=== Page {page_numbers[i]} ===\n\n{table_pages.get(page_numbers[i], '')}" for i in group)
+                        )
+                        for group in page_groups
+                    ]
+                    # Results are collected in submission order, so the Markdown stays in page order
+                    markdown_content = '\n\n'.join(future.result() for future in futures)
 
         # Log the completion with Braintrust
         logger.log({
@@ -92,7 +279,9 @@ def generate_markdown_from_scan(gemini_model, doc_path: str, raw_text_path: str,
                 "prompt": prompt,
                 "raw_text": raw_text,
                 "table_data": table_data,
-                "num_images": len(images),
+                "num_images": sum(1 for parts in visual_parts for part in parts if not isinstance(part, str)),
+                "image_mode": image_mode,
+                "pages_per_request": pages_per_request,
                 "doc_type": "pdf" if file_ext == ".pdf" else "image"
             },
             "output": {"markdown_content": markdown_content},
@@ -103,13 +292,17 @@ def generate_markdown_from_scan(gemini_model, doc_path: str, raw_text_path: str,
         })
         
         return markdown_content
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Gemini API error during markdown generation: {str(e)}")
 
-def generate_excel_mapping_from_markdown(gemini_model, template_markdown: str, scan_markdown: str) -> dict:
+def _stream_excel_mapping(gemini_model, prefix: str, content_parts: list, exclude_cells: set, tool: str):
     """
-    Uses Gemini to analyze template and scan markdown, returning a Python dictionary 
-    mapping cell IDs to values for filling the Excel template.
+    Sends a mapping request in JSON response mode and yields (cell_id, value) pairs as they are streamed.
+    The prefix (instructions and template) is the same for every scan of a template and is sent from the
+    context cache; content_parts hold the scan content and optionally page images. Shared by the Markdown
+    and the direct mapping.
     """
     # Initialize Braintrust logger
     logger = init_logger(
@@ -117,45 +310,136 @@ def generate_excel_mapping_from_markdown(gemini_model, template_markdown: str, s
         api_key=os.getenv("BRAINTRUST_API_KEY")
     )
 
+    from google import generativeai as genai
+    parser = IncrementalMappingParser()
+    response_text = ""
+    pair_count = 0
+    stream_error = None
+    with stage_deadline("gemini_mapping") as deadline, stage_timer("gemini_mapping"):
+        try:
+            request_model, request_parts = with_cached_prefix(gemini_model, [prefix], content_parts)
+
+            def start_stream():
+                # Hedging covers the wait for the first chunk; the rest is read from whichever call answered first
+                response = call_with_rate_limit(
+                    "gemini",
+                    request_model.generate_content,
+                    request_parts,
+                    model=_model_name(request_model),
+                    generation_config=genai.GenerationConfig(
+                        response_mime_type="application/json",
+                        response_schema=MAPPING_RESPONSE_SCHEMA
+                    ),
+                    stream=True,
+                    **_request_options()
+                )
+                chunks = iter(response)
+                return response, chunks, next(chunks, None)
+
+            response, chunks, first_chunk = call_hedged("gemini_mapping", start_stream, discard=_close_stream)
+            for chunk in itertools.chain([first_chunk] if first_chunk is not None else [], chunks):
+                chunk_text = chunk.text
+                response_text += chunk_text
+                for cell_id, value in parser.feed(chunk_text):
+                    if cell_id in exclude_cells:
+                        continue
+                    pair_count += 1
+                    yield cell_id, value
+                if deadline is not None:
+                    # Stops reading a stream that overruns the stage; the pairs completed so far are kept
+                    deadline.check()
+            record_token_usage(response, tool)
+        except Exception as e:
+            stream_error = e
+
+    # Log the completion with Braintrust
+    logger.log({
+        "input": {
+            "prompt": prefix + ''.join(part for part in content_parts if isinstance(part, str)),
+            "num_images": sum(1 for part in content_parts if not isinstance(part, str))
+        },
+        "output": {"dict_string": response_text},
+        "metadata": {
+            "model_name": "gemini-2.5-flash-preview-04-17",
+            "tool": tool,
+            "skipped_elements": parser.skipped_elements,
+            "stream_error": str(stream_error) if stream_error else None
+        }
+    })
+
+    if stream_error is not None:
+        if pair_count == 0:
+            if isinstance(stream_error, HTTPException):
+                raise stream_error
+            raise HTTPException(status_code=500, detail=f"Gemini API error during data mapping generation: {str(stream_error)}\nRaw Response: {response_text[:500]}...")
+        print(f"Gemini mapping stream ended early ({stream_error}), keeping {pair_count} complete pairs.")
+    elif pair_count == 0 and not response_text.strip():
+        raise HTTPException(status_code=500, detail="Gemini returned an empty data mapping response.")
+    if parser.skipped_elements:
+        print(f"Skipped {len(parser.skipped_elements)} malformed mapping elements from Gemini.")
+
+def stream_excel_mapping_from_markdown(gemini_model, template_markdown: str, scan_markdown: str, exclude_cells: list[str] | None = None):
+    """
+    Uses Gemini's JSON response mode to map the scan markdown onto the template and yields (cell_id, value)
+    pairs as soon as each one has been streamed, so callers can validate and write cells while Gemini is
+    still generating. If the stream breaks off, every pair completed before that point is still yielded.
+    Cells listed in exclude_cells have already been filled and are left out of the mapping.
+    """
     prompt = read_prompt_file('excel-mapping.md')
-    prompt = f"{prompt}\n\nExcel Template:\n------------------------\n\"\"\"\n{template_markdown}\n\"\"\"\n------------------------\n\nForm in Markdown:\n--------------------------\n\"\"\"\n{scan_markdown}\n\"\"\"\n--------------------------\n"
+    prefix = f"{prompt}\n\nExcel Template:\n------------------------\n\"\"\"\n{template_markdown}\n\"\"\"\n------------------------\n\n"
+    scan_part = f"Form in Markdown:\n--------------------------\n\"\"\"\n{scan_markdown}\n\"\"\"\n--------------------------\n"
+    if exclude_cells:
+        scan_part += f"\nThe following cells have already been filled, do NOT include them in the JSON array: {', '.join(exclude_cells)}\n"
+    yield from _stream_excel_mapping(gemini_model, prefix, [scan_part], set(exclude_cells or []), "excel_mapping")
 
-    try:
-        response = gemini_model.generate_content(prompt)
-        
-        dict_string = response.text.strip()
+def stream_excel_mapping_followup(
+    gemini_model, template_markdown: str, missing_values: list[dict], flagged_cells: dict, exclude_cells: list[str] | None = None
+):
+    """
+    Targeted re-ask after the local coverage check: sends only the form values the mapping left out (with the
+    form line each was found on) and the mapped cells that cannot be written, and yields the cells to add.
+    Uses the same prefix as the Markdown mapping, so the instructions and template come from the context cache.
+    """
+    prompt = read_prompt_file('excel-mapping.md')
+    prefix = f"{prompt}\n\nExcel Template:\n------------------------\n\"\"\"\n{template_markdown}\n\"\"\"\n------------------------\n\n"
+    followup = read_prompt_file('excel-mapping-followup.md') + "\n"
+    if missing_values:
+        followup += "\nForm values not mapped:\n" + ''.join(
+            f'- "{item["value"]}" (form line: {item["context"]})\n' for item in missing_values
+        )
+    if flagged_cells:
+        followup += "\nCells that cannot be written:\n" + ''.join(
+            f'- {cell_id} = "{value}": {issue}\n' for cell_id, (value, issue) in flagged_cells.items()
+        )
+    if exclude_cells:
+        followup += f"\nThe following cells have already been filled, do NOT include them in the JSON array: {', '.join(exclude_cells)}\n"
+    yield from _stream_excel_mapping(gemini_model, prefix, [followup], set(exclude_cells or []), "excel_mapping_followup")
 
-        # Save dict_string to file for debugging/logging
-        with open("gemini_response.txt", "w") as f:
-            f.write(dict_string)
-        # Clean potential json fences
-        dict_string = dict_string.removeprefix("```json").removesuffix("```").strip()
-        
-        # Log the completion with Braintrust
-        logger.log({
-            "input": {
-                "prompt": prompt
-            },
-            "output": {"dict_string": dict_string},
-            "metadata": {
-                "model_name": "gemini-2.5-flash-preview-04-17",
-                "tool": "excel_mapping"
-            }
-        })
+def stream_excel_mapping_from_structure(
+    gemini_model, template_markdown: str, raw_text: str, table_data: str, key_values: str,
+    images: list | None = None, exclude_cells: list[str] | None = None
+):
+    """
+    Fast mode: maps the Textract output (text, key/value pairs and tables) and optionally the page images
+    straight onto the template in a single Gemini call, without generating the scan Markdown first.
+    Yields (cell_id, value) pairs like stream_excel_mapping_from_markdown.
+    """
+    prompt = read_prompt_file('excel-mapping-direct.md')
+    prefix = f"{prompt}\n\nExcel Template:\n------------------------\n\"\"\"\n{template_markdown}\n\"\"\"\n------------------------\n\n"
+    scan_part = (
+        f"Form Text (from AWS Textract):\n--------------------------\n\"\"\"\n{raw_text}\n\"\"\"\n--------------------------\n\n"
+        f"Form Key/Value Pairs (from AWS Textract):\n--------------------------\n\"\"\"\n{key_values}\n\"\"\"\n--------------------------\n\n"
+        f"Form Tables (from AWS Textract):\n--------------------------\n\"\"\"\n{table_data}\n\"\"\"\n--------------------------\n"
+    )
+    if exclude_cells:
+        scan_part += f"\nThe following cells have already been filled, do NOT include them in the JSON array: {', '.join(exclude_cells)}\n"
+    content_parts = [scan_part] + [_image_part(image) for image in images or []]
+    yield from _stream_excel_mapping(gemini_model, prefix, content_parts, set(exclude_cells or []), "excel_mapping_direct")
 
-        # Safely evaluate the string to a dictionary
-        try:
-            data_to_insert = ast.literal_eval(dict_string)
-            if not isinstance(data_to_insert, dict):
-                raise ValueError("Gemini did not return a dictionary.")
-            return data_to_insert
-        except (SyntaxError, ValueError, TypeError) as e:
-             raise HTTPException(status_code=500, detail=f"Gemini returned invalid dictionary format: {e}\nResponse: {dict_string}")
-            
-    except Exception as e:
-        # Catch potential API errors or other issues
-        # Check if 'response' exists before trying to access 'response.text'
-        error_detail = f"Gemini API error during data mapping generation: {str(e)}"
-        if 'response' in locals() and hasattr(response, 'text'):
-             error_detail += f"\nRaw Response: {response.text[:500]}..." # Include partial response for debugging
-        raise HTTPException(status_code=500, detail=error_detail) 
\ No newline at end of file
+def generate_excel_mapping_from_markdown(gemini_model, template_markdown: str, scan_markdown: str, exclude_cells: list[str] | None = None) -> dict:
+    """
+    Uses Gemini to analyze template and scan markdown, returning a Python dictionary 
+    mapping cell IDs to values for filling the Excel template.
+    Cells listed in exclude_cells have already been filled and are left out of the mapping.
+    """
+    return dict(stream_excel_mapping_from_markdown(gemini_model, template_markdown, scan_markdown, exclude_cells))
@@ -0,0 +1,86 @@
+import json
+
+
+class IncrementalMappingParser:
+    """
+    Incrementally parses a streamed JSON mapping and emits (cell, value) pairs as soon as each one is complete.
+
+    Two top-level shapes are understood:
+    - an array of {"cell": ..., "text": ... | "number": ...} objects (Gemini's structured-output schema)
+    - an object of {"A1": value, ...} pairs (the free-form format)
+    Anything before the first '[' or '{' (e.g. a code fence) is ignored. A malformed element is skipped
+    instead of failing the whole response, and an element cut off by a truncated stream is never emitted.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._container = None  # '[' or '{' once the top-level container has been found
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._element_start = None
+        self._done = False
+        self.skipped_elements = []
+
+    def feed(self, chunk: str) -> list[tuple[str, object]]:
+        """Adds a chunk of response text and returns the pairs that were completed by it."""
+        self._buffer += chunk
+        pairs = []
+        while self._pos < len(self._buffer) and not self._done:
+            char = self._buffer[self._pos]
+            if self._container is None:
+                if char in '[{':
+                    self._container = char
+                    self._depth = 1
+                    self._element_start = self._pos + 1
+                self._pos += 1
+                continue
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '[{':
+                self._depth += 1
+            elif char in ']}':
+                self._depth -= 1
+                if self._depth == 0:
+                    pairs.extend(self._parse_element(self._buffer[self._element_start:self._pos]))
+                    self._done = True
+            elif char == ',' and self._depth == 1:
+                pairs.extend(self._parse_element(self._buffer[self._element_start:self._pos]))
+                self._element_start = self._pos + 1
+            self._pos += 1
+
+        # Drop text that has already been parsed so the buffer only holds the current element
+        if self._element_start is not None and self._element_start > 0 and not self._done:
+            self._buffer = self._buffer[self._element_start:]
+            self._pos -= self._element_start
+            self._element_start = 0
+        return pairs
+
+    def _parse_element(self, element: str) -> list[tuple[str, object]]:
+        element = element.strip()
+        if not element:
+            return []
+        try:
+            if self._container == '{':
+                return list(json.loads("{" + element + "}").items())
+            item = json.loads(element)
+        except json.JSONDecodeError:
+            self.skipped_elements.append(element)
+            return []
+        if not isinstance(item, dict) or not isinstance(item.get("cell"), str):
+            self.skipped_elements.append(element)
+            return []
+        value = item.get("number") if item.get("number") is not None else item.get("text")
+        if value is None:
+            self.skipped_elements.append(element)
+            return []
+        return [(item["cell"], value)]
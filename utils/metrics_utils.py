@@ -0,0 +1,157 @@
+import time
+import asyncio
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+# Latency buckets in seconds, sized for everything from a template fill to a multi-page Gemini call
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Event-loop lag is normally sub-millisecond, anything above 100ms means a route blocked the loop
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_metrics_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> {"buckets": [...], "sum": float, "count": int}
+_help = {}
+
+# Per-request list of (stage, seconds), set by the HTTP middleware and read for the Server-Timing header
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def increment_counter(name: str, value: float = 1, description: str = "", **labels) -> None:
+    """Adds value to a counter, e.g. increment_counter("excel_agent_pages_total", 3, source="textract")."""
+    with _metrics_lock:
+        key = (name, _label_key(labels))
+        _counters[key] = _counters.get(key, 0) + value
+        if description:
+            _help.setdefault(name, description)
+
+
+def observe_histogram(name: str, value: float, description: str = "", buckets: tuple = LATENCY_BUCKETS, **labels) -> None:
+    """Records one observation in a latency histogram."""
+    with _metrics_lock:
+        key = (name, _label_key(labels))
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"bounds": buckets, "buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(histogram["bounds"]):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+        if description:
+            _help.setdefault(name, description)
+
+
+def start_request_timings() -> tuple[list, contextvars.Token]:
+    """Starts collecting stage timings for the current request. Returns the timings list and a reset token."""
+    timings = []
+    return timings, _request_timings.set(timings)
+
+
+def reset_request_timings(token: contextvars.Token) -> None:
+    _request_timings.reset(token)
+
+
+def record_request_timing(name: str, seconds: float) -> None:
+    """Adds an entry to the current request's Server-Timing header without recording a stage metric."""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """
+    Times a pipeline stage. The duration is recorded in the excel_agent_stage_duration_seconds
+    histogram and, when running inside an HTTP request, in that request's Server-Timing header.
+    """
+    # Captured up front: the stage may finish in another thread than the one that started it
+    timings = _request_timings.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe_histogram(
+            "excel_agent_stage_duration_seconds", elapsed,
+            description="Duration of pipeline stages in seconds", stage=stage
+        )
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def timed_stage(stage: str):
+    """Decorator form of stage_timer for functions that make up a whole stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def monitor_event_loop_lag(interval: float) -> None:
+    """
+    Sleeps for interval seconds in a loop and records how late each wake-up was in the
+    excel_agent_event_loop_lag_seconds histogram. Sustained lag means blocking work is running on the loop.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        observe_histogram(
+            "excel_agent_event_loop_lag_seconds", max(0.0, loop.time() - start - interval),
+            description="Delay of event loop wake-ups in seconds", buckets=LAG_BUCKETS
+        )
+
+
+def format_server_timing(timings: list, total_seconds: float | None = None) -> str:
+    """Formats stage timings as a Server-Timing header value, summing stages that ran more than once."""
+    totals = {}
+    for stage, seconds in timings:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in totals.items()]
+    if total_seconds is not None:
+        entries.append(f"total;dur={total_seconds * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def render_prometheus_metrics() -> str:
+    """Renders all counters and histograms in the Prometheus text exposition format."""
+    lines = []
+    with _metrics_lock:
+        for metric_name in sorted({name for name, _ in _counters}):
+            if metric_name in _help:
+                lines.append(f"# HELP {metric_name} {_help[metric_name]}")
+            lines.append(f"# TYPE {metric_name} counter")
+            for (name, labels), value in sorted(_counters.items()):
+                if name == metric_name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        for metric_name in sorted({name for name, _ in _histograms}):
+            if metric_name in _help:
+                lines.append(f"# HELP {metric_name} {_help[metric_name]}")
+            lines.append(f"# TYPE {metric_name} histogram")
+            for (name, labels), histogram in sorted(_histograms.items()):
+                if name != metric_name:
+                    continue
+                for bound, count in zip(histogram["bounds"], histogram["buckets"]):
+                    lines.append(f"{name}_bucket{_format_labels(labels, (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,105 @@
+import os
+import re
+
+# Blank pages (and blank backs of duplex scans) are detected from pixel statistics and skip Textract and Gemini
+PAGE_BLANK_FILTER_ENABLED = os.getenv('PAGE_BLANK_FILTER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Share of a page's pixels that must be ink for it to count as not blank. Kept low: a page with a single
+# handwritten value must never be dropped, a noisy blank page only costs its Textract and Gemini calls
+PAGE_BLANK_MAX_INK_RATIO = float(os.getenv('PAGE_BLANK_MAX_INK_RATIO', '0.001'))
+# Pages whose text shares too little vocabulary with the template's labels (cover sheets, photo pages) are
+# left out of the Gemini requests
+PAGE_RELEVANCE_FILTER_ENABLED = os.getenv('PAGE_RELEVANCE_FILTER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+PAGE_RELEVANCE_MIN_SCORE = float(os.getenv('PAGE_RELEVANCE_MIN_SCORE', '0.1'))
+
+# Pages are downscaled to this width before their pixels are counted
+_THUMBNAIL_WIDTH = 800
+# Ink is clearly darker than the page background, which is the most common brightness
+_INK_CONTRAST = 60
+# Template terms a page must match for a score of 1.0; large templates are not harder to match than small ones
+_RELEVANCE_TERMS = 20
+_TERM = re.compile(r'[^\W\d_]{3,}')
+# Words too common to tell a form page from a cover sheet
+_STOP_WORDS = {
+    'the', 'and', 'for', 'with', 'from', 'this', 'that', 'are', 'was', 'not', 'you', 'your', 'our', 'all',
+    'any', 'per', 'has', 'have', 'will', 'please', 'page', 'date', 'name', 'total', 'yes'
+}
+
+
+def page_ink_ratio(image) -> float:
+    """Share of the page's pixels that are clearly darker than its background."""
+    gray = image.convert('L')
+    if gray.width > _THUMBNAIL_WIDTH:
+        gray = gray.resize((_THUMBNAIL_WIDTH, max(1, round(gray.height * _THUMBNAIL_WIDTH / gray.width))))
+    histogram = gray.histogram()
+    background = max(range(256), key=histogram.__getitem__)
+    ink = sum(histogram[:max(0, background - _INK_CONTRAST)])
+    return ink / (gray.width * gray.height)
+
+
+def is_blank_page(image) -> bool:
+    return PAGE_BLANK_FILTER_ENABLED and page_ink_ratio(image) < PAGE_BLANK_MAX_INK_RATIO
+
+
+def blank_page(page_num: int) -> dict:
+    """The structure of a page that was skipped as blank: no lines, key/value pairs or tables."""
+    return {"lines": [], "text_lines": [], "key_values": [], "tables": [], "page": page_num, "skipped": "blank"}
+
+
+def _terms(text: str) -> set:
+    return {term.lower() for term in _TERM.findall(text)} - _STOP_WORDS
+
+
+def _page_terms(page: dict) -> set:
+    terms = set()
+    for line in page["lines"]:
+        terms |= _terms(line)
+    for kv in page["key_values"]:
+        terms |= _terms(f"{kv['key']} {kv['value']}")
+    for grid in page["tables"]:
+        for row in grid:
+            terms |= _terms(' '.join(row))
+    return terms
+
+
+def score_page_relevance(page: dict, template_terms: set) -> float:
+    """Share of the template's label vocabulary (up to 20 terms) that also appears on the page, from 0.0 to 1.0."""
+    if not template_terms:
+        return 1.0
+    matched = len(_page_terms(page) & template_terms)
+    return min(1.0, matched / min(len(template_terms), _RELEVANCE_TERMS))
+
+
+def filter_pages(pages: list[dict], template_labels: list[str] | None = None) -> list[dict]:
+    """
+    Decides which pages go to Gemini. Returns one {"page", "decision", "score"} per page, where decision is
+    "kept", "blank" (skipped before Textract) or "irrelevant" (its text matches too few template labels).
+    Without template labels only blank pages are dropped. If no page would be kept, all non-blank pages are.
+    """
+    template_terms = set()
+    for label in template_labels or []:
+        template_terms |= _terms(label)
+    decisions = []
+    for page in pages:
+        if page.get("skipped") == "blank":
+            decisions.append({"page": page["page"], "decision": "blank", "score": 0.0})
+            continue
+        score = score_page_relevance(page, template_terms) if template_labels and PAGE_RELEVANCE_FILTER_ENABLED else 1.0
+        decision = "kept" if score >= PAGE_RELEVANCE_MIN_SCORE else "irrelevant"
+        decisions.append({"page": page["page"], "decision": decision, "score": round(score, 2)})
+    if not any(decision["decision"] == "kept" for decision in decisions):
+        for decision in decisions:
+            if decision["decision"] == "irrelevant":
+                decision["decision"] = "kept"
+    return decisions
+
+
+def kept_pages(decisions: list[dict]) -> list[int]:
+    return [decision["page"] for decision in decisions if decision["decision"] == "kept"]
+
+
+def format_page_decisions(decisions: list[dict]) -> str:
+    """Formats the decisions for the X-Page-Filter header, e.g. "1=kept;score=0.85, 2=blank, 3=irrelevant;score=0.05"."""
+    return ", ".join(
+        f"{decision['page']}={decision['decision']}" + (f";score={decision['score']:.2f}" if decision['decision'] != 'blank' else "")
+        for decision in decisions
+    )
@@ -0,0 +1,109 @@
+import os
+import re
+import shutil
+import subprocess
+
+# Digitally generated PDFs are read from their text layer with poppler's pdftotext instead of Textract
+PDF_TEXT_LAYER_ENABLED = os.getenv('PDF_TEXT_LAYER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# A page needs at least this many non-space characters in its text layer, otherwise it is treated as a scan
+PDF_TEXT_LAYER_MIN_CHARS = int(os.getenv('PDF_TEXT_LAYER_MIN_CHARS', '50'))
+PDFTOTEXT_TIMEOUT_SECONDS = 60
+
+# Share of a page's characters that must be readable text; broken font encodings produce control
+# characters and U+FFFD instead, and such text layers are worse than OCR
+_MIN_READABLE_SHARE = 0.95
+# In -layout output, words of one column are separated by single spaces and columns by runs of spaces
+_SEGMENT = re.compile(r'\S+(?: \S+)*')
+_KEY_VALUE = re.compile(r'^([^:]{1,60}?)\s*:\s*(\S.*)$')
+
+
+def _is_usable_page(text: str) -> bool:
+    characters = [char for char in text if not char.isspace()]
+    if len(characters) < PDF_TEXT_LAYER_MIN_CHARS:
+        return False
+    readable = sum(1 for char in characters if char.isprintable() and char != '�')
+    return readable / len(characters) >= _MIN_READABLE_SHARE
+
+
+def read_pdf_text_layer(doc_path: str) -> list[str] | None:
+    """
+    Returns the layout-preserving text of every page of a PDF, or None when the PDF has no usable text
+    layer on every page (scans, image-only pages, garbled encodings) or pdftotext is not available.
+    """
+    if not PDF_TEXT_LAYER_ENABLED or os.path.splitext(doc_path)[1].lower() != '.pdf':
+        return None
+    if shutil.which('pdftotext') is None:
+        return None
+    try:
+        result = subprocess.run(
+            ['pdftotext', '-layout', '-enc', 'UTF-8', doc_path, '-'],
+            capture_output=True, timeout=PDFTOTEXT_TIMEOUT_SECONDS, check=True
+        )
+    except (subprocess.SubprocessError, OSError) as e:
+        print(f"Could not read the text layer of {doc_path}: {e}")
+        return None
+    # Pages are separated by form feeds, and the output ends with one
+    pages = result.stdout.decode('utf-8', errors='replace').split('\f')
+    if pages and not pages[-1].strip():
+        pages.pop()
+    if not pages or not all(_is_usable_page(page) for page in pages):
+        return None
+    return pages
+
+
+def _segments(line: str) -> list[tuple[int, str]]:
+    """Splits a layout line into (start column, text) segments at runs of two or more spaces."""
+    return [(match.start(), match.group()) for match in _SEGMENT.finditer(line)]
+
+
+def _build_table(rows: list[list[tuple[int, str]]]) -> list[list[str]]:
+    """Aligns the segments of consecutive multi-column lines into a grid by their start columns."""
+    starts = sorted({start for row in rows for start, _ in row})
+    columns = []
+    for start in starts:
+        # Starts within two characters of each other belong to the same column
+        if not columns or start - columns[-1] > 2:
+            columns.append(start)
+    grid = []
+    for row in rows:
+        cells = [''] * len(columns)
+        for start, text in row:
+            index = max(i for i, column in enumerate(columns) if column <= start + 2)
+            cells[index] = f"{cells[index]} {text}".strip()
+        grid.append(cells)
+    return grid
+
+
+def parse_text_layer_page(text: str) -> dict:
+    """
+    Parses one page of pdftotext -layout output into the structure parse_textract_page returns:
+    {"lines", "text_lines", "key_values", "tables"}. Runs of two or more lines with several columns become
+    tables (and are left out of text_lines), and "Label: value" segments (or a "Label:" segment followed
+    by another segment) key/value pairs.
+    """
+    lines, text_lines, key_values, tables = [], [], [], []
+    table_rows = []
+    for line in text.splitlines() + ['']:
+        segments = _segments(line)
+        if len(segments) >= 2:
+            table_rows.append(segments)
+        else:
+            if len(table_rows) >= 2:
+                tables.append(_build_table(table_rows))
+            else:
+                text_lines.extend(' '.join(segment for _, segment in row) for row in table_rows)
+            table_rows = []
+            text_lines.extend(segment for _, segment in segments)
+
+        for index, (_, segment) in enumerate(segments):
+            lines.append(segment)
+            match = _KEY_VALUE.match(segment)
+            if match:
+                key, value = match.groups()
+            elif segment.endswith(':') and index + 1 < len(segments):
+                key, value = segment[:-1].strip(), segments[index + 1][1]
+            else:
+                continue
+            # Read from the document itself rather than recognized, so there is no recognition uncertainty
+            key_values.append({"key": key, "value": value, "confidence": 100.0})
+    return {"lines": lines, "text_lines": text_lines, "key_values": key_values, "tables": tables}
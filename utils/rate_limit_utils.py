@@ -0,0 +1,155 @@
+import os
+import math
+import time
+import random
+import threading
+from fastapi import HTTPException
+
+from utils.metrics_utils import increment_counter, observe_histogram
+
+# Request quotas. Gemini quotas apply per model, so every model gets its own bucket.
+TEXTRACT_REQUESTS_PER_SECOND = float(os.getenv('TEXTRACT_REQUESTS_PER_SECOND', '5'))
+TEXTRACT_BURST = int(os.getenv('TEXTRACT_BURST', '5'))
+GEMINI_REQUESTS_PER_MINUTE = float(os.getenv('GEMINI_REQUESTS_PER_MINUTE', '300'))
+GEMINI_BURST = int(os.getenv('GEMINI_BURST', '10'))
+# Admission control: calls that would wait longer than this, or find the wait queue full, are rejected with 429
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv('RATE_LIMIT_MAX_WAIT_SECONDS', '10'))
+RATE_LIMIT_MAX_QUEUE = int(os.getenv('RATE_LIMIT_MAX_QUEUE', '32'))
+# Retries of throttled calls, with full-jitter exponential backoff
+THROTTLE_MAX_RETRIES = int(os.getenv('THROTTLE_MAX_RETRIES', '4'))
+THROTTLE_BACKOFF_BASE_SECONDS = float(os.getenv('THROTTLE_BACKOFF_BASE_SECONDS', '0.5'))
+THROTTLE_BACKOFF_MAX_SECONDS = 8.0
+
+_TEXTRACT_THROTTLING_CODES = {
+    'ThrottlingException', 'ProvisionedThroughputExceededException', 'LimitExceededException', 'TooManyRequestsException'
+}
+
+
+class UpstreamBusyError(HTTPException):
+    """An upstream call was not admitted (or stayed throttled); answered as 429 with a Retry-After header."""
+
+    def __init__(self, upstream: str, retry_after: float):
+        self.upstream = upstream
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(
+            status_code=429,
+            detail=f"{upstream} is at its request quota, retry in {self.retry_after}s",
+            headers={"Retry-After": str(self.retry_after)}
+        )
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. A caller that finds no token reserves the next one and sleeps until it
+    accrues, so waiting callers are served in arrival order without busy polling.
+    """
+
+    def __init__(self, name: str, rate_per_second: float, burst: int, max_wait: float, max_queue: int):
+        self.name = name
+        self.rate = rate_per_second
+        self.burst = max(1, burst)
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._waiters = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> float:
+        """Takes one token, waiting if needed. Returns the wait in seconds; raises UpstreamBusyError instead of overstaying."""
+        with self._lock:
+            self._refill(time.monotonic())
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if wait > 0 and (wait > self.max_wait or self._waiters >= self.max_queue):
+                increment_counter("excel_agent_rate_limit_rejections_total", description="Upstream calls rejected by admission control", upstream=self.name)
+                raise UpstreamBusyError(self.name, wait)
+            self._tokens -= 1
+            if wait > 0:
+                self._waiters += 1
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                with self._lock:
+                    self._waiters -= 1
+        observe_histogram("excel_agent_rate_limit_wait_seconds", wait, description="Time spent waiting for an upstream token", upstream=self.name)
+        return wait
+
+    def estimated_wait(self) -> float:
+        """Seconds a caller arriving now would wait for a token."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (1 - self._tokens) / self.rate)
+
+    def drain(self) -> None:
+        """Drops any saved-up burst after the upstream throttled us, so other callers slow down too."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, 0.0)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(upstream: str, model: str | None = None) -> TokenBucket:
+    """Returns the shared limiter for an upstream ("textract" or "gemini"), per model for Gemini."""
+    name = f"{upstream}:{model}" if model else upstream
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            if upstream == "gemini":
+                rate, burst = GEMINI_REQUESTS_PER_MINUTE / 60, GEMINI_BURST
+            else:
+                rate, burst = TEXTRACT_REQUESTS_PER_SECOND, TEXTRACT_BURST
+            limiter = _limiters[name] = TokenBucket(name, rate, burst, RATE_LIMIT_MAX_WAIT_SECONDS, RATE_LIMIT_MAX_QUEUE)
+        return limiter
+
+
+def check_admission(*upstreams: str) -> None:
+    """
+    Rejects a request up front with UpstreamBusyError when any limiter of the given upstreams
+    (all models, for Gemini) already has a wait beyond the admission deadline.
+    """
+    with _limiters_lock:
+        limiters = [l for name, l in _limiters.items() if name.split(':')[0] in upstreams]
+    for limiter in limiters:
+        wait = limiter.estimated_wait()
+        if wait > limiter.max_wait:
+            increment_counter("excel_agent_rate_limit_rejections_total", description="Upstream calls rejected by admission control", upstream=limiter.name)
+            raise UpstreamBusyError(limiter.name, wait)
+
+
+def is_throttling_error(error: Exception) -> bool:
+    # Checked by shape rather than class so botocore and google.api_core need not be imported here
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):  # botocore ClientError
+        return response.get('Error', {}).get('Code') in _TEXTRACT_THROTTLING_CODES
+    # google.api_core TooManyRequests / ResourceExhausted carry the HTTP status as code
+    return getattr(error, 'code', None) == 429
+
+
+def call_with_rate_limit(upstream: str, func, *args, model: str | None = None, **kwargs):
+    """
+    Calls func once a token for the upstream is available. Throttling errors are retried with jittered
+    exponential backoff (each retry takes a new token); other errors are raised unchanged.
+    """
+    limiter = get_rate_limiter(upstream, model)
+    for attempt in range(THROTTLE_MAX_RETRIES + 1):
+        limiter.acquire()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if not is_throttling_error(e):
+                raise
+            increment_counter("excel_agent_upstream_throttled_total", description="Calls throttled by an upstream", upstream=limiter.name)
+            limiter.drain()
+            backoff = min(THROTTLE_BACKOFF_MAX_SECONDS, THROTTLE_BACKOFF_BASE_SECONDS * 2 ** attempt)
+            if attempt == THROTTLE_MAX_RETRIES:
+                raise UpstreamBusyError(limiter.name, backoff)
+            print(f"{limiter.name} throttled the call (attempt {attempt + 1}), backing off: {e}")
+            time.sleep(random.uniform(0, backoff))
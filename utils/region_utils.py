@@ -0,0 +1,92 @@
+import os
+
+# Words Textract read with less confidence than this are sent to Gemini as image crops in "regions" mode
+REGION_MIN_CONFIDENCE = float(os.getenv('REGION_MIN_CONFIDENCE', '90'))
+# Handwritten words are cropped whatever their confidence: Textract's handwriting confidence is a poor guide
+REGION_INCLUDE_HANDWRITING = os.getenv('REGION_INCLUDE_HANDWRITING', 'true').lower() in ('1', 'true', 'yes')
+# Margin around each line, as a share of the page size; lines whose margins touch are cropped together
+REGION_PADDING = float(os.getenv('REGION_PADDING', '0.005'))
+# When the crops would cover more of the page than this, the whole page is sent instead
+REGION_MAX_PAGE_SHARE = float(os.getenv('REGION_MAX_PAGE_SHARE', '0.6'))
+# Crops larger than this many pixels are downscaled; Gemini bills images in 768x768 tiles
+REGION_MAX_PIXELS = int(os.getenv('REGION_MAX_PIXELS', str(768 * 768)))
+
+# Textract text quoted in a crop's caption, so Gemini knows which part of the context it corrects
+_CAPTION_CHARS = 200
+
+
+def is_uncertain_word(block: dict) -> bool:
+    """Whether a Textract WORD block should be checked against the image."""
+    if REGION_INCLUDE_HANDWRITING and block.get('TextType') == 'HANDWRITING':
+        return True
+    return block.get('Confidence', 100.0) < REGION_MIN_CONFIDENCE
+
+
+def _padded(box: list[float]) -> list[float]:
+    left, top, width, height = box
+    return [
+        max(0.0, left - REGION_PADDING), max(0.0, top - REGION_PADDING),
+        min(1.0, left + width + REGION_PADDING), min(1.0, top + height + REGION_PADDING)
+    ]
+
+
+def _touches(a: list[float], b: list[float]) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def find_regions(uncertain_lines: list[dict]) -> list[dict]:
+    """
+    Merges the padded boxes of the uncertain lines into regions, {"box": [left, top, right, bottom], "texts": [...]},
+    in page coordinates from 0 to 1 and in reading order. Lines whose boxes touch, such as the cells of a
+    table row or the rows of a table, end up in the same region.
+    """
+    regions = [{"box": _padded(line["box"]), "texts": [line["text"]]} for line in uncertain_lines]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(len(regions) - 1, i, -1):
+                if _touches(regions[i]["box"], regions[j]["box"]):
+                    a, b = regions[i]["box"], regions.pop(j)
+                    regions[i]["box"] = [min(a[0], b["box"][0]), min(a[1], b["box"][1]), max(a[2], b["box"][2]), max(a[3], b["box"][3])]
+                    regions[i]["texts"] = regions[i]["texts"] + b["texts"]
+                    merged = True
+    return sorted(regions, key=lambda region: (region["box"][1], region["box"][0]))
+
+
+def region_share(regions: list[dict]) -> float:
+    """Share of the page the regions cover (they do not overlap once merged)."""
+    return sum((box[2] - box[0]) * (box[3] - box[1]) for box in (region["box"] for region in regions))
+
+
+def crop_region(image, box: list[float]):
+    """Crops a region from the page image in grayscale, downscaled to at most REGION_MAX_PIXELS."""
+    width, height = image.size
+    crop = image.crop((round(box[0] * width), round(box[1] * height), round(box[2] * width), round(box[3] * height))).convert('L')
+    pixels = crop.width * crop.height
+    if pixels > REGION_MAX_PIXELS:
+        scale = (REGION_MAX_PIXELS / pixels) ** 0.5
+        crop = crop.resize((max(1, int(crop.width * scale)), max(1, int(crop.height * scale))))
+    return crop
+
+
+def region_parts(image, page: dict) -> tuple[list, str]:
+    """
+    The visual parts of a page for Gemini: a caption and a crop per uncertain region, nothing when Textract read
+    the whole page confidently, or the full page image when the regions would cover most of it.
+    Returns (parts, kind) where kind is "crops", "none" or "page".
+    """
+    regions = find_regions(page.get("uncertain_lines", []))
+    if not regions:
+        return [], "none"
+    if region_share(regions) > REGION_MAX_PAGE_SHARE:
+        return [f"Page {page['page']} (full page):", image], "page"
+    parts = []
+    for number, region in enumerate(regions, 1):
+        left, top = region["box"][0], region["box"][1]
+        texts = ' / '.join(region["texts"])
+        if len(texts) > _CAPTION_CHARS:
+            texts = texts[:_CAPTION_CHARS] + '...'
+        parts.append(f"Page {page['page']}, region {number} (at {left:.0%} from the left, {top:.0%} from the top); Textract read: {texts}")
+        parts.append(crop_region(image, region["box"]))
+    return parts, "crops"
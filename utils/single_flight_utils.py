@@ -0,0 +1,60 @@
+import asyncio
+import hashlib
+
+from utils.metrics_utils import increment_counter
+
+
+def coalescing_key(*parts) -> str:
+    """Builds a single-flight key from content hashes and request parameters."""
+    return hashlib.sha256('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+        self.result_taken = False
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller starts the work, callers that arrive
+    while it is in flight wait for it and receive its result (or its exception). The entry is removed
+    as soon as the work finishes, so nothing is cached beyond the lifetime of the in-flight call.
+
+    The work runs as its own task that every caller awaits through asyncio.shield, so a caller that is
+    cancelled (e.g. its client disconnected) does not cancel the others; the work itself is only cancelled
+    once no caller is waiting for it any more.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}  # key -> _Flight
+
+    async def run(self, key: str, func, share=None):
+        """
+        Awaits func() once per key. The first caller to pick up the result receives it as is; share(result),
+        if given, builds the copy every other caller receives, e.g. a private copy of an output file that
+        the first caller's own cleanup will delete.
+        """
+        flight = self._calls.get(key)
+        if flight is None:
+            flight = self._calls[key] = _Flight(asyncio.ensure_future(func()))
+            flight.task.add_done_callback(lambda _: self._calls.pop(key, None) if self._calls.get(key) is flight else None)
+        else:
+            increment_counter(
+                "excel_agent_coalesced_requests_total",
+                description="Requests that attached to an identical in-flight request", endpoint=self.name
+            )
+
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+        if flight.result_taken and share is not None:
+            return share(result)
+        flight.result_taken = True
+        return result